@@ -4,8 +4,9 @@ import os
 import importlib
 from utils.user_manager import user_manager     # 确保这行导入存在
 from config import LOGGER
-from bot.bot_session_manager import BotSessionManager
+from bot.bot_session_manager import session_manager_cache
 from tools.tool_manager import ToolManager
+from utils.session_utils import cancel_session_calls, get_session_id
 import sys
 
 # streamlit run app.py
@@ -26,6 +27,8 @@ def load_page(page_name):               # 定义一个函数，用于根据页
 
 # 一个Streamlit应用的入口点，它负责处理用户会话、登录状态、页面导航以及应用的最终渲染
 if __name__ == "__main__":
+    # 页面重跑时，上一次运行中还没结束的大模型调用已经没有页面接收结果，立即取消，释放连接和限流配额
+    cancel_session_calls()
     bot_manager = None
     tool_manager = ToolManager()                    # 创建一个ToolManager工具管理器实例
     st.session_state.tool_manager = tool_manager    # 将工具管理器实例存储在会话状态中
@@ -48,7 +51,7 @@ if __name__ == "__main__":
             st.session_state['token'] = token   # 将token存储在会话状态中，以便在页面之间传递
             st.session_state.logged_in = True   # 更新会话状态以反映用户已登录
             st.session_state.username = user_manager.get_logged_in_username()   # 将用户名存储在会话状态中，以便在页面之间传递
-            bot_manager = BotSessionManager(st.session_state.username)          # 创建一个BotSessionManager实例，用于管理用户的机器人会话
+            bot_manager = session_manager_cache.get(st.session_state.username, get_session_id())  # 获取用户在本会话中的BotSessionManager实例，进程内缓存，数据没有变化时不重新读取
             st.session_state.bot_manager = bot_manager                          # 将 BotSessionManager 实例存储在会话状态中
             # 更新会话状态以包含用户的机器人列表、群组历史版本信息和当前群组历史版本索引
             st.session_state.bots = bot_manager.bots                            # 将机器人列表存储在会话状态中
@@ -74,48 +77,67 @@ if __name__ == "__main__":
     if 'page' not in st.session_state:
         st.session_state.page = "login_page"
 
-    # st.columns([1, 1, 1], gap="small") 创建了三列，每列的宽度比例为 1:1:1，即三列宽度相等。gap="small" 设置了列之间的间距为小间距。
-    # 返回的 col_empty, col_center, col_empty 分别代表这三列，其中 col_center 是中间的一列，通常用于放置主要内容，而 col_empty 用于在两侧留白。
-    col_empty, col_center, col_empty = st.columns([1, 1, 1], gap="small")
-    if st.session_state.logged_in:
-        if st.session_state.page == "change_password_page":
-            change_password_page = load_page("change_password_page")
-            with col_center:
-                change_password_page()
-        elif st.session_state.page == "group_page":
-            group_page = load_page("group_page")
-            group_page()
-        elif st.session_state.page == "main_page":
-            main_page = load_page("main_page")
-            main_page()
-        else:
-            st.session_state.page = "group_page"
-            group_page = load_page("group_page")
-            group_page()
+    # 页面运行期间的保存请求合并到运行结束时一次写入；st.rerun、st.stop 通过异常中断运行，在 finally 中写入
+    if bot_manager:
+        bot_manager.begin_unit_of_work()
+    try:
+        # st.columns([1, 1, 1], gap="small") 创建了三列，每列的宽度比例为 1:1:1，即三列宽度相等。gap="small" 设置了列之间的间距为小间距。
+        # 返回的 col_empty, col_center, col_empty 分别代表这三列，其中 col_center 是中间的一列，通常用于放置主要内容，而 col_empty 用于在两侧留白。
+        col_empty, col_center, col_empty = st.columns([1, 1, 1], gap="small")
+        if st.session_state.logged_in:
+            if st.session_state.page == "change_password_page":
+                change_password_page = load_page("change_password_page")
+                with col_center:
+                    change_password_page()
+            elif st.session_state.page == "group_page":
+                group_page = load_page("group_page")
+                group_page()
+            elif st.session_state.page == "main_page":
+                main_page = load_page("main_page")
+                main_page()
+            else:
+                st.session_state.page = "group_page"
+                group_page = load_page("group_page")
+                group_page()
         
-        # 更新最后访问的页面信息
-        bot_manager.set_last_visited_page(st.session_state.page)
+            # 更新最后访问的页面信息
+            bot_manager.set_last_visited_page(st.session_state.page)
 
-    # 如果用户未登录（st.session_state.logged_in为False），则检查会话状态中的page变量; 如果page是register_page，则加载注册页面。否则，默认加载登录页面
-    else:
-        if st.session_state.page == "register_page":
-            register_page = load_page("register_page")
-            with col_center:
-                register_page()
+        # 如果用户未登录（st.session_state.logged_in为False），则检查会话状态中的page变量; 如果page是register_page，则加载注册页面。否则，默认加载登录页面
         else:
-            st.session_state.page = "login_page"
-            login_page = load_page("login_page")
-            with col_center:
-                login_page()
+            if st.session_state.page == "register_page":
+                register_page = load_page("register_page")
+                with col_center:
+                    register_page()
+            else:
+                st.session_state.page = "login_page"
+                login_page = load_page("login_page")
+                with col_center:
+                    login_page()
+
+        # 页脚: 底部版权信息
+        st.markdown("""
+                        <p style="text-align: center; color: gray; padding-top:5rem">
+                            <a href="https://gitee.com/gptzm/multibot-chat" style="color: gray;">MultiBot-Chat by zm</a>
+                        </p>
+                    """, unsafe_allow_html=True)
 
-    # 页脚: 底部版权信息
-    st.markdown("""
-                    <p style="text-align: center; color: gray; padding-top:5rem">
-                        <a href="https://gitee.com/gptzm/multibot-chat" style="color: gray;">MultiBot-Chat by zm</a>
-                    </p>
-                """, unsafe_allow_html=True)
+        # 保存会话状态: 如果用户已登录并且 bot_manager 存在，更新聊天配置并将数据保存到文件。
+        if st.session_state.logged_in and bot_manager:
+            bot_manager.update_chat_config(st.session_state.chat_config)
+            bot_manager.save_data_to_file()
+    finally:
+        if bot_manager:
+            bot_manager.end_unit_of_work()
 
-    # 保存会话状态: 如果用户已登录并且 bot_manager 存在，更新聊天配置并将数据保存到文件。
-    if st.session_state.logged_in and bot_manager:
-        bot_manager.update_chat_config(st.session_state.chat_config)
-        bot_manager.save_data_to_file()
+        # 连接预热: 页面渲染完之后再加载预热模块（openai、httpx 等依赖较重），不拖慢首屏
+        # 进程启动后只预热一次规划引擎的连接和本地模型；每个会话登录后预热一次用户各Bot的连接，之后的重跑不再预热
+        # 放在 finally 中：登录成功后以 st.rerun 结束的运行也会执行；预热出错只记录日志，不掩盖页面本身的异常
+        try:
+            from bot.warmup import warmer
+            warmer.warm_up_on_start()
+            if st.session_state.logged_in and bot_manager and st.session_state.get('warmed_up_username') != st.session_state.username:
+                st.session_state.warmed_up_username = st.session_state.username
+                warmer.warm_up_bots(bot_manager.bots)
+        except Exception as e:
+            LOGGER.warning(f"连接预热出错: {str(e)}")
@@ -0,0 +1,108 @@
+# *-* coding:utf-8 *-*
+import logging
+import random
+
+from bot.config import ENGINE_ADAPTERS
+from bot.metrics import metrics_recorder
+from bot.rate_limiter import get_rate_limiter
+from bot.resilience import get_circuit_breaker
+from config import AUTO_ROUTE_EWMA_ALPHA, AUTO_ROUTE_WINDOW, AUTO_ROUTE_MIN_SAMPLES, AUTO_ROUTE_EXPLORE_RATE
+
+LOGGER = logging.getLogger(__name__)
+
+# 错误率接近 1 时评分的上限，避免除以 0
+MIN_SUCCESS_RATE = 0.05
+# 自动路由时沿用自动路由Bot自身设置的字段，其余字段（引擎、模型、密钥、接口地址）取自被选中的Bot
+PERSONA_FIELDS = ('system_prompt', 'temperature', 'cache', 'function_calling')
+
+
+def get_backend_stats(bot):
+    """
+    从最近的调用指标中计算Bot的实时状态：
+    - latency: 首字延迟的指数加权平均（秒），非流式调用按总耗时计算
+    - error_rate: 失败率的指数加权平均
+    - queue_depth: 正在进行和排队等待限流配额的调用数
+    - samples: 参与计算的调用数
+
+    用户取消的调用、缓存命中和合并请求的等待方不反映服务端的状态，不计入。
+    """
+    records = [
+        r for r in metrics_recorder.get_recent(bot_id=bot['id'])
+        if not r.get('cancelled') and not r.get('cache_hit') and not r.get('shared')
+    ][-AUTO_ROUTE_WINDOW:]
+
+    latency = None
+    error_rate = 0.0
+    for record in records:
+        error_rate += AUTO_ROUTE_EWMA_ALPHA * ((1.0 if record.get('error') else 0.0) - error_rate)
+        if record.get('error'):
+            continue
+        sample = record.get('first_token_latency')
+        if sample is None:
+            sample = record.get('latency')
+        if sample is None:
+            continue
+        latency = sample if latency is None else latency + AUTO_ROUTE_EWMA_ALPHA * (sample - latency)
+
+    adapter_config = ENGINE_ADAPTERS.get(bot.get('engine', ''), {})
+    api_key = bot.get(adapter_config.get('api_key_field', 'api_key'), '')
+    queue_depth = metrics_recorder.get_in_flight(bot['id']) + get_rate_limiter(bot.get('engine', ''), api_key).queue_depth()
+    return {'latency': latency, 'error_rate': error_rate, 'queue_depth': queue_depth, 'samples': len(records)}
+
+
+def is_available(bot):
+    """
+    Bot所在的接口正在熔断时不参与选择。
+    """
+    adapter_config = ENGINE_ADAPTERS.get(bot.get('engine', ''), {})
+    base_url = adapter_config.get('base_url') or bot.get(adapter_config.get('base_url_field', ''), '')
+    return not get_circuit_breaker(bot.get('engine', ''), base_url).is_open()
+
+
+def score_backend(stats):
+    """
+    评分越低越优先：延迟按排队深度放大，再按成功率折算。
+    """
+    return (stats['latency'] or 0) * (1 + stats['queue_depth']) / max(MIN_SUCCESS_RATE, 1 - stats['error_rate'])
+
+
+def select_backend(bot, pool_bots):
+    """
+    从自动路由Bot自身和它的等价Bot池中选出本次调用使用的Bot。
+
+    - 正在熔断的Bot跳过，全部熔断时仍在全部候选中选择
+    - 样本不足的Bot优先，样本最少的先选，用于积累统计数据
+    - 以 AUTO_ROUTE_EXPLORE_RATE 的概率随机选择，其余按 score_backend 选评分最低的
+    """
+    candidates = [bot] + [b for b in pool_bots if b and b['id'] != bot['id']]
+    available = [b for b in candidates if is_available(b)] or candidates
+    if len(available) == 1:
+        return available[0]
+
+    stats = {b['id']: get_backend_stats(b) for b in available}
+    unexplored = [b for b in available if stats[b['id']]['samples'] < AUTO_ROUTE_MIN_SAMPLES or stats[b['id']]['latency'] is None]
+    if unexplored:
+        chosen = min(unexplored, key=lambda b: (stats[b['id']]['samples'], stats[b['id']]['queue_depth']))
+        reason = '样本不足'
+    elif random.random() < AUTO_ROUTE_EXPLORE_RATE:
+        chosen = random.choice(available)
+        reason = '随机探测'
+    else:
+        chosen = min(available, key=lambda b: score_backend(stats[b['id']]))
+        reason = '评分最低'
+    LOGGER.info(f"[AutoRoute] {bot['name']} 选择 {chosen['name']}（{reason}）: "
+                + ', '.join(f"{b['name']} 延迟={stats[b['id']]['latency']} 错误率={stats[b['id']]['error_rate']:.2f} 排队={stats[b['id']]['queue_depth']}" for b in available))
+    return chosen
+
+
+def make_backend_config(bot, backend):
+    """
+    生成实际请求使用的Bot配置：连接相关的字段取自被选中的Bot，人设相关的字段沿用自动路由Bot。
+    """
+    if backend['id'] == bot['id']:
+        return bot
+    config = dict(backend)
+    for field in PERSONA_FIELDS:
+        if field in bot:
+            config[field] = bot[field]
+    return config
@@ -1,12 +1,15 @@
 import streamlit as st
+import hashlib
 import json
-import os
-from utils.crypto_utils import encrypt_data, decrypt_data
+import threading
+from collections import OrderedDict
+from bot.session_storage import (get_session_storage, apply_log_record, VERSION_KINDS, INDEX_FIELDS, topic_key,
+                                 is_topic_loaded, topic_message_count, topic_bot_ids, update_topic_index)
 import logging
 from datetime import datetime
 import uuid
 from bot.config import ENGINE_CONFIG
-from config import USER_CONFIG_BASEDIR
+from config import SESSION_CACHE_SIZE
 
 LOGGER = logging.getLogger(__name__)
     
@@ -16,6 +19,24 @@ class BotSessionManager:
         LOGGER.info(f"初始化 BotSessionManager，用户名: {username}")
         if not username:
             raise ValueError("用户名未设置")
+        self.storage = get_session_storage(username)
+        # 工作单元：页面运行期间的保存请求只标记数据已修改，新消息先缓存，运行结束时统一写入一次
+        # 每个浏览器会话有自己的实例（见 SessionManagerCache），只共用存储；按嵌套层数记录，
+        # 页面重跑时上一次运行的 finally 与新的运行可能交错，所有运行都结束后才退出工作单元
+        # 待写入的记录、修改标记和已加载的话题消息都在 _flush_lock 中修改
+        self._unit_depth = 0
+        self._flush_lock = threading.RLock()
+        self._loaded = False
+        # 上次读取或写入后存储中数据的版本，与存储当前的版本不同说明其他会话或进程修改过数据
+        self._loaded_version = None
+        self._dirty = False
+        self._pending_records = []
+        self._saved_digest = None
+        # 删除了消息时，摘要中的消息条数可能被之后追加的新消息抵消，必须重写快照
+        self._force_snapshot = False
+        # 保存统计：requested 保存请求数，written 实际写入存储的次数，
+        # merged 在工作单元中合并到运行结束时写入的请求数，unchanged 没有需要写入的内容的写入次数
+        self.save_stats = {'requested': 0, 'written': 0, 'merged': 0, 'unchanged': 0}
         
         # 设置所有值的默认值
         self.bots = []
@@ -30,6 +51,9 @@ class BotSessionManager:
             'group_history_length': 20,
             'force_system_prompt': '',
             'group_user_prompt': '',
+            'stream': True,
+            'trim_by_tokens': False,
+            'summarize_context': False,
         }
         self.last_visited_page = 'main_page'
 
@@ -39,20 +63,34 @@ class BotSessionManager:
         self.fix_history_names()
         self.fix_group_history_names()
 
-    def load_data_from_file(self):
+    @property
+    def username(self):
+        return self._filename
+
+    # 已经加载过并且存储中的数据在此之后没有被修改时跳过，不重新读取和解密；force 为 True 时总是重新读取
+    def load_data_from_file(self, force=False):
         if not self._filename:
             LOGGER.error("无法加载：用户名未设置")
             return
+        # 还没写入的修改先写入，避免被文件中的旧数据覆盖
+        if self._dirty or self._pending_records:
+            self.flush()
+        if self._loaded and not force and self.storage.state_version() == self._loaded_version:
+            return
+        # 重新读取时保留本会话当前选中的话题，不被其他会话保存的选择覆盖
+        selection = self._current_topic_keys() if self._loaded else None
         try:
-            file_path = f"{USER_CONFIG_BASEDIR}/{self._filename}.encrypt"
-            if not os.path.exists(file_path):
+            # 先取版本再读取：读取期间有其他写入时，下次检查会再读取一次，不会漏掉修改
+            version = self.storage.state_version()
+            data, records = self.storage.load()
+            if data is None:
                 LOGGER.info(f"欢迎新用户: {self._filename}")
-                return  # 使用默认值
+                # 使用默认值，还没有写入快照时仍然重放已追加的消息
+                data = {'history_versions': self.history_versions, 'group_history_versions': self.group_history_versions}
 
-            with open(file_path, 'r') as f:
-                encrypted_data = f.read()
-            decrypted_data = decrypt_data(encrypted_data)
-            data = json.loads(decrypted_data)
+            # 重放快照之后追加的新消息
+            for record in records:
+                apply_log_record(data, record)
             
             # 自动更新从文件读取到的参数
             for key, value in data.items():
@@ -66,16 +104,135 @@ class BotSessionManager:
             if 'last_visited_page' in data:
                 self.last_visited_page = data['last_visited_page']
 
+            if selection:
+                self._restore_topic_keys(selection)
+            # 恢复本会话的选择之后再计算摘要：只是恢复选择不需要重写快照
+            self._saved_digest = self._state_digest()
+            self._loaded = True
+            self._loaded_version = version
+
         except Exception as e:
             LOGGER.error(f"加载配置文件时出错：{str(e)}")
             # 出错时保留默认值
 
+    # 当前话题的 timestamp，话题的顺序变化后也能找回同一个话题
+    def _current_topic_keys(self):
+        keys = {}
+        for kind, index in (('private', self.current_history_version_idx), ('group', self.current_group_history_version_idx)):
+            versions = getattr(self, VERSION_KINDS[kind][0])
+            if 0 <= index < len(versions):
+                keys[kind] = versions[index].get('timestamp')
+        return keys
+
+    def _restore_topic_keys(self, keys):
+        for kind, attr in (('private', 'current_history_version_idx'), ('group', 'current_group_history_version_idx')):
+            versions = getattr(self, VERSION_KINDS[kind][0])
+            index = next((i for i, version in enumerate(versions) if keys.get(kind) and version.get('timestamp') == keys[kind]), None)
+            if index is not None:
+                setattr(self, attr, index)
+
+    # 请求保存：在工作单元中只标记数据已修改，运行结束时由 flush 统一写入；不在工作单元中时立即写入
     def save_data_to_file(self):
-        self.ensure_valid_history_version()
-        self.ensure_valid_group_history_version()
-        if not self._filename:
-            return
-        
+        with self._flush_lock:
+            self.save_stats['requested'] += 1
+            self._dirty = True
+            if self._unit_depth:
+                self.save_stats['merged'] += 1
+                return
+        self.flush()
+
+    # 页面运行开始时调用，之后的保存请求合并到运行结束时的 end_unit_of_work 中一次写入
+    def begin_unit_of_work(self):
+        with self._flush_lock:
+            self._unit_depth += 1
+
+    # 页面运行结束时调用（包括 st.rerun、st.stop 中断运行时），写入本次运行的全部修改
+    def end_unit_of_work(self):
+        try:
+            self.flush()
+        finally:
+            with self._flush_lock:
+                self._unit_depth = max(0, self._unit_depth - 1)
+        stats = self.get_save_stats()
+        LOGGER.info(f"[BotSessionManager] 保存请求 {stats['requested']} 次，实际写入 {stats['written']} 次，"
+                    f"跳过 {stats['skipped']} 次（合并到运行结束时写入 {stats['merged']} 次，没有修改 {stats['unchanged']} 次）")
+
+    # 显式提交：立即写入目前为止的修改，工作单元继续有效
+    def commit(self):
+        self.flush()
+
+    # skipped 为没有单独写入的保存请求数，包括合并写入的请求和没有修改的请求
+    def get_save_stats(self):
+        stats = dict(self.save_stats)
+        stats['skipped'] = max(0, stats['requested'] - stats['written'])
+        return stats
+
+    @staticmethod
+    def _topic_meta(kind, version):
+        return {key: value for key, value in version.items() if key != VERSION_KINDS[kind][1] and key not in INDEX_FIELDS}
+
+    # 快照中除消息以外部分的摘要：新消息已经追加写入，不需要为此重写快照；删除消息时由 _force_snapshot 强制重写
+    # 与上次写入时的摘要相同说明没有需要写入快照的修改，跳过写入
+    def _state_digest(self):
+        data = self._build_snapshot_data(with_messages=False)
+        return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def flush(self):
+        with self._flush_lock:
+            self._dirty = False
+            if not self._filename:
+                return
+            records, self._pending_records = self._pending_records, []
+            force_snapshot, self._force_snapshot = self._force_snapshot, False
+            if records:
+                self._track_write(self.storage.append(records))
+            # 增量日志达到上限，或者需要把旧格式的数据拆分成按话题保存时，重写快照
+            force_snapshot = force_snapshot or self.storage.needs_compaction()
+            self.ensure_valid_history_version()
+            self.ensure_valid_group_history_version()
+            digest = self._state_digest()
+            written = bool(records)
+            if force_snapshot or digest != self._saved_digest:
+                self._track_write(self.storage.save_snapshot(self._build_snapshot_data()))
+                self._saved_digest = digest
+                written = True
+            # 追加了新消息或重写了快照都算一次写入
+            self.save_stats['written' if written else 'unchanged'] += 1
+
+            # 修改都已写入，不是当前话题的消息可以从内存中释放，需要时重新读取
+            self._unload_topics()
+
+    # 写入前的版本与上次读取或写入后的版本相同时，内存中的数据仍是最新的；
+    # 否则其他会话或进程在此期间也写入过，标记为过期，下次 load_data_from_file 时重新读取
+    def _track_write(self, versions):
+        previous, current = versions
+        self._loaded_version = current if previous == self._loaded_version else None
+
+    # 话题的消息按需加载：话题索引（名称、时间、消息数、参与的Bot）常驻内存，用到话题的消息时才从存储读取
+    def _load_topic(self, kind, index):
+        with self._flush_lock:
+            versions = getattr(self, VERSION_KINDS[kind][0])
+            if not 0 <= index < len(versions):
+                return None
+            version = versions[index]
+            if not is_topic_loaded(kind, version):
+                messages = self.storage.load_topic(kind, topic_key(version, index))
+                if kind == 'private':
+                    # 以索引中的Bot为准：已删除的Bot的消息不再加载，还没有消息的Bot保留空列表
+                    messages = {bot_id: messages.get(bot_id, []) for bot_id in version.get('message_counts', {})}
+                version[VERSION_KINDS[kind][1]] = messages
+            return version
+
+    def _unload_topics(self):
+        with self._flush_lock:
+            current = {'private': self.current_history_version_idx, 'group': self.current_group_history_version_idx}
+            for kind, (versions_key, messages_key) in VERSION_KINDS.items():
+                for index, version in enumerate(getattr(self, versions_key)):
+                    if index != current[kind] and messages_key in version:
+                        update_topic_index(kind, version)
+                        del version[messages_key]
+
+    def _build_snapshot_data(self, with_messages=True):
         # 创建一个不包含历史记录的 bots 副本
         bots_without_history = []
         for bot in self.bots:
@@ -84,10 +241,18 @@ class BotSessionManager:
             bot_copy.pop('group_history', None)
             bots_without_history.append(bot_copy)
         
-        data = {
+        history_versions = self.history_versions
+        group_history_versions = self.group_history_versions
+        if not with_messages:
+            history_versions = [
+                dict(self._topic_meta('private', version), histories=sorted(topic_bot_ids('private', version)))
+                for version in history_versions
+            ]
+            group_history_versions = [self._topic_meta('group', version) for version in group_history_versions]
+        return {
             'bots': bots_without_history,
-            'history_versions': self.history_versions,
-            'group_history_versions': self.group_history_versions,
+            'history_versions': history_versions,
+            'group_history_versions': group_history_versions,
             'current_history_version_idx': self.current_history_version_idx,
             'current_group_history_version_idx': self.current_group_history_version_idx,
             'bot_id_map': self.bot_id_map,
@@ -95,9 +260,26 @@ class BotSessionManager:
             'auto_speak': self.auto_speak,
             'last_visited_page': self.last_visited_page
         }
-        encrypted_data = encrypt_data(json.dumps(data))
-        with open(f"{USER_CONFIG_BASEDIR}/{self._filename}.encrypt", 'w') as f:
-            f.write(encrypted_data)
+
+    # 新消息只追加写入（加密文件存储追加到增量日志，SQLite 存储插入新行），增量日志达到上限时重写一次完整快照
+    # 记录中保存话题的 timestamp 用于定位话题，话题的顺序变化后也能找到正确的位置
+    # 在工作单元中先缓存，运行结束时与其他修改一起写入
+    def _append_to_log(self, records):
+        if not self._filename or not records:
+            return
+        with self._flush_lock:
+            self.save_stats['requested'] += 1
+            self._pending_records.extend(records)
+            if self._unit_depth:
+                self.save_stats['merged'] += 1
+                return
+        self.flush()
+
+    def _message_record(self, index, bot_id, message):
+        return {'op': 'message', 'version': self.history_versions[index].get('timestamp'), 'index': index, 'bot_id': bot_id, 'message': message}
+
+    def _group_message_record(self, index, message):
+        return {'op': 'group_message', 'version': self.group_history_versions[index].get('timestamp'), 'index': index, 'message': message}
     
     def ensure_valid_history_version(self):
         if not self.history_versions:
@@ -116,13 +298,13 @@ class BotSessionManager:
     def remove_empty_new_history_version(self):
         self.history_versions = [
             version for version in self.history_versions
-            if not (version['name'] == '新话题' and all(len(h) == 0 for h in version['histories'].values()))
+            if not (version['name'] == '新话题' and topic_message_count('private', version) == 0)
         ]
 
     def remove_empty_new_group_history_version(self):
         self.group_history_versions = [
             version for version in self.group_history_versions
-            if not (version['name'] == '新群聊话题' and len(version['group_history']) == 0)
+            if not (version['name'] == '新群聊话题' and topic_message_count('group', version) == 0)
         ]
     
     def fix_history_names(self, specific_index=None):
@@ -132,7 +314,8 @@ class BotSessionManager:
                 idx = specific_index
             
             if 'name' not in version or version['name'] == '新话题':
-                first_prompt = self.get_first_prompt(version['histories'])
+                # 没有消息的话题不需要读取消息
+                first_prompt = self.get_first_prompt(self._load_topic('private', idx)['histories']) if topic_message_count('private', version) else None
                 if first_prompt:
                     content = first_prompt.replace('\n', ' ').replace('\r', '')
                     if len(content) > 20:
@@ -148,7 +331,7 @@ class BotSessionManager:
                 idx = specific_index
             
             if 'name' not in version or version['name'] == '新群聊话题':
-                first_prompt = self.get_first_group_prompt(version['group_history'])
+                first_prompt = self.get_first_group_prompt(self._load_topic('group', idx)['group_history']) if topic_message_count('group', version) else None
                 if first_prompt:
                     content = first_prompt.replace('\n', ' ').replace('\r', '')
                     if len(content) > 20:
@@ -201,7 +384,10 @@ class BotSessionManager:
         self.bots.append(bot)
         self.bot_id_map[bot['name']] = bot_id
         for version in self.history_versions:
-            version['histories'][bot_id] = []
+            if is_topic_loaded('private', version):
+                version['histories'][bot_id] = []
+            else:
+                version.setdefault('message_counts', {})[bot_id] = 0
         self.fix_bot_setting()
         self.save_data_to_file()
 
@@ -253,7 +439,8 @@ class BotSessionManager:
         bot_id = bot['id']
         self.bots = [b for b in self.bots if b['id'] != bot_id]
         for version in self.history_versions:
-            version['histories'].pop(bot_id, None)
+            version.get('histories', {}).pop(bot_id, None)
+            version.get('message_counts', {}).pop(bot_id, None)
         self.bot_id_map.pop(bot['name'], None)
         self.fix_bot_setting()
         self.save_data_to_file()
@@ -298,19 +485,17 @@ class BotSessionManager:
 
     def is_current_history_empty(self):
         if self.current_history_version_idx < len(self.history_versions):
-            current_history = self.history_versions[self.current_history_version_idx]['histories']
-            return all(len(history) == 0 for history in current_history.values())
+            return topic_message_count('private', self.history_versions[self.current_history_version_idx]) == 0
         return True
 
     def is_current_group_history_empty(self):
         if self.current_group_history_version_idx < len(self.group_history_versions):
-            current_group_history = self.group_history_versions[self.current_group_history_version_idx]['group_history']
-            return len(current_group_history) == 0
+            return topic_message_count('group', self.group_history_versions[self.current_group_history_version_idx]) == 0
         return True
 
     def get_participating_bots(self, version_index):
         if 0 <= version_index < len(self.history_versions):
-            return set(self.history_versions[version_index]['histories'].keys())
+            return set(topic_bot_ids('private', self.history_versions[version_index]))
         return set()
 
     def add_message_to_history(self, bot_id, message):
@@ -318,9 +503,21 @@ class BotSessionManager:
             return
         
         if bot_id and self.current_history_version_idx < len(self.history_versions):
-            current_version = self.history_versions[self.current_history_version_idx]
+            current_version = self._load_topic('private', self.current_history_version_idx)
             current_version['histories'].setdefault(bot_id, []).append(message)
-        self.save_data_to_file()
+            self._append_to_log([self._message_record(self.current_history_version_idx, bot_id, message)])
+
+    # 批量添加多个Bot的消息，全部添加完后一次写入增量日志
+    # messages 是 (bot_id, message) 元组的列表
+    def add_messages_to_history(self, messages):
+        if self.current_history_version_idx < len(self.history_versions):
+            current_version = self._load_topic('private', self.current_history_version_idx)
+            records = []
+            for bot_id, message in messages:
+                if bot_id and message:
+                    current_version['histories'].setdefault(bot_id, []).append(message)
+                    records.append(self._message_record(self.current_history_version_idx, bot_id, message))
+            self._append_to_log(records)
 
     def get_default_bot(self, engine):
         if 'default_bots' not in st.session_state:
@@ -332,6 +529,8 @@ class BotSessionManager:
                 'system_prompt': '用中文回答问题',
                 'temperature': 1.0, 
                 'enable': True,
+                'cache': False,
+                'function_calling': False,
             }
             
             # 使用 ENGINE_CONFIG 中的默认值
@@ -363,10 +562,17 @@ class BotSessionManager:
         self.save_data_to_file()
         return bot_copy
 
+    # 返回Bot在各个话题中的消息数，不读取消息；需要消息时用 get_history_by_bot 读取单个话题
     def get_all_histories(self, bot):
         bot_id = bot['id']
-        return [{'name': version['name'], 'timestamp': version['timestamp'], 'history': version['histories'].get(bot_id, [])} 
-                for version in self.history_versions]
+        return [{'index': index, 'name': version['name'], 'timestamp': version['timestamp'],
+                 'message_count': len(version['histories'].get(bot_id, [])) if is_topic_loaded('private', version)
+                 else version.get('message_counts', {}).get(bot_id, 0)}
+                for index, version in enumerate(self.history_versions)]
+
+    def get_history_by_bot(self, bot, version_index):
+        version = self._load_topic('private', version_index)
+        return version['histories'].get(bot['id'], []) if version else []
 
     def clear_all_histories(self):
         self.history_versions = [{'timestamp': datetime.now().isoformat(), 'histories': {}, 'name': '新话题'}]
@@ -389,11 +595,12 @@ class BotSessionManager:
     def get_current_history_by_bot(self, bot):
         bot_id = bot['id']
         if bot_id and self.current_history_version_idx < len(self.history_versions):
-            current_version = self.history_versions[self.current_history_version_idx]
+            current_version = self._load_topic('private', self.current_history_version_idx)
             return current_version['histories'].get(bot_id, [])
         return []
 
-    def add_message_to_group_history(self, role, content, bot=None, tool=None):
+    # error 为 True 时表示这是一条调用失败的提示，只用于展示，不会作为上下文发送给大模型
+    def add_message_to_group_history(self, role, content, bot=None, tool=None, metrics=None, error=False):
         if not content:
             return
         
@@ -402,28 +609,53 @@ class BotSessionManager:
             "content": content,
             "timestamp": datetime.now().isoformat()
         }
+        if metrics:
+            message["metrics"] = metrics
+        if error:
+            message["error"] = True
         if bot:
             message["bot_id"] = bot["id"]
             message["bot_name"] = bot["name"]
         if tool:
             message["tool_name"] = tool["name"]
-        self.group_history_versions[self.current_group_history_version_idx]['group_history'].append(message)
+        self._load_topic('group', self.current_group_history_version_idx)['group_history'].append(message)
+        self._append_to_log([self._group_message_record(self.current_group_history_version_idx, message)])
+
+    # 上下文摘要保存在历史版本中：私聊按 bot_id 保存在 summaries 里，群聊保存在 summary 里
+    def get_context_summary(self, bot_id=None):
+        if bot_id:
+            if self.current_history_version_idx < len(self.history_versions):
+                return self.history_versions[self.current_history_version_idx].get('summaries', {}).get(bot_id)
+        elif self.current_group_history_version_idx < len(self.group_history_versions):
+            return self.group_history_versions[self.current_group_history_version_idx].get('summary')
+        return None
+
+    def set_context_summary(self, summary, bot_id=None):
+        if bot_id:
+            if self.current_history_version_idx < len(self.history_versions):
+                self.history_versions[self.current_history_version_idx].setdefault('summaries', {})[bot_id] = summary
+        elif self.current_group_history_version_idx < len(self.group_history_versions):
+            self.group_history_versions[self.current_group_history_version_idx]['summary'] = summary
         self.save_data_to_file()
 
     def get_current_group_history(self):
         if self.current_group_history_version_idx < len(self.group_history_versions):
-            current_version = self.group_history_versions[self.current_group_history_version_idx]
+            current_version = self._load_topic('group', self.current_group_history_version_idx)
             return current_version.get('group_history', [])
         return []
 
     def get_participating_bots_in_current_group_history(self):
         if self.current_group_history_version_idx < len(self.group_history_versions):
-            current_version = self.group_history_versions[self.current_group_history_version_idx]
+            current_version = self._load_topic('group', self.current_group_history_version_idx)
             bot_ids = set(message['bot_id'] for message in current_version['group_history'] if message['role'] == 'assistant' and 'bot_id' in message)
             return [bot for bot in self.bots if bot['id'] in bot_ids]
         return []
 
+    # 导出完整配置时读取所有话题的消息
     def get_bot_config(self):
+        for kind, (versions_key, _) in VERSION_KINDS.items():
+            for index in range(len(getattr(self, versions_key))):
+                self._load_topic(kind, index)
         return {
             'bots': self.bots,
             'history_versions': self.history_versions,
@@ -459,45 +691,48 @@ class BotSessionManager:
     def get_default_history_by_bot(self, bot):
         bot_id = bot['id']
         if bot_id and len(self.history_versions) > 0:
-            default_version = self.history_versions[0]
+            default_version = self._load_topic('private', 0)
             return default_version['histories'].get(bot_id, [])
         return []
 
     def get_default_group_history(self):
         if len(self.group_history_versions) > 0:
-            default_version = self.group_history_versions[0]
+            default_version = self._load_topic('group', 0)
             return default_version.get('group_history', [])
         return []
 
     def add_message_to_default_history(self, bot_id, message):
         if bot_id and len(self.history_versions) > 0:
-            default_version = self.history_versions[0]
+            default_version = self._load_topic('private', 0)
             default_version['histories'].setdefault(bot_id, []).append(message)
-        self.save_data_to_file()
+            self._append_to_log([self._message_record(0, bot_id, message)])
 
     def add_message_to_default_group_history(self, role, message, bot={}):
         if len(self.group_history_versions) > 0:
-            default_version = self.group_history_versions[0]
-            default_version['group_history'].append({
+            default_version = self._load_topic('group', 0)
+            group_message = {
                 'bot_id': bot.get('id',''),
                 'role': role,
                 'content': message
-            })
-        self.save_data_to_file()
+            }
+            default_version['group_history'].append(group_message)
+            self._append_to_log([self._group_message_record(0, group_message)])
 
     def remove_last_group_message(self):
         if self.current_group_history_version_idx < len(self.group_history_versions):
-            current_version = self.group_history_versions[self.current_group_history_version_idx]
+            current_version = self._load_topic('group', self.current_group_history_version_idx)
             if current_version['group_history']:
                 current_version['group_history'].pop()
+                self._force_snapshot = True
                 self.save_data_to_file()
 
     # 移除最后几条bot的回复，特点是role不是user
     def remove_recently_bot_group_message(self):
         if self.current_group_history_version_idx < len(self.group_history_versions):
-            current_version = self.group_history_versions[self.current_group_history_version_idx]
+            current_version = self._load_topic('group', self.current_group_history_version_idx)
             while len(current_version['group_history']) > 0 and current_version['group_history'][-1]['role'] != 'user':
                 current_version['group_history'].pop()
+                self._force_snapshot = True
                 self.save_data_to_file()
 
     def get_auto_speak(self):
@@ -518,4 +753,55 @@ class BotSessionManager:
         return next((bot for bot in self.bots if bot['id'] == bot_id), None)
     
     def get_bot_by_name(self, bot_name):
-        return next((bot for bot in self.bots if bot['name'] == bot_name), None)
\ No newline at end of file
+        return next((bot for bot in self.bots if bot['name'] == bot_name), None)
+
+
+# 定义会话管理器缓存类：按 (用户名, 浏览器会话ID) 在进程内缓存 BotSessionManager 实例
+# 页面每次重跑都要用到用户的会话管理器，存储中的数据没有变化时直接复用内存中的数据，不再读取和解密整个用户文件
+# 每个会话有自己的实例，当前话题等选择状态互不影响；同一用户的会话只共用存储（见 get_session_storage）
+# 与 st.session_state 相比，缓存的总数有上限（长时间不活动的会话被淘汰），并且可以在一个会话中作废同一用户所有会话的实例
+class SessionManagerCache:
+    def __init__(self, max_size=SESSION_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username, session_id=None):
+        """
+        返回用户在这个浏览器会话中的会话管理器。其他会话或进程修改过用户数据时重新加载，没有缓存时新建。
+        """
+        key = (username, session_id)
+        with self._lock:
+            manager = self._items.get(key)
+            if manager is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+        if manager is not None:
+            manager.load_data_from_file()
+            return manager
+
+        manager = BotSessionManager(username)
+        with self._lock:
+            self.misses += 1
+            # 同一会话并发创建时保留先放入缓存的实例
+            manager = self._items.setdefault(key, manager)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return manager
+
+    # 移除用户在某个会话中的会话管理器；不指定会话时移除用户在所有会话中的会话管理器，它们下次运行时重新加载
+    def invalidate(self, username, session_id=None):
+        with self._lock:
+            for key in [key for key in self._items if key[0] == username and (session_id is None or key[1] == session_id)]:
+                self._items.pop(key)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+# 创建全局会话管理器缓存实例
+session_manager_cache = SessionManagerCache()
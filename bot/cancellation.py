@@ -0,0 +1,107 @@
+# *-* coding:utf-8 *-*
+import logging
+import threading
+import weakref
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CallCancelledError(Exception):
+    """
+    调用被取消（页面重跑、退出登录或点击了停止生成）。
+    """
+
+    def __init__(self, message="已停止生成"):
+        super().__init__(message)
+
+
+class CancelToken:
+    """
+    一次大模型调用的取消标记。
+
+    调用过程中打开的HTTP流通过 track 登记，取消时立即关闭它们，
+    阻塞在读取上的线程会马上收到异常退出，而不是等到生成结束。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._resources = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def track(self, resource):
+        """
+        登记一个有 close 方法的对象（requests 的 Response、OpenAI 的 Stream 等），返回该对象。
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._resources.append(resource)
+                return resource
+        # 已经取消时直接关闭
+        self._close(resource)
+        return resource
+
+    def untrack(self, resource):
+        with self._lock:
+            if resource in self._resources:
+                self._resources.remove(resource)
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            resources, self._resources = self._resources, []
+        for resource in resources:
+            self._close(resource)
+
+    def _close(self, resource):
+        try:
+            resource.close()
+        except Exception as e:
+            LOGGER.debug(f"[Cancel] 关闭连接出错: {str(e)}")
+
+    def wait(self, timeout):
+        """
+        等待 timeout 秒，期间被取消时提前返回 True。
+        """
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise CallCancelledError()
+
+
+class CancelRegistry:
+    """
+    按 Streamlit 会话登记进行中的调用。页面重跑、退出登录或点击停止生成时，取消该会话所有未结束的调用。
+    使用弱引用保存，调用结束、ChatRouter 被回收后自动移除。
+    """
+
+    def __init__(self):
+        self._tokens = {}       # session_id -> WeakSet[CancelToken]
+        self._lock = threading.Lock()
+
+    def new_token(self, session_id):
+        token = CancelToken()
+        if session_id:
+            with self._lock:
+                self._tokens.setdefault(session_id, weakref.WeakSet()).add(token)
+        return token
+
+    def cancel_session(self, session_id):
+        with self._lock:
+            tokens = list(self._tokens.pop(session_id, []))
+        pending = [token for token in tokens if not token.cancelled]
+        for token in pending:
+            token.cancel()
+        if pending:
+            LOGGER.info(f"[Cancel] 会话 {session_id} 取消了 {len(pending)} 个进行中的调用")
+        return len(pending)
+
+
+# 创建全局调用登记实例
+cancel_registry = CancelRegistry()
@@ -1,22 +1,49 @@
 # *-* coding:utf-8 *-*
-import requests
+import asyncio
 import json
 import logging
 import random
-from openai import OpenAI
-import streamlit as st
+import threading
+import time
+from datetime import datetime
+import httpx
+from bot.cancellation import CallCancelledError, CancelToken
+from bot.client_pool import client_pool, hash_api_key
+from bot.resilience import UpstreamError, CircuitOpenError, get_circuit_breaker, call_with_retry, call_with_retry_async, classify_error, parse_retry_after, RetryPolicy
+from bot.response_cache import response_cache, make_cache_key
+from bot.metrics import metrics_recorder
+from bot.single_flight import single_flight, make_flight_key
+from bot.rate_limiter import RateLimitTimeout, get_rate_limiter
+from utils.token_utils import estimate_messages_tokens, estimate_text_tokens, get_context_budget, trim_messages_to_budget
+from utils.summary_utils import summarize_history
+from bot.function_calling import build_tool_schemas, build_tool_history, run_tool_calls
+from utils.image_utils import ImageError, encode_image_for_engine
+from bot.config import ENGINE_ADAPTERS
+from config import LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT, FUNCTION_CALL_MAX_ROUNDS
 
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
 
+
+class ChatRouterError(Exception):
+    """
+    调用大模型失败（已按策略重试仍失败、熔断中或接口返回错误）。
+    调用方应当把它展示给用户，但不要当作Bot的回复存入上下文。
+    """
+
+
 # 定义一个通用的聊天路由组件
 class ChatRouter:
-    def __init__(self, bot_config, chat_config):
+    def __init__(self, bot_config, chat_config, username=None, context_summary=None, cancel_token=None, summary_source=None):
         """
         初始化路由器。
         
         参数:
             bot_config (dict): 机器人配置，包括engine, base_url, api_key, model等。
+            username (str): 发起请求的用户，共用同一个API Key的用户按用户名轮流使用限流配额。
+            context_summary (dict): 这段对话之前保存的摘要，上下文超出预算时用它代替较早的消息。
+            cancel_token (CancelToken): 取消标记，取消后立即关闭进行中的连接，不再重试并退还限流配额。
+            summary_source (ChatRouter): 对冲请求的主Bot。传入时复用它本次使用的摘要，不再调用基础模型生成摘要。
         """
         self.engine = bot_config.get('engine', '')
         self.api_endpoint = bot_config.get('api_endpoint', '')
@@ -29,11 +56,51 @@ class ChatRouter:
         else:
             self.system_prompt = bot_config.get('system_prompt', '')
         self.group_user_prompt = chat_config.get('group_user_prompt', '')
+        # 传给工具的群聊接力提示词，只在群聊调用时设置
+        self.tool_group_prompt = ''
         self.history_length = chat_config.get('history_length', 10)
         self.group_history_length = chat_config.get('group_history_length', 20)
+        # 按 token 预算裁剪上下文时不再按条数截取历史，而是保留预算内最新的消息
+        self.trim_by_tokens = chat_config.get('trim_by_tokens', False)
+        # 上下文超出预算时把较早的消息总结成摘要，只在按 token 预算裁剪时生效
+        self.summarize_context = self.trim_by_tokens and chat_config.get('summarize_context', False)
+        self.context_summary = context_summary
+        self.summary_updated = False
+        self.active_summary = None
+        self.summary_source = summary_source
+        # 本次调用的摘要已经确定（或者不会再生成）时设置，备用Bot等待它后复用摘要
+        self.summary_ready = threading.Event()
         self.bot_id = bot_config.get('id', '')
         self.user_id = bot_config.get('user_id', random.randint(1000000000,9999999999))
         self.temperature = bot_config.get('temperature', 1.0)
+
+        # 根据 ENGINE_ADAPTERS 解析本次请求使用的适配器、接口地址和密钥
+        self.adapter_config = ENGINE_ADAPTERS.get(self.engine, {})
+        self.adapter = self.adapter_config.get('adapter', '')
+        self.request_base_url = self.adapter_config.get('base_url') or bot_config.get(self.adapter_config.get('base_url_field', ''), '')
+        self.request_api_key = bot_config.get(self.adapter_config.get('api_key_field', 'api_key'), '')
+        self.request_timeout = self.adapter_config.get('timeout', LLM_READ_TIMEOUT)
+        self.context_budget = get_context_budget(self.engine, self.model or self.adapter_config.get('default_model'))
+        # 引擎不支持图片输入时为 None，消息中的图片不发送
+        self.image_profile = self.adapter_config.get('image')
+        self.last_usage = None
+        self.metrics = {}
+        self.retry_count = 0
+        self.queue_wait = 0
+        self.username = username
+        # temperature 为 0 的Bot回复是确定的，直接缓存；其他Bot需要在设置中开启缓存
+        self.cacheable = self.temperature == 0 or bool(bot_config.get('cache', False))
+        self.cache_hit = False
+        self.circuit_breaker = get_circuit_breaker(self.engine, self.request_base_url)
+        self.rate_limiter = get_rate_limiter(self.engine, self.request_api_key)
+        self.cancel_token = cancel_token or CancelToken()
+        # 上游请求（连接、重试、限流排队、工具调用）使用的取消标记。一般就是 cancel_token；
+        # 合并的流式请求由 single_flight 提供，调用方被取消后只要还有其他调用方在读取，上游请求就继续
+        self.call_token = self.cancel_token
+        # 本次调用可以通过 function calling 使用的工具，由 _set_tools 在每次调用开始时设置
+        self.tools = []
+        self.tool_schemas = []
+        self.tool_call_count = 0
     
     def send_message(self, prompt, history, input_type='text', image=None, tools=None):
         """
@@ -43,14 +110,17 @@ class ChatRouter:
             prompt (str): 用户输入的文本。
             history (list): 历史对话记录。
             input_type (str): 输入类型，'text' 或 'image'。
-            image (bytes): 如果input_type是'image'，则提供图片的字节数据。
+            image (bytes | str): 如果input_type是'image'，则提供图片的字节数据，或对话历史中保存的 data URL。
             tools (list): 可选的工具列表，用于增强模型能力。
         
         返回:
-            response_content (str 或生成器): 模型的回复内容或流式数据。
+            response_content (str): 模型的回复内容。
+
+        异常:
+            ChatRouterError: 重试后仍然失败时抛出。
         """
         
-        history = history[-self.history_length:]
+        history = self._slice_history(history, self.history_length)
         # 001 打印系统提示词
         # LOGGER.info(f"Sending message with system_prompt: {self.system_prompt}")
 
@@ -64,581 +134,812 @@ class ChatRouter:
             prompt (str): 用户输入的文本。
             group_history (list): 群聊历史记录。
             input_type (str): 输入类型，'text' 或 'image'。
-            image (bytes): 如果input_type是'image'，则提供图片的字节数据。
+            image (bytes | str): 如果input_type是'image'，则提供图片的字节数据，或对话历史中保存的 data URL。
             tools (list): 可选的工具列表，用于增强模型能力。
         
         返回:
-            response_content (str 或生成器): 模型的回复内容或流式数据。
+            response_content (str): 模型的回复内容。
+
+        异常:
+            ChatRouterError: 重试后仍然失败时抛出。
         """
 
-        group_history = group_history[-self.group_history_length:]
+        self.tool_group_prompt = self.group_user_prompt
+        group_history = self._slice_history(group_history, self.group_history_length)
         # 001
         # LOGGER.info(f"Sending message with system_prompt: {self.system_prompt}")
         
         return str(self._call_engine_chat(prompt, group_history, input_type=input_type, image=image, tools=tools))
-        
-    def _call_engine_chat(self, prompt, history, input_type='text', image=None, tools=None):
-        if self.engine == 'AzureOpenAI':
-            return self._azure_openai_chat(prompt, history)
-        elif self.engine == 'ChatGLM':
-            return self._chatglm_chat(prompt, history)
-        elif self.engine == 'CoZe':
-            return self._coze_chat(prompt, history)
-        elif self.engine == 'Qwen':
-            return self._qwen_chat(prompt, history)
-        elif self.engine == 'Ollama':
-            return self._ollama_chat(prompt, history)
-        elif self.engine == 'Qianfan':
-            return self._qianfan_chat(prompt, history)
-        elif self.engine == 'XingHuo':
-            return self._xinghuo_chat(prompt, history)
-        elif self.engine == 'DeepSeek':
-            return self._deepseek_chat(prompt, history)
-        elif self.engine == 'Moonshot':
-            return self._moonshot_chat(prompt, history)
-        elif self.engine == 'Yi':
-            return self._yi_chat(prompt, history)
-        elif self.engine == 'Groq':
-            return self._groq_chat(prompt, history)
-        elif self.engine == 'MiniMax':
-            return self._minimax_chat(prompt, history)
-        elif self.engine == 'Stepfun':
-            return self._stepfun_chat(prompt, history)
-        elif self.engine == '302AI':
-            return self._302ai_chat(prompt, history)
-        elif self.engine == 'siliconflow':
-            return self._siliconflow_chat(prompt, history)
-        elif self.engine == 'OpenAI':
-            return self._openai_chat(prompt, history)
-        else:
-            return "不支持的引擎。"
-
-    def _azure_openai_chat(self, prompt, history):
-        
-        try:
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-            # st.stop()
-            if not messages:
-                return
-            
-            headers = {
-                "Content-Type": "application/json",
-                "api-key": self.api_key,
-            }
-            data = {
-                "messages": messages,
-                "temperature": self.temperature,
-            }
-            
-            url = f"{self.api_endpoint}/openai/deployments/{self.model}/chat/completions?api-version=2024-02-01"
-            response = requests.post(url, headers=headers, data=json.dumps(data))
-
-            LOGGER.warning(f'  response.json():\n{response.json()}')
-            response_json = response.json()
-            if response_json.get('choices') and len(response_json['choices']) > 0:
-                LOGGER.info(f'  response:\n\n\n {response_json}')
-                if 'content' in response_json['choices'][0]['message']:
-                    return str(response_json['choices'][0]['message']['content'])
-                else:
-                    return [str(response_json['choices'][0]),str(response_json['error']['message'])]
-            else:
-                return f"[AzureOpenAI] Error: {response_json['error']['message']}"
-        except Exception as e:
-            return "[AzureOpenAI] API 调用出错: " + str(e)
-    
-    def _chatglm_chat(self, prompt, history):
-        try:
-            from zhipuai import ZhipuAI
-            client = ZhipuAI(api_key=self.api_key)
-        
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
 
-            if not messages:
-                return
-            
-            payload = {
-                "model": self.model or "glm-4",
-                "messages": messages,
-                "temperature": self.temperature,
-            }
-            
-            json_response = client.chat.completions.create(**payload)
-            
-            LOGGER.info(f'  response:\n\n\n {json_response}')
-            
-            if json_response.choices and len(json_response.choices) > 0:
-                return json_response.choices[0].message.content
-            else:
-                return f'[ChatGLM] Error:{json_response["error"]["message"]}'
-
-        except Exception as e:
-            LOGGER.error(f"[ChatGLM] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-        
-    def _coze_chat(self, prompt, history):
-        # 实现与CoZe的交互
-        
-        try:
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
+    def send_message_stream(self, prompt, history, input_type='text', image=None, tools=None):
+        """
+        以流式方式发送消息到指定的大模型，参数同 send_message。
 
-            if not messages:
-                return
-            
-            payload = {
-                "bot_id": str(self.bot_id),
-                "user": str(self.user_id),
-                "query": prompt,
-                "chat_history": messages,
-                "stream": False,
-            }
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-            }
-
-            LOGGER.info(f'  headers:\n\n\n {headers}')
-            LOGGER.info(f'  payload:\n\n\n {payload}')
-            
-            response = requests.post('https://api.coze.cn/open_api/v2/chat', json=payload, headers=headers)
-            json_response = response.json()
-            if json_response['msg'] != 'success':
-                return f"[COZE] Error: {json_response['msg']}"
-            answer = None
-            for message in json_response['messages']:
-                if message.get('type') == 'answer':
-                    answer = message.get('content')
-                    break
-            if not answer:
-                return "[COZE] Error: empty answer"
-            return answer
-        except Exception as e:
-            return "错误: " + str(e)
-    
-    # 通过OpenAI客户端与Qwen模型进行交互，发送用户的输入和对话历史，接收模型的响应，并返回模型的回复内容
-    def _qwen_chat(self, prompt, history):
-        # 001 实现与Qwen的交互
-        try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-            )
+        返回:
+            生成器: 逐段产出模型回复的增量文本。首字延迟和总耗时在生成结束后记录在 self.metrics 中。
+            失败时在迭代过程中抛出 ChatRouterError。
+        """
+        history = self._slice_history(history, self.history_length)
+        return self._call_engine_stream(prompt, history, input_type=input_type, image=image, tools=tools)
 
-            messages = self._join_messages(prompt, history)     # 调用 _join_messages 方法将 prompt 和 history 合并成适合API输入的格式
-            messages = self._fix_messages(messages)             # 调用 _fix_messages 方法对消息格式进行修正，确保它们符合API的要求
+    def send_message_group_stream(self, prompt, group_history, input_type='text', image=None, tools=None):
+        """
+        以流式方式发送群聊消息到指定的大模型，参数同 send_message_group。
 
-            if not messages:
-                return
+        返回:
+            生成器: 逐段产出模型回复的增量文本。
+        """
+        self.tool_group_prompt = self.group_user_prompt
+        group_history = self._slice_history(group_history, self.group_history_length)
+        return self._call_engine_stream(prompt, group_history, input_type=input_type, image=image, tools=tools)
 
-            # LOGGER.info(f'  qwen messages:\n\n\n {messages}')
-            # 使用 client.chat.completions.create 方法向Qwen模型发送请求，获取模型的响应
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,       # temperature 参数控制生成文本的随机性，值越低，生成的文本越确定
-            )
-            # 将一个 Pydantic 模型实例序列化为 JSON 字符串的方法。Pydantic 是一个数据验证和设置管理的库，它使用 Python 类型注解来验证数据
-            # LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
+    async def send_message_async(self, prompt, history, input_type='text', image=None, tools=None):
+        """
+        send_message 的 asyncio 版本，参数、返回值和异常相同。
+        兼容OpenAI接口的引擎使用 AsyncOpenAI，AzureOpenAI、CoZe、Qianfan 使用 httpx.AsyncClient，
+        同一个事件循环中可以同时挂起大量请求而不占用线程。
+        智谱清言没有异步SDK，与同步版本一样通过 zhipuai SDK 鉴权，在线程池中调用；工具调用在线程池中执行。
+        """
+        history = self._slice_history(history, self.history_length)
+        return str(await self._call_engine_chat_async(prompt, history, input_type=input_type, image=image, tools=tools))
 
-            # 检查API响应是否有可用的选项；如果有，返回第一个选项中的消息内容，如果没有，返回错误信息。
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[Qwen] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"[Qwen] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-    
-    def _qianfan_chat(self, prompt, history):
-        # 实现与Qianfan的交互
+    async def send_message_group_async(self, prompt, group_history, input_type='text', image=None, tools=None):
+        """
+        send_message_group 的 asyncio 版本，参数、返回值和异常相同。
+        """
+        self.tool_group_prompt = self.group_user_prompt
+        group_history = self._slice_history(group_history, self.group_history_length)
+        return str(await self._call_engine_chat_async(prompt, group_history, input_type=input_type, image=image, tools=tools))
+
+    # adapter 类型到处理方法的映射，分派时直接查表
+    # 处理方法的参数为 (prompt, messages)，失败时直接抛出异常，由 _call_engine_* 统一重试和熔断
+    ADAPTER_HANDLERS = {
+        'openai': '_openai_compatible_chat',
+        'azure': '_azure_openai_chat',
+        'chatglm': '_chatglm_chat',
+        'coze': '_coze_chat',
+        'qianfan': '_qianfan_chat',
+    }
+
+    # adapter 类型到流式处理方法的映射
+    ADAPTER_STREAM_HANDLERS = {
+        'openai': '_openai_compatible_stream',
+        'azure': '_azure_openai_stream',
+        'chatglm': '_chatglm_stream',
+        'coze': '_coze_stream',
+        'qianfan': '_qianfan_stream',
+    }
+
+    # adapter 类型到异步处理方法的映射
+    ADAPTER_ASYNC_HANDLERS = {
+        'openai': '_openai_compatible_chat_async',
+        'azure': '_azure_openai_chat_async',
+        'chatglm': '_chatglm_chat_async',
+        'coze': '_coze_chat_async',
+        'qianfan': '_qianfan_chat_async',
+    }
+
+    def _slice_history(self, history, history_length):
+        if self.trim_by_tokens:
+            return history
+        return history[-history_length:]
+
+    def _get_handler(self, handlers):
+        handler = handlers.get(self.adapter)
+        if not handler:
+            raise ChatRouterError("不支持的引擎。")
+        return getattr(self, handler)
+
+    def _apply_summary(self, prompt, history):
+        """
+        历史记录超出预算时用摘要代替较早的消息，新生成的摘要保存在 self.context_summary 中，由调用方写回历史版本。
+        """
+        if not self.summarize_context:
+            return history
+        if self.summary_source is not None:
+            return self._reuse_summary(history)
+        budget = self.context_budget - estimate_text_tokens(self.system_prompt) - estimate_text_tokens(prompt)
         try:
-            url = "https://qianfan.baidubce.com/v2/chat/completions"
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-            
-            payload = json.dumps({
-                "model": self.model,
-                "messages": messages,
-                "temperature": self.temperature,
-            })
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {self.api_key}',
-            }
-            
-            response = requests.request("POST", url, headers=headers, data=payload)
-            LOGGER.info(f'  response:\n\n\n {response.text}')
-
-            completion = json.loads(response.text)
-            
-            if 'choices' in completion and len(completion['choices']) > 0:
-                return completion['choices'][0]['message']['content']
-            else:
-                return f"[QianFan] Error:{completion['error']['message']}"
+            summary, history = summarize_history(history, self.context_summary, budget)
         except Exception as e:
-            LOGGER.error(f"[QianFan] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-    
-    def _xinghuo_chat(self, prompt, history):
-        # 实现与星火的交互
+            # 生成摘要失败时退回到直接裁剪
+            LOGGER.warning(f"[{self.engine}] 生成上下文摘要失败: {str(e)}")
+            return history
+        if summary is not self.context_summary and summary is not None:
+            self.context_summary = summary
+            self.summary_updated = True
+        self.active_summary = summary
+        return history
+
+    def _reuse_summary(self, history):
+        """
+        复用主Bot本次使用的摘要，同一个请求只生成一次摘要。主Bot没有使用摘要时返回完整的历史记录，由裁剪处理超出预算的部分。
+        """
+        while not self.summary_source.summary_ready.wait(0.5):
+            self.cancel_token.raise_if_cancelled()
+        summary = self.summary_source.active_summary
+        if summary is None:
+            return history
+        self.active_summary = summary
+        return history[summary['upto']:]
+
+    def _prepare_messages(self, prompt, history, image=None):
+        self.active_summary = None
         try:
-            client = OpenAI(
-                api_key=self.api_password, # 控制台获取的APIPassword
-                base_url="https://spark-api-open.xf-yun.com/v1",
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
+            history = self._apply_summary(prompt, history)
+        finally:
+            self.summary_ready.set()
+        messages = self._join_messages(prompt, history, image)     # 将 prompt 和 history 合并成适合API输入的格式
+        messages = self._fix_messages(messages)             # 对消息格式进行修正，确保它们符合API的要求
+        LOGGER.info(f'  messages:\n\n\n {self._redact_images(messages)}')
+        return messages
 
-            LOGGER.info(f'  messages:\n\n\n {messages}')
+    def _set_tools(self, tools):
+        """
+        只有接口支持 function calling 的引擎才会把工具发给模型，其他引擎忽略 tools。
+        """
+        if tools and self.adapter_config.get('function_calling'):
+            self.tools = tools
+            self.tool_schemas = build_tool_schemas(tools)
+        else:
+            self.tools = []
+            self.tool_schemas = []
+
+    def _cache_key(self, messages):
+        # 调用了工具的回复依赖工具的实时结果（如搜索），不缓存
+        if not self.cacheable or self.tool_schemas:
+            return None
+        model = self.model or self.adapter_config.get('default_model') or self.bot_id
+        # 生成参数：temperature，以及 Coze 按 bot_id 区分的智能体
+        params = {'temperature': self.temperature, 'bot_id': self.bot_id if self.adapter == 'coze' else ''}
+        return make_cache_key(self.engine, self.request_base_url, model, params, self.system_prompt, messages)
+
+    def _flight_key(self, messages):
+        """
+        请求的全部要素（接口、密钥、模型、参数和消息）都相同时才会合并。
+        """
+        return make_flight_key(self.engine, self.request_base_url, hash_api_key(self.request_api_key), self.model,
+                               self.temperature, self.bot_id if self.adapter == 'coze' else '',
+                               [schema['function']['name'] for schema in self.tool_schemas], messages)
 
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-            
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
+    def _get_cached_response(self, cache_key):
+        """
+        缓存命中时记录指标并返回缓存的回复，未命中返回 None。
+        """
+        if not cache_key:
+            return None
+        content = response_cache.get(cache_key)
+        if content is not None:
+            LOGGER.info(f"[{self.engine}] 命中回复缓存")
+            self.cache_hit = True
+        return content
+
+    def _start_call(self):
+        self.call_token = self.cancel_token
+        self.last_usage = None
+        self.retry_count = 0
+        self.queue_wait = 0
+        self.cache_hit = False
+        self.tool_call_count = 0
+        return time.monotonic()
+
+    def _record_metrics(self, messages, content, start_time, first_token_latency, shared=False, error=None):
+        """
+        汇总本次调用的指标，保存在 self.metrics 中并写入全局的指标记录。
+        接口没有返回用量（部分流式接口、合并请求的等待方、缓存命中）时按估算值记录。
+        """
+        usage = self.last_usage if not shared and not self.cache_hit else None
+        latency = round(time.monotonic() - start_time, 3)
+        self.metrics = {
+            'timestamp': datetime.now().isoformat(),
+            'engine': self.engine,
+            'model': self.model or self.adapter_config.get('default_model', ''),
+            'bot_id': self.bot_id,
+            'queue_wait': round(self.queue_wait, 3),
+            'first_token_latency': first_token_latency if first_token_latency is not None else (None if error else latency),
+            'latency': latency,
+            'prompt_tokens': (usage or {}).get('prompt_tokens') or estimate_messages_tokens(messages),
+            'completion_tokens': (usage or {}).get('completion_tokens') or estimate_text_tokens(content),
+            'usage_estimated': not (usage and usage.get('completion_tokens')),
+            'retry_count': self.retry_count,
+            'cache_hit': self.cache_hit,
+            'shared': shared,
+            'tool_calls': self.tool_call_count,
+        }
+        if error:
+            self.metrics['error'] = error
+            # 用户取消的调用不代表Bot的可用性，路由和对冲请求统计时需要排除
+            self.metrics['cancelled'] = self.cancel_token.cancelled
+        metrics_recorder.record(self.metrics)
+
+    def _on_retry(self, attempt, error, delay):
+        self.retry_count = attempt
+        if getattr(error, 'status_code', None) == 429:
+            # 服务端已经限流，暂停发放配额，排队中的请求一起等待
+            self.rate_limiter.pause(delay)
+
+    def _acquire_rate_limit(self, messages):
+        """
+        按估算的 token 数排队取得限流配额，返回预扣的 token 数，调用结束后交给 _settle_rate_limit 修正。
+        """
+        estimated_tokens = estimate_messages_tokens(messages)
+        self.queue_wait += self.rate_limiter.acquire(self.username, estimated_tokens, cancel_token=self.call_token)
+        return estimated_tokens
+
+    def _settle_rate_limit(self, estimated_tokens):
+        if self.last_usage:
+            self.rate_limiter.settle(estimated_tokens, self.last_usage.get('total_tokens'))
+
+    def _to_router_error(self, error):
+        if isinstance(error, ChatRouterError):
+            return error
+        if isinstance(error, CallCancelledError) or self.cancel_token.cancelled:
+            return ChatRouterError(f"[{self.engine}] {str(CallCancelledError())}")
+        if isinstance(error, (CircuitOpenError, RateLimitTimeout)):
+            return ChatRouterError(f"[{self.engine}] {str(error)}")
+        LOGGER.error(f"[{self.engine}] API 调用出错: {str(error)}")
+        return ChatRouterError(f"[{self.engine}] API 调用出错: {str(error)}")
 
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[Xinghuo] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"[Xinghuo] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-        
-    def _deepseek_chat(self, prompt, history):
-        # 实现与DeepSeek的交互
+    def _call_engine_chat(self, prompt, history, input_type='text', image=None, tools=None):
+        handler = self._get_handler(self.ADAPTER_HANDLERS)
+        self._set_tools(tools)
+        messages = self._prepare_messages(prompt, history, image if input_type == 'image' else None)
+        if not messages:
+            return ''
+        start_time = self._start_call()
+        cache_key = self._cache_key(messages)
+        cached_response = self._get_cached_response(cache_key)
+        if cached_response is not None:
+            self._record_metrics(messages, cached_response, start_time, None)
+            return cached_response
+
+        def call():
+            estimated_tokens = self._acquire_rate_limit(messages)
+            try:
+                result = handler(prompt, messages)
+                self.cancel_token.raise_if_cancelled()
+            except Exception:
+                if self.cancel_token.cancelled:
+                    self.rate_limiter.release(estimated_tokens)
+                raise
+            self._settle_rate_limit(estimated_tokens)
+            return result
+
+        metrics_recorder.call_started(self.bot_id)
         try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.deepseek.com",
+            # 同时发出的相同请求只调用一次上游，其余调用方共享结果
+            result, leader = single_flight.do(
+                self._flight_key(messages),
+                lambda: call_with_retry(call, self.circuit_breaker, on_retry=self._on_retry, cancel_token=self.cancel_token),
+                cancel_token=self.cancel_token,
             )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[DeepSeek] Error:{completion.error.message}"
         except Exception as e:
-            LOGGER.error(f"[DeepSeek] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-        
-    def _moonshot_chat(self, prompt, history):
-        # 实现与Moonshot的交互
+            error = self._to_router_error(e)
+            self._record_metrics(messages, '', start_time, None, error=str(error))
+            raise error from e
+        finally:
+            metrics_recorder.call_finished(self.bot_id)
+        # 非流式调用拿到第一个字时整个回复已经返回，首字延迟即总耗时
+        self._record_metrics(messages, result, start_time, None, shared=not leader)
+        if cache_key and leader:
+            response_cache.set(cache_key, result)
+        return result
+
+    def _call_engine_stream(self, prompt, history, input_type='text', image=None, tools=None):
+        handler = self._get_handler(self.ADAPTER_STREAM_HANDLERS)
+        self._set_tools(tools)
+        messages = self._prepare_messages(prompt, history, image if input_type == 'image' else None)
+        if not messages:
+            return
+        start_time = self._start_call()
+        cache_key = self._cache_key(messages)
+        cached_response = self._get_cached_response(cache_key)
+        if cached_response is not None:
+            self._record_metrics(messages, cached_response, start_time, None)
+            yield cached_response
+            return
+
+        response_content = ''
+        first_token_latency = None
+        # 同时发出的相同请求只调用一次上游，其余调用方同步收到相同的增量
+        stream, leader = single_flight.stream(self._flight_key(messages), lambda token: self._stream_with_retry(handler, prompt, messages, token), cancel_token=self.cancel_token)
+        metrics_recorder.call_started(self.bot_id)
         try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.moonshot.cn/v1",
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[Moonshot] Error:{completion.error.message}"
+            for delta in stream:
+                if first_token_latency is None:
+                    first_token_latency = round(time.monotonic() - start_time, 3)
+                    LOGGER.info(f"[{self.engine}] 首字延迟: {first_token_latency}s")
+                response_content += delta
+                yield delta
         except Exception as e:
-            LOGGER.error(f"[Moonshot] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-        
-    def _yi_chat(self, prompt, history):
-        # 实现与Yi的交互
-        try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.lingyiwanwu.com/v1",
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
+            error = self._to_router_error(e)
+            self._record_metrics(messages, response_content, start_time, first_token_latency, shared=not leader, error=str(error))
+            raise error from e
+        finally:
+            stream.close()
+            metrics_recorder.call_finished(self.bot_id)
+        self._record_metrics(messages, response_content, start_time, first_token_latency, shared=not leader)
+        if cache_key and leader:
+            response_cache.set(cache_key, response_content)
+
+    def _stream_with_retry(self, handler, prompt, messages, call_token):
+        """
+        在熔断器保护下发起流式请求，只在还没有产出任何内容时重试，否则用户会看到重复的文本。
+        被取消或被关闭时不再重试，还没有产出内容的调用退还预扣的限流配额。
+        """
+        self.call_token = call_token
+        policy = RetryPolicy()
+        started = False
+        attempt = 0
+        while True:
+            self.call_token.raise_if_cancelled()
+            self.circuit_breaker.before_call()
+            estimated_tokens = None
+            # 没有得到结果就结束的调用在 finally 中释放：被取消、流被关闭（GeneratorExit）、
+            # Streamlit 中断运行（BaseException）时都不能让半开状态的试探请求一直占着
+            recorded = False
+            try:
+                estimated_tokens = self._acquire_rate_limit(messages)
+                for delta in handler(prompt, messages):
+                    if not delta:
+                        continue
+                    started = True
+                    yield delta
+                # 连接被关闭后流可能直接结束而不报错，不能把截断的回复当作成功
+                self.call_token.raise_if_cancelled()
+                self._settle_rate_limit(estimated_tokens)
+                recorded = True
+                self.circuit_breaker.record_success()
                 return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[Yi] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"[Yi] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-        
-    def _groq_chat(self, prompt, history):
-        # 实现与Groq的交互
+            except Exception as e:
+                if self.call_token.cancelled:
+                    # 取消时连接被主动关闭，产生的连接错误不计入熔断
+                    raise CallCancelledError() from e
+                recorded = True
+                self.circuit_breaker.record_error(e)
+                retryable, retry_after, _ = classify_error(e)
+                if started or not retryable or attempt >= policy.max_retries:
+                    raise
+                delay = policy.get_delay(attempt, retry_after)
+                attempt += 1
+                self._on_retry(attempt, e, delay)
+                LOGGER.warning(f"[Retry] {self.circuit_breaker.key} 第 {attempt} 次重试，等待 {delay:.1f}s，原因: {str(e)}")
+                self.call_token.wait(delay)
+            finally:
+                if not recorded:
+                    self.circuit_breaker.record_cancel()
+                    if estimated_tokens is not None:
+                        # 已经产出内容的按估算值结算，还没有产出的退还预扣的配额
+                        if started:
+                            self._settle_rate_limit(estimated_tokens)
+                        else:
+                            self.rate_limiter.release(estimated_tokens)
+
+    async def _call_engine_chat_async(self, prompt, history, input_type='text', image=None, tools=None):
+        handler = self._get_handler(self.ADAPTER_ASYNC_HANDLERS)
+        self._set_tools(tools)
+        # 生成摘要时会同步调用基础模型，放到线程池中执行
+        messages = await asyncio.to_thread(self._prepare_messages, prompt, history, image if input_type == 'image' else None)
+        if not messages:
+            return ''
+        start_time = self._start_call()
+        cache_key = self._cache_key(messages)
+        cached_response = self._get_cached_response(cache_key)
+        if cached_response is not None:
+            self._record_metrics(messages, cached_response, start_time, None)
+            return cached_response
+
+        async def call():
+            # 排队等待配额会阻塞线程，放到线程池中执行，不阻塞事件循环
+            estimated_tokens = await asyncio.to_thread(self._acquire_rate_limit, messages)
+            try:
+                result = await handler(prompt, messages)
+                self.cancel_token.raise_if_cancelled()
+            except BaseException:
+                # 被取消时（包括等待中的协程被取消）退还预扣的配额
+                if self.cancel_token.cancelled:
+                    self.rate_limiter.release(estimated_tokens)
+                raise
+            self._settle_rate_limit(estimated_tokens)
+            return result
+
+        metrics_recorder.call_started(self.bot_id)
         try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.groq.com/openai/v1",
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
+            result, leader = await single_flight.do_async(
+                self._flight_key(messages),
+                lambda: call_with_retry_async(call, self.circuit_breaker, on_retry=self._on_retry, cancel_token=self.cancel_token),
+                cancel_token=self.cancel_token,
             )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[Yi] Error:{completion.error.message}"
         except Exception as e:
-            LOGGER.error(f"Yi API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-        
-    def _minimax_chat(self, prompt, history):
-        # 实现与MiniMax的交互
+            error = self._to_router_error(e)
+            self._record_metrics(messages, '', start_time, None, error=str(error))
+            raise error from e
+        finally:
+            metrics_recorder.call_finished(self.bot_id)
+        self._record_metrics(messages, result, start_time, None, shared=not leader)
+        if cache_key and leader:
+            response_cache.set(cache_key, result)
+        return result
+
+    def _check_response(self, response):
+        """
+        检查直接发送的HTTP请求的状态码，出错时抛出 UpstreamError，requests 和 httpx 的响应都适用。
+        """
+        if response.status_code < 400:
+            return
         try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.minimax.chat/v1",
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
+            message = response.json().get('error', {}).get('message') or response.text
+        except Exception:
+            message = response.text
+        raise UpstreamError(response.status_code, message, retry_after=parse_retry_after(response.headers.get('Retry-After')))
 
-            if not messages:
+    def _iter_sse_data(self, response):
+        """
+        逐条解析 SSE 响应中的 data 字段，遇到 [DONE] 时结束。
+        """
+        response.encoding = 'utf-8'
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            yield data
+
+    # ---------- 兼容OpenAI接口的引擎 ----------
+
+    def _openai_compatible_payload(self, messages, allow_tools=True):
+        payload = {
+            "model": self.model or self.adapter_config.get('default_model'),
+            "messages": messages,
+            "temperature": self.temperature,       # temperature 参数控制生成文本的随机性，值越低，生成的文本越确定
+            "timeout": self.request_timeout,
+        }
+        if self.tool_schemas:
+            payload["tools"] = self.tool_schemas
+            # 达到最大轮数后要求模型直接回答，消息中已有工具结果，tools 参数仍需保留
+            if not allow_tools:
+                payload["tool_choice"] = "none"
+        return payload
+
+    def _add_usage(self, usage):
+        """
+        累加多轮请求（function calling）的用量。
+        """
+        if not usage:
+            return
+        if not self.last_usage:
+            self.last_usage = dict(usage)
+            return
+        for key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+            self.last_usage[key] = (self.last_usage.get(key) or 0) + (usage.get(key) or 0)
+
+    def _run_tool_round(self, messages, content, tool_calls):
+        """
+        执行模型返回的工具调用，返回需要追加到 messages 中的助手消息和工具结果。
+        工具和群聊中一样收到对话上下文，群聊时还会收到群聊接力提示词。
+        """
+        self.call_token.raise_if_cancelled()
+        self.tool_call_count += len(tool_calls)
+        LOGGER.info(f"[{self.engine}] 模型请求调用工具: {', '.join(call['function']['name'] for call in tool_calls)}")
+        assistant_message = {"role": "assistant", "content": content or '', "tool_calls": tool_calls}
+        results = run_tool_calls(tool_calls, self.tools, self.tool_group_prompt, build_tool_history(messages))
+        self.call_token.raise_if_cancelled()
+        return [assistant_message] + results
+
+    def _parse_openai_tool_calls(self, completion):
+        if not completion.choices:
+            return []
+        tool_calls = getattr(completion.choices[0].message, 'tool_calls', None) or []
+        return [{
+            "id": call.id or f"call_{index}",
+            "type": "function",
+            "function": {"name": call.function.name, "arguments": call.function.arguments or ''},
+        } for index, call in enumerate(tool_calls)]
+
+    def _parse_openai_completion(self, completion):
+        LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
+        self._add_usage(completion.usage.model_dump() if getattr(completion, 'usage', None) else None)
+
+        # 检查API响应是否有可用的选项；如果有，返回第一个选项中的消息内容，如果没有，抛出错误信息。
+        if completion.choices and len(completion.choices) > 0:
+            return completion.choices[0].message.content
+        else:
+            raise ChatRouterError(f"[{self.engine}] Error:{completion.error.message}")
+
+    def _openai_compatible_chat(self, prompt, messages):
+        # 所有兼容OpenAI接口的引擎共用这条请求路径，差异只在于 ENGINE_ADAPTERS 中的配置
+        client = client_pool.get_openai_client(self.engine, self.request_base_url, self.request_api_key)
+        # 模型请求调用工具时执行工具并带上结果再次请求，最多 FUNCTION_CALL_MAX_ROUNDS 轮
+        messages = list(messages)
+        for round_index in range(FUNCTION_CALL_MAX_ROUNDS + 1):
+            payload = self._openai_compatible_payload(messages, allow_tools=round_index < FUNCTION_CALL_MAX_ROUNDS)
+            completion = client.chat.completions.create(**payload)
+            tool_calls = self._parse_openai_tool_calls(completion) if self.tool_schemas else []
+            if not tool_calls:
+                return self._parse_openai_completion(completion)
+            self._add_usage(completion.usage.model_dump() if getattr(completion, 'usage', None) else None)
+            messages += self._run_tool_round(messages, completion.choices[0].message.content, tool_calls)
+
+    def _openai_compatible_stream(self, prompt, messages):
+        client = client_pool.get_openai_client(self.engine, self.request_base_url, self.request_api_key)
+        messages = list(messages)
+        for round_index in range(FUNCTION_CALL_MAX_ROUNDS + 1):
+            payload = self._openai_compatible_payload(messages, allow_tools=round_index < FUNCTION_CALL_MAX_ROUNDS)
+            stream = self.call_token.track(client.chat.completions.create(**payload, stream=True))
+            content = ''
+            tool_calls = {}
+            round_usage = None
+            try:
+                for chunk in stream:
+                    if getattr(chunk, 'usage', None):
+                        round_usage = chunk.usage.model_dump()
+                    if not chunk.choices or not chunk.choices[0].delta:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content += delta.content
+                        yield delta.content
+                    # 流式返回的工具调用按 index 分片，参数需要逐片拼接
+                    for call in getattr(delta, 'tool_calls', None) or []:
+                        index = call.index if call.index is not None else len(tool_calls)
+                        entry = tool_calls.setdefault(index, {"id": f"call_{index}", "type": "function", "function": {"name": '', "arguments": ''}})
+                        if call.id:
+                            entry['id'] = call.id
+                        if call.function and call.function.name:
+                            entry['function']['name'] = call.function.name
+                        if call.function and call.function.arguments:
+                            entry['function']['arguments'] += call.function.arguments
+            finally:
+                self.call_token.untrack(stream)
+                stream.close()
+            self._add_usage(round_usage)
+            if not tool_calls:
                 return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
+            if content:
+                # 调用工具前的说明和最终回答分段显示
+                yield '\n\n'
+            messages += self._run_tool_round(messages, content, [tool_calls[index] for index in sorted(tool_calls)])
+
+    async def _openai_compatible_chat_async(self, prompt, messages):
+        client = client_pool.get_async_openai_client(self.engine, self.request_base_url, self.request_api_key)
+        # 工具调用的轮次与同步版本相同，工具在线程池中执行，不阻塞事件循环
+        messages = list(messages)
+        for round_index in range(FUNCTION_CALL_MAX_ROUNDS + 1):
+            payload = self._openai_compatible_payload(messages, allow_tools=round_index < FUNCTION_CALL_MAX_ROUNDS)
+            completion = await client.chat.completions.create(**payload)
+            tool_calls = self._parse_openai_tool_calls(completion) if self.tool_schemas else []
+            if not tool_calls:
+                return self._parse_openai_completion(completion)
+            self._add_usage(completion.usage.model_dump() if getattr(completion, 'usage', None) else None)
+            messages += await asyncio.to_thread(self._run_tool_round, messages, completion.choices[0].message.content, tool_calls)
+
+    # ---------- AzureOpenAI ----------
+
+    def _azure_request(self, messages, stream=False):
+        url = f"{self.request_base_url.rstrip('/')}/openai/deployments/{self.model}/chat/completions?api-version=2024-02-01"
+        headers = {
+            "Content-Type": "application/json",
+            "api-key": self.request_api_key,
+        }
+        data = {
+            "messages": messages,
+            "temperature": self.temperature,
+        }
+        if stream:
+            data["stream"] = True
+        return url, headers, data
+
+    def _parse_azure_response(self, response_json):
+        LOGGER.info(f'  response:\n\n\n {response_json}')
+        self.last_usage = response_json.get('usage')
+        if response_json.get('choices') and len(response_json['choices']) > 0:
+            if 'content' in response_json['choices'][0]['message']:
+                return str(response_json['choices'][0]['message']['content'])
             else:
-                return f"[MiniMax] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"MiniMax API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
-        
-    def _stepfun_chat(self, prompt, history):
-        # 实现与Stepfun的交互
+                raise ChatRouterError(f"[AzureOpenAI] Error: {response_json['choices'][0]}")
+        else:
+            raise ChatRouterError(f"[AzureOpenAI] Error: {response_json['error']['message']}")
+
+    def _azure_openai_chat(self, prompt, messages):
+        url, headers, data = self._azure_request(messages)
+        session = client_pool.get_requests_session(self.engine, self.request_base_url)
+        response = session.post(url, headers=headers, data=json.dumps(data), timeout=(LLM_CONNECT_TIMEOUT, self.request_timeout))
+        self._check_response(response)
+        return self._parse_azure_response(response.json())
+
+    def _azure_openai_stream(self, prompt, messages):
+        url, headers, data = self._azure_request(messages, stream=True)
+        session = client_pool.get_requests_session(self.engine, self.request_base_url)
+        response = session.post(url, headers=headers, data=json.dumps(data), timeout=(LLM_CONNECT_TIMEOUT, self.request_timeout), stream=True)
+        self.call_token.track(response)
         try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.stepfun.com/v1",
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[Stepfun] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"Stepfun API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
+            self._check_response(response)
+            for data in self._iter_sse_data(response):
+                chunk = json.loads(data)
+                # Azure 的第一个数据块只包含内容过滤结果，choices 为空
+                if chunk.get('choices'):
+                    delta = chunk['choices'][0].get('delta') or {}
+                    if delta.get('content'):
+                        yield delta['content']
+        finally:
+            self.call_token.untrack(response)
+            response.close()
+
+    async def _azure_openai_chat_async(self, prompt, messages):
+        url, headers, data = self._azure_request(messages)
+        client = client_pool.get_async_http_client(self.engine, self.request_base_url)
+        response = await client.post(url, headers=headers, json=data, timeout=httpx.Timeout(self.request_timeout, connect=LLM_CONNECT_TIMEOUT))
+        self._check_response(response)
+        return self._parse_azure_response(response.json())
+
+    # ---------- 智谱清言 ----------
+
+    def _chatglm_chat(self, prompt, messages):
+        client = client_pool.get_zhipuai_client(self.request_api_key, self.request_base_url)
+        payload = {
+            "model": self.model or "glm-4",
+            "messages": messages,
+            "temperature": self.temperature,
+        }
         
-    def _ollama_chat(self, prompt, history):
-        # 实现与Ollama的交互
-        try:
-            
-            LOGGER.info([self.api_key, self.base_url])
-            client = OpenAI(
-                api_key= self.api_key,
-                base_url= self.base_url,
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[Ollama] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"[Ollama] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
+        json_response = client.chat.completions.create(**payload)
         
-    def _302ai_chat(self, prompt, history):
-        # 实现与302AI的交互
-        try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.302.ai/v1",
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[302AI] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"[302AI] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
+        LOGGER.info(f'  response:\n\n\n {json_response}')
+        self.last_usage = json_response.usage.model_dump() if getattr(json_response, 'usage', None) else None
         
-    def _siliconflow_chat(self, prompt, history):
-        # 实现与siliconflow的交互
+        if json_response.choices and len(json_response.choices) > 0:
+            return json_response.choices[0].message.content
+        else:
+            raise ChatRouterError(f'[ChatGLM] Error:{json_response["error"]["message"]}')
+
+    async def _chatglm_chat_async(self, prompt, messages):
+        # zhipuai SDK 没有异步客户端，且密钥需要由 SDK 生成鉴权令牌，所以在线程池中调用同步版本
+        return await asyncio.to_thread(self._chatglm_chat, prompt, messages)
+
+    def _chatglm_stream(self, prompt, messages):
+        client = client_pool.get_zhipuai_client(self.request_api_key, self.request_base_url)
+        stream = self.call_token.track(client.chat.completions.create(
+            model=self.model or "glm-4",
+            messages=messages,
+            temperature=self.temperature,
+            stream=True,
+        ))
         try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.siliconflow.cn/v1",
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-            
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
-
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[siliconflow] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"[siliconflow] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
+            for chunk in stream:
+                # 智谱的流对象不一定能从其他线程关闭，每个数据块之间再检查一次
+                self.call_token.raise_if_cancelled()
+                if getattr(chunk, 'usage', None):
+                    self.last_usage = chunk.usage.model_dump()
+                if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            self.call_token.untrack(stream)
+
+    # ---------- CoZe ----------
+
+    def _coze_request(self, prompt, messages, stream=False):
+        url = f'{self.request_base_url}/open_api/v2/chat'
+        headers = {
+            "Authorization": f"Bearer {self.request_api_key}",
+        }
+        payload = {
+            "bot_id": str(self.bot_id),
+            "user": str(self.user_id),
+            "query": prompt,
+            "chat_history": messages,
+            "stream": stream,
+        }
+        return url, headers, payload
+
+    def _parse_coze_response(self, json_response):
+        if json_response['msg'] != 'success':
+            raise ChatRouterError(f"[COZE] Error: {json_response['msg']}")
+        answer = None
+        for message in json_response['messages']:
+            if message.get('type') == 'answer':
+                answer = message.get('content')
+                break
+        if not answer:
+            raise ChatRouterError("[COZE] Error: empty answer")
+        return answer
+
+    def _coze_chat(self, prompt, messages):
+        # 实现与CoZe的交互
+        url, headers, payload = self._coze_request(prompt, messages)
+        LOGGER.info(f'  payload:\n\n\n {payload}')
         
-    def _openai_chat(self, prompt, history):
-        # 实现与OpenAI的交互
+        session = client_pool.get_requests_session(self.engine, self.request_base_url)
+        response = session.post(url, json=payload, headers=headers, timeout=(LLM_CONNECT_TIMEOUT, self.request_timeout))
+        self._check_response(response)
+        return self._parse_coze_response(response.json())
+
+    def _coze_stream(self, prompt, messages):
+        url, headers, payload = self._coze_request(prompt, messages, stream=True)
+        session = client_pool.get_requests_session(self.engine, self.request_base_url)
+        response = session.post(url, json=payload, headers=headers, timeout=(LLM_CONNECT_TIMEOUT, self.request_timeout), stream=True)
+        self.call_token.track(response)
         try:
-            client = OpenAI(
-                api_key= self.api_key,
-                base_url= self.base_url,
-            )
-
-            messages = self._join_messages(prompt, history)
-            messages = self._fix_messages(messages)
-
-            if not messages:
-                return
-
-            LOGGER.info(f'  messages:\n\n\n {messages}')
-
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
-
-            LOGGER.info(f'  response:\n\n\n {completion.model_dump_json()}')
+            self._check_response(response)
+            for data in self._iter_sse_data(response):
+                event = json.loads(data)
+                if event.get('event') == 'message':
+                    message = event.get('message') or {}
+                    if message.get('type') == 'answer' and message.get('content'):
+                        yield message['content']
+                elif event.get('event') == 'error':
+                    raise ChatRouterError(f"[COZE] Error: {(event.get('error_information') or {}).get('msg', '')}")
+                elif event.get('event') == 'done':
+                    return
+        finally:
+            self.call_token.untrack(response)
+            response.close()
+
+    async def _coze_chat_async(self, prompt, messages):
+        url, headers, payload = self._coze_request(prompt, messages)
+        client = client_pool.get_async_http_client(self.engine, self.request_base_url)
+        response = await client.post(url, json=payload, headers=headers, timeout=httpx.Timeout(self.request_timeout, connect=LLM_CONNECT_TIMEOUT))
+        self._check_response(response)
+        return self._parse_coze_response(response.json())
+
+    # ---------- 百度千帆 ----------
+
+    def _qianfan_request(self, messages, stream=False):
+        url = f"{self.request_base_url}/chat/completions"
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.request_api_key}',
+        }
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": self.temperature,
+        }
+        if stream:
+            payload["stream"] = True
+        return url, headers, payload
+
+    def _parse_qianfan_response(self, completion):
+        LOGGER.info(f'  response:\n\n\n {completion}')
+        self.last_usage = completion.get('usage')
+        if 'choices' in completion and len(completion['choices']) > 0:
+            return completion['choices'][0]['message']['content']
+        else:
+            raise ChatRouterError(f"[QianFan] Error:{completion['error']['message']}")
 
-            if completion.choices and len(completion.choices) > 0:
-                return completion.choices[0].message.content
-            else:
-                return f"[OpenAI] Error:{completion.error.message}"
-        except Exception as e:
-            LOGGER.error(f"[OpenAI] API 调用出错: {str(e)}")
-            return f"错误: {str(e)}"
+    def _qianfan_chat(self, prompt, messages):
+        # 实现与Qianfan的交互
+        url, headers, payload = self._qianfan_request(messages)
+        session = client_pool.get_requests_session(self.engine, self.request_base_url)
+        response = session.post(url, headers=headers, data=json.dumps(payload), timeout=(LLM_CONNECT_TIMEOUT, self.request_timeout))
+        self._check_response(response)
+        return self._parse_qianfan_response(json.loads(response.text))
+
+    def _qianfan_stream(self, prompt, messages):
+        url, headers, payload = self._qianfan_request(messages, stream=True)
+        session = client_pool.get_requests_session(self.engine, self.request_base_url)
+        response = session.post(url, headers=headers, data=json.dumps(payload), timeout=(LLM_CONNECT_TIMEOUT, self.request_timeout), stream=True)
+        self.call_token.track(response)
+        try:
+            self._check_response(response)
+            for data in self._iter_sse_data(response):
+                chunk = json.loads(data)
+                if chunk.get('usage'):
+                    self.last_usage = chunk['usage']
+                if chunk.get('choices'):
+                    delta = chunk['choices'][0].get('delta') or {}
+                    if delta.get('content'):
+                        yield delta['content']
+        finally:
+            self.call_token.untrack(response)
+            response.close()
+
+    async def _qianfan_chat_async(self, prompt, messages):
+        url, headers, payload = self._qianfan_request(messages)
+        client = client_pool.get_async_http_client(self.engine, self.request_base_url)
+        response = await client.post(url, headers=headers, json=payload, timeout=httpx.Timeout(self.request_timeout, connect=LLM_CONNECT_TIMEOUT))
+        self._check_response(response)
+        return self._parse_qianfan_response(response.json())
 
     def add_to_history(self, user_message, bot_response):
         """
@@ -662,17 +963,24 @@ class ChatRouter:
         """
         return self.history
 
-    def _join_messages(self, prompt, history):
-        if self.system_prompt:
+    def _join_messages(self, prompt, history, image=None):
+        system_prompt = self.system_prompt
+        # 较早的对话已经总结成摘要时，摘要附在系统提示词后面
+        if self.active_summary:
+            system_prompt = f"{system_prompt}\n\n以下是之前对话的摘要：\n{self.active_summary['content']}".strip()
+        user_message = {"role": "user", "content": prompt}
+        if image:
+            user_message["image"] = image
+        if system_prompt:
             messages = [
-                {"role": "system", "content": self.system_prompt},
+                {"role": "system", "content": system_prompt},
                 *history,
-                {"role": "user", "content": prompt},
+                user_message,
             ]
         else:
             messages = [
                 *history,
-                {"role": "user", "content": prompt},
+                user_message,
             ]
 
         return messages
@@ -683,10 +991,51 @@ class ChatRouter:
         # role 的值直接从原消息中获取。
         # content 的值尝试从原消息中获取，如果 content 不存在，则使用空字符串 "" 作为默认值。
         # 只有当消息的 content 不为空时，这条消息才会被包含在新列表中
-        messages = [{"role": msg.get("role"), "content": str(msg.get("content",""))} for msg in messages if msg['content']]
+        # 带 error 标记的消息是调用失败的提示，不属于对话内容，也要排除
+        # 引擎支持图片输入时，用户消息中的图片也保留下来，裁剪上下文后再按引擎的格式附加
+        fixed_messages = []
+        for msg in messages:
+            if not msg['content'] or msg.get('error'):
+                continue
+            fixed_message = {"role": msg.get("role"), "content": str(msg.get("content",""))}
+            if msg.get('image') and self.image_profile:
+                fixed_message["image"] = msg['image']
+            fixed_messages.append(fixed_message)
+        messages = fixed_messages
         # 检查修正后的 messages 列表是否非空，并且列表中最后一条消息的 role 是否不是 'user',如果是这种情况，将最后一条消息的 role 修改为 'user'。
         if messages and messages[-1]['role'] != 'user':
             messages[-1]['role'] = 'user'
+        # 按 token 预算保留系统提示词和最新的消息，避免超长的上下文发出去后才被接口拒绝
+        if self.trim_by_tokens:
+            messages = trim_messages_to_budget(messages, self.context_budget)
+        if self.image_profile:
+            messages = [self._attach_image(msg) for msg in messages]
         # LOGGER.info(messages)
         # LOGGER.info("fix_messages: \n\n\n" + str(messages) + "\n\n\n")
-        return messages
\ No newline at end of file
+        return messages
+
+    def _attach_image(self, message):
+        """
+        把用户消息中的图片按引擎的限制编码后，转换为 OpenAI 格式的多模态 content。
+        编码结果按图片内容缓存，历史消息中的图片不会每轮重新编码。
+        """
+        image = message.pop('image', None)
+        if not image or message['role'] != 'user':
+            return message
+        try:
+            payload = encode_image_for_engine(image, self.image_profile)
+        except ImageError as e:
+            LOGGER.warning(f"[{self.engine}] 图片无法发送，只发送文字: {str(e)}")
+            return message
+        return {
+            "role": message['role'],
+            "content": [
+                {"type": "text", "text": message['content']},
+                {"type": "image_url", "image_url": {"url": payload}},
+            ],
+        }
+
+    def _redact_images(self, messages):
+        # 记录日志时省略图片数据
+        return [{**msg, "content": [part if part.get('type') != 'image_url' else {"type": "image_url", "image_url": {"url": "<image>"}} for part in msg['content']]}
+                if isinstance(msg.get('content'), list) else msg for msg in messages]
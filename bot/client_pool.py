@@ -0,0 +1,215 @@
+# *-* coding:utf-8 *-*
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    CLIENT_POOL_MAX_SIZE, CLIENT_POOL_IDLE_TIMEOUT, CLIENT_POOL_MAX_CONNECTIONS,
+    CLIENT_POOL_KEEPALIVE_EXPIRY, LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def hash_api_key(api_key):
+    """
+    计算API Key的摘要，用于做缓存键，避免明文密钥常驻在字典键中。
+    """
+    return hashlib.sha256(str(api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+class ClientPool:
+    """
+    进程级的大模型客户端注册表。
+
+    按 (engine, base_url, api_key摘要) 复用长连接客户端，使每轮对话不再重新做 DNS + TCP + TLS 握手。
+    - 容量有上限，超出时淘汰最久未使用的客户端
+    - 空闲超过 idle_timeout 秒的客户端会被关闭并移除
+    - 所有操作都有锁保护，可在多线程（Streamlit 每个会话一个线程）中安全使用
+    """
+
+    def __init__(self, max_size=CLIENT_POOL_MAX_SIZE, idle_timeout=CLIENT_POOL_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clients = OrderedDict()   # key -> {'client': ..., 'last_used': ...}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, key, factory):
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key)
+            if entry is None:
+                entry = {'client': factory(), 'last_used': now}
+                self._clients[key] = entry
+                LOGGER.info(f"[ClientPool] 新建客户端: {key[0]} {key[1]}")
+                while len(self._clients) > self.max_size:
+                    # 按容量淘汰的客户端可能仍有调用在进行，只移除引用，不主动关闭
+                    old_key, _ = self._clients.popitem(last=False)
+                    LOGGER.info(f"[ClientPool] 容量已满，淘汰客户端: {old_key[0]} {old_key[1]}")
+            else:
+                entry['last_used'] = now
+                self._clients.move_to_end(key)
+            return entry['client']
+
+    def _evict_idle(self, now):
+        expired = [key for key, entry in self._clients.items() if now - entry['last_used'] > self.idle_timeout]
+        for key in expired:
+            entry = self._clients.pop(key)
+            self._close_client(entry['client'])
+            LOGGER.info(f"[ClientPool] 空闲超时，关闭客户端: {key[0]} {key[1]}")
+
+    def _close_client(self, client):
+        try:
+            result = client.close()
+            if asyncio.iscoroutine(result):
+                # 异步客户端的 close 是协程，交给所属事件循环执行
+                try:
+                    asyncio.get_running_loop().create_task(result)
+                except RuntimeError:
+                    result.close()
+        except Exception as e:
+            LOGGER.warning(f"[ClientPool] 关闭客户端出错: {str(e)}")
+
+    def _new_http_client(self):
+        return httpx.Client(
+            limits=httpx.Limits(
+                max_connections=CLIENT_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=CLIENT_POOL_MAX_CONNECTIONS,
+                keepalive_expiry=CLIENT_POOL_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+
+    def get_openai_client(self, engine, base_url, api_key):
+        """
+        获取兼容OpenAI接口的客户端。
+        """
+        from openai import OpenAI
+
+        key = ('openai', engine, base_url or '', hash_api_key(api_key))
+        return self._get_or_create(key, lambda: OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=self._new_http_client(),
+            max_retries=0,      # 重试由 bot.resilience 统一处理
+        ))
+
+    def get_zhipuai_client(self, api_key, base_url=None):
+        """
+        获取智谱清言客户端，SDK内部自带 httpx 连接池，复用实例即可复用连接。
+        base_url 为空时使用SDK默认的接口地址。
+        """
+        from zhipuai import ZhipuAI
+
+        key = ('zhipuai', 'ChatGLM', base_url or '', hash_api_key(api_key))
+        return self._get_or_create(key, lambda: ZhipuAI(api_key=api_key, base_url=base_url or None, max_retries=0))
+
+    def get_requests_session(self, engine, base_url):
+        """
+        获取直接使用 requests 调用的引擎（AzureOpenAI、CoZe、Qianfan）的会话，会话内的连接池按主机复用连接。
+        """
+        def factory():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=CLIENT_POOL_MAX_CONNECTIONS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            return session
+
+        key = ('requests', engine, base_url or '', '')
+        return self._get_or_create(key, factory)
+
+    def _new_async_http_client(self):
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=CLIENT_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=CLIENT_POOL_MAX_CONNECTIONS,
+                keepalive_expiry=CLIENT_POOL_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+
+    def get_async_openai_client(self, engine, base_url, api_key):
+        """
+        获取兼容OpenAI接口的异步客户端，需在事件循环中调用。
+        """
+        from openai import AsyncOpenAI
+
+        key = ('async_openai', engine, base_url or '', hash_api_key(api_key))
+        return self._get_or_create(key, lambda: AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=self._new_async_http_client(),
+            max_retries=0,
+        ))
+
+    def get_async_http_client(self, engine, base_url):
+        """
+        获取直接发送HTTP请求的引擎所用的 httpx.AsyncClient，需在事件循环中调用。
+        """
+        key = ('async_http', engine, base_url or '', '')
+        return self._get_or_create(key, self._new_async_http_client)
+
+    def clear(self):
+        with self._lock:
+            for entry in self._clients.values():
+                self._close_client(entry['client'])
+            self._clients.clear()
+
+    def size(self):
+        with self._lock:
+            return len(self._clients)
+
+
+class ClientPoolRegistry:
+    """
+    同步客户端在整个进程内共用一个 ClientPool；
+    异步客户端绑定在创建它的事件循环上，因此每个事件循环单独使用一个 ClientPool，事件循环被回收时随之释放。
+    """
+
+    def __init__(self):
+        self._sync_pool = ClientPool()
+        self._loop_pools = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _loop_pool(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pool = self._loop_pools.get(loop)
+            if pool is None:
+                pool = ClientPool()
+                self._loop_pools[loop] = pool
+            return pool
+
+    def get_openai_client(self, engine, base_url, api_key):
+        return self._sync_pool.get_openai_client(engine, base_url, api_key)
+
+    def get_zhipuai_client(self, api_key, base_url=None):
+        return self._sync_pool.get_zhipuai_client(api_key, base_url)
+
+    def get_requests_session(self, engine, base_url):
+        return self._sync_pool.get_requests_session(engine, base_url)
+
+    def get_async_openai_client(self, engine, base_url, api_key):
+        return self._loop_pool().get_async_openai_client(engine, base_url, api_key)
+
+    def get_async_http_client(self, engine, base_url):
+        return self._loop_pool().get_async_http_client(engine, base_url)
+
+    def clear(self):
+        self._sync_pool.clear()
+
+    def size(self):
+        return self._sync_pool.size()
+
+
+# 创建全局客户端注册表实例
+client_pool = ClientPoolRegistry()
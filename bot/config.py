@@ -2,6 +2,7 @@ ENGINE_CONFIG = {
   "engines": {
     "OpenAI": {
       "name": "OpenAI(需翻墙)",
+      "context_budget": {"default": 100000, "gpt-4": 6000, "gpt-3.5-turbo": 12000},
       "fields": [
         {
           "name": "model",
@@ -38,6 +39,7 @@ ENGINE_CONFIG = {
     },
     "AzureOpenAI": {
       "name": "微软OpenAI",
+      "context_budget": {"default": 100000, "gpt-4": 6000, "gpt-35-turbo": 12000},
       "fields": [
         {
           "name": "model",
@@ -74,6 +76,8 @@ ENGINE_CONFIG = {
     },
     "ChatGLM": {
       "name": "智谱清言",
+      "rate_limit": {"rpm": 300, "tpm": 500000},
+      "context_budget": {"default": 100000},
       "fields": [
         {
           "name": "model",
@@ -102,6 +106,7 @@ ENGINE_CONFIG = {
     },
     "CoZe": {
       "name": "Coze智能体",
+      "context_budget": {"default": 24000},
       "fields": [
         {
           "name": "bot_id",
@@ -121,6 +126,8 @@ ENGINE_CONFIG = {
     },
     "Qwen": {
       "name": "通义千问",
+      "rate_limit": {"rpm": 600, "tpm": 1000000},
+      "context_budget": {"default": 100000, "qwen-max": 24000},
       "fields": [
         {
           "name": "model",
@@ -149,6 +156,7 @@ ENGINE_CONFIG = {
     },
     "Ollama": {
       "name": "Ollama",
+      "context_budget": {"default": 3000},
       "fields": [
         {
           "name": "model",
@@ -169,6 +177,7 @@ ENGINE_CONFIG = {
     },
     "XingHuo": {
       "name": "讯飞星火",
+      "context_budget": {"default": 6000, "4.0Ultra": 6000, "generalv3.5": 6000},
       "fields": [
         {
           "name": "model",
@@ -197,6 +206,7 @@ ENGINE_CONFIG = {
     },
     "Qianfan": {
       "name": "百度文心",
+      "context_budget": {"default": 6000, "ernie-4.0-turbo-128k": 100000},
       "fields": [
         {
           "name": "model",
@@ -225,6 +235,7 @@ ENGINE_CONFIG = {
     },
     "DeepSeek": {
       "name": "DeepSeek",
+      "context_budget": {"default": 56000},
       "fields": [
         {
           "name": "model",
@@ -253,6 +264,7 @@ ENGINE_CONFIG = {
     },
     "MiniMax": {
       "name": "MiniMax",
+      "context_budget": {"default": 200000},
       "fields": [
         {
           "name": "model",
@@ -281,6 +293,8 @@ ENGINE_CONFIG = {
     },
     "Moonshot": {
       "name": "KIMI",
+      "rate_limit": {"rpm": 200, "tpm": 128000},
+      "context_budget": {"default": 6000, "moonshot-v1-32k": 28000, "moonshot-v1-128k": 120000},
       "fields": [
         {
           "name": "model",
@@ -309,6 +323,8 @@ ENGINE_CONFIG = {
     },
     "Stepfun": {
       "name": "阶跃星辰",
+      "rate_limit": {"rpm": 60, "tpm": 1000000},
+      "context_budget": {"default": 6000, "step-1-32k": 28000, "step-1-128k": 120000, "step-1-256k": 240000},
       "fields": [
         {
           "name": "model",
@@ -337,6 +353,8 @@ ENGINE_CONFIG = {
     },
     "Yi": {
       "name": "零一万物",
+      "rate_limit": {"rpm": 120, "tpm": 300000},
+      "context_budget": {"default": 14000, "yi-large": 28000},
       "fields": [
         {
           "name": "model",
@@ -365,6 +383,8 @@ ENGINE_CONFIG = {
     },
     "Groq": {
       "name": "Groq(需翻墙)",
+      "rate_limit": {"rpm": 30, "tpm": 6000},
+      "context_budget": {"default": 28000, "llama3-8b-8192": 6000, "llama3-70b-8192": 6000},
       "fields": [
         {
           "name": "model",
@@ -393,6 +413,7 @@ ENGINE_CONFIG = {
     },
     "302AI": {
       "name": "302.AI",
+      "context_budget": {"default": 100000},
       "fields": [
         {
           "name": "model",
@@ -421,6 +442,8 @@ ENGINE_CONFIG = {
     },
     "siliconflow": {
       "name": "硅基流动",
+      "rate_limit": {"rpm": 1000, "tpm": 50000},
+      "context_budget": {"default": 56000},
       "fields": [
         {
           "name": "model",
@@ -449,3 +472,45 @@ ENGINE_CONFIG = {
     },
   }
 }
+
+
+# 引擎适配器注册表，ChatRouter 根据 adapter 类型直接查表分派请求
+# - adapter: 请求路径类型，openai 表示兼容OpenAI接口，所有此类引擎共用同一条请求路径
+# - base_url: 固定的接口地址
+# - base_url_field: 从Bot配置中读取接口地址的字段名（与 base_url 二选一）
+# - api_key_field: 从Bot配置中读取密钥的字段名，默认为 api_key
+# - timeout: 单次请求的读取超时（秒），不设置时使用全局的 MULTIBOT_LLM_READ_TIMEOUT
+# - default_model: Bot未填写模型时使用的默认模型
+# - function_calling: 接口支持 OpenAI 格式的 tools 参数，Bot开启"调用工具"后可以通过 function calling 使用工具
+# - image: 接口支持图片输入时，发送前按这里的限制缩放和压缩图片，没有配置的引擎只发送文字
+#     max_side: 长边最大像素数；short_side: 短边最大像素数；max_pixels: 总像素数上限；
+#     max_bytes: base64 编码后的最大字节数；data_url: 为 False 时只发送 base64 字符串，不带 data: 前缀
+#     未设置的项使用 MULTIBOT_IMAGE_MAX_SIDE 和 MULTIBOT_IMAGE_MAX_BYTES
+# 新增兼容OpenAI接口的引擎时，只需要在 ENGINE_CONFIG 和这里各加一项即可
+ENGINE_ADAPTERS = {
+  "OpenAI": {"adapter": "openai", "base_url_field": "base_url", "function_calling": True, "image": {"max_side": 2048, "short_side": 768}},
+  "AzureOpenAI": {"adapter": "azure", "base_url_field": "api_endpoint", "image": {"max_side": 2048, "short_side": 768}},
+  "ChatGLM": {"adapter": "chatglm", "base_url": "https://open.bigmodel.cn/api/paas/v4", "default_model": "glm-4", "image": {"max_side": 2048, "data_url": False}},
+  "CoZe": {"adapter": "coze", "base_url": "https://api.coze.cn"},
+  "Qwen": {"adapter": "openai", "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "function_calling": True, "image": {"max_side": 2048, "max_pixels": 1003520}},
+  "Ollama": {"adapter": "openai", "base_url_field": "base_url", "timeout": 300, "function_calling": True, "image": {"max_side": 1344}},
+  "XingHuo": {"adapter": "openai", "base_url": "https://spark-api-open.xf-yun.com/v1", "api_key_field": "api_password"},
+  "Qianfan": {"adapter": "qianfan", "base_url": "https://qianfan.baidubce.com/v2", "image": {"max_side": 2048}},
+  "DeepSeek": {"adapter": "openai", "base_url": "https://api.deepseek.com", "function_calling": True},
+  "MiniMax": {"adapter": "openai", "base_url": "https://api.minimax.chat/v1", "function_calling": True},
+  "Moonshot": {"adapter": "openai", "base_url": "https://api.moonshot.cn/v1", "function_calling": True, "image": {"max_side": 2048}},
+  "Stepfun": {"adapter": "openai", "base_url": "https://api.stepfun.com/v1", "function_calling": True, "image": {"max_side": 2048}},
+  "Yi": {"adapter": "openai", "base_url": "https://api.lingyiwanwu.com/v1", "function_calling": True, "image": {"max_side": 1536}},
+  "Groq": {"adapter": "openai", "base_url": "https://api.groq.com/openai/v1", "function_calling": True, "image": {"max_side": 2048}},
+  "302AI": {"adapter": "openai", "base_url": "https://api.302.ai/v1", "function_calling": True, "image": {"max_side": 2048, "short_side": 768}},
+  "siliconflow": {"adapter": "openai", "base_url": "https://api.siliconflow.cn/v1", "function_calling": True, "image": {"max_side": 2048}},
+}
+
+
+def apply_mock_base_url(mock_base_url):
+    """
+    把所有引擎的接口地址改为本地模拟服务（utils/mock_llm_server.py），地址中带上引擎名，便于模拟服务按引擎区分配置和统计。
+    由 config.py 在设置了 MULTIBOT_MOCK_LLM_BASE_URL 时调用。
+    """
+    for engine, adapter_config in ENGINE_ADAPTERS.items():
+        adapter_config['base_url'] = f"{mock_base_url.rstrip('/')}/{engine}"
@@ -0,0 +1,85 @@
+# *-* coding:utf-8 *-*
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import FAN_OUT_MAX_WORKERS
+
+LOGGER = logging.getLogger(__name__)
+
+# 进程内共用的线程池，所有会话的并发请求都在这里执行
+_executor = ThreadPoolExecutor(max_workers=FAN_OUT_MAX_WORKERS, thread_name_prefix='fan_out')
+
+
+def fan_out(jobs, timeout, heartbeat=None):
+    """
+    把多个请求并发执行，按到达顺序产出每个请求的进度事件。
+
+    参数:
+        jobs (dict): 任务ID -> 无参函数，函数返回一个逐段产出回复文本的可迭代对象（流式或一次性返回均可）。
+        timeout (float): 每个任务的超时时间（秒），从开始并发时计时。
+        heartbeat (float): 连续这么多秒没有事件时产出一次 'tick'，调用方可以借此刷新页面；为 None 时不产出。
+
+    产出:
+        (job_id, event, payload) 元组，event 为:
+            'delta'   - payload 为新到达的一段文本
+            'done'    - 任务正常结束
+            'error'   - 任务抛出异常，payload 为异常信息
+            'timeout' - 任务超时，已通知其停止
+            'tick'    - 心跳，job_id 和 payload 均为 None
+        每个任务最终一定会产出 'done'、'error'、'timeout' 之一。
+
+    注意: 任务函数在线程池中执行，不能在其中调用 Streamlit 的任何接口。
+    """
+    events = queue.Queue()
+    cancel_events = {job_id: threading.Event() for job_id in jobs}
+
+    def run(job_id, job):
+        stream = None
+        try:
+            stream = job()
+            for delta in stream:
+                if cancel_events[job_id].is_set():
+                    return
+                events.put((job_id, 'delta', delta))
+            events.put((job_id, 'done', None))
+        except Exception as e:
+            LOGGER.error(f"[fan_out] 任务 {job_id} 出错: {str(e)}")
+            events.put((job_id, 'error', str(e)))
+        finally:
+            # 关闭生成器，使流式请求释放底层连接
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+
+    deadline = time.monotonic() + timeout
+    for job_id, job in jobs.items():
+        _executor.submit(run, job_id, job)
+
+    pending = set(jobs)
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for job_id in list(pending):
+                    pending.discard(job_id)
+                    cancel_events[job_id].set()
+                    LOGGER.warning(f"[fan_out] 任务 {job_id} 超过 {timeout} 秒未完成")
+                    yield job_id, 'timeout', None
+                return
+            try:
+                job_id, event, payload = events.get(timeout=min(remaining, heartbeat) if heartbeat else remaining)
+            except queue.Empty:
+                if heartbeat:
+                    yield None, 'tick', None
+                continue
+            if job_id not in pending:
+                continue
+            if event in ('done', 'error'):
+                pending.discard(job_id)
+            yield job_id, event, payload
+    finally:
+        # 调用方提前停止迭代时（如页面重跑），通知还没结束的任务停止
+        for job_id in pending:
+            cancel_events[job_id].set()
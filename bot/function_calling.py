@@ -0,0 +1,111 @@
+# *-* coding:utf-8 *-*
+import importlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from utils.token_utils import truncate_text_to_tokens
+from config import FUNCTION_CALL_TIMEOUT, FUNCTION_RESULT_MAX_TOKENS
+
+LOGGER = logging.getLogger(__name__)
+
+# 工具单独使用一个线程池：调用方本身可能运行在 fan_out 或对冲请求的线程池中
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='function_call')
+
+
+def build_tool_schemas(tools):
+    """
+    把 ToolManager 中配置了 function 的工具转换成 OpenAI 格式的 function 定义，函数名即工具的目录名。
+    工具的 run 只接收一段文本，所以每个函数只有一个 content 参数。
+    """
+    schemas = []
+    for tool in tools or []:
+        function = tool.get('function')
+        if not function:
+            continue
+        schemas.append({
+            "type": "function",
+            "function": {
+                "name": tool['id'],
+                "description": f"{tool['name']}：{tool['description']}",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "content": {"type": "string", "description": function.get('content_description', '工具要处理的文本')},
+                    },
+                    "required": ["content"],
+                },
+            },
+        })
+    return schemas
+
+
+def _message_text(content):
+    # 带图片的消息 content 是分段列表，工具只处理其中的文本
+    if isinstance(content, list):
+        return '\n'.join(part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text')
+    return content or ''
+
+
+def build_tool_history(messages):
+    """
+    把发给模型的 messages 转换成群聊工具使用的历史格式：去掉系统提示词、工具调用和工具结果，只保留有文本的用户和助手消息。
+    """
+    history = []
+    for message in messages or []:
+        if message.get('role') not in ('user', 'assistant') or message.get('tool_calls'):
+            continue
+        text = _message_text(message.get('content'))
+        if text:
+            history.append({"role": message['role'], "content": text})
+    return history
+
+
+def _run_tool(tool, arguments, group_prompt, history):
+    try:
+        content = json.loads(arguments or '{}').get('content', '')
+    except (ValueError, AttributeError):
+        # 部分模型直接返回纯文本参数
+        content = arguments or ''
+    module = importlib.import_module(f"tools.{tool['id']}.{tool['main_file'][:-3]}")
+    # 工具按群聊工具的方式调用，对话上下文之后追加一条用参数作为内容的消息，作为工具要处理的最后一条消息
+    result = module.run(tool.get('parameter', {}), content, group_prompt, history + [{"role": "user", "content": content}])
+    if isinstance(result, list):
+        result = '\n\n'.join(str(r) for r in result if r)
+    return str(result or '（没有结果）')
+
+
+def run_tool_calls(tool_calls, tools, group_prompt='', history=None, timeout=FUNCTION_CALL_TIMEOUT):
+    """
+    并发执行模型返回的工具调用，返回按调用顺序排列的 tool 消息，可以直接追加到 messages 中。
+
+    参数:
+        tool_calls (list): OpenAI 格式的 tool_calls，[{'id', 'function': {'name', 'arguments'}}]。
+        tools (list): ToolManager 中的工具列表。
+        group_prompt (str): 群聊接力提示词，私聊时为空。
+        history (list): 工具可以参考的对话上下文，由 build_tool_history 生成。
+        timeout (float): 等待所有工具完成的最长时间（秒），超时的工具返回错误信息。
+    """
+    tool_map = {tool['id']: tool for tool in tools or [] if tool.get('function')}
+    futures = {}
+    results = {}
+    for call in tool_calls:
+        name = call['function']['name']
+        tool = tool_map.get(name)
+        if tool is None:
+            results[call['id']] = f"[ERROR] 没有名为 {name} 的工具"
+            continue
+        LOGGER.info(f"[FunctionCall] 调用工具 {name}: {call['function'].get('arguments', '')[:200]}")
+        futures[call['id']] = _executor.submit(_run_tool, tool, call['function'].get('arguments'), group_prompt, history or [])
+
+    wait(futures.values(), timeout=timeout)
+    for call_id, future in futures.items():
+        if not future.done():
+            future.cancel()
+            results[call_id] = f"[ERROR] 工具执行超过 {int(timeout)} 秒"
+        elif future.exception() is not None:
+            results[call_id] = f"[ERROR] 工具执行出错: {str(future.exception())}"
+        else:
+            results[call_id] = truncate_text_to_tokens(future.result(), FUNCTION_RESULT_MAX_TOKENS)
+
+    return [{"role": "tool", "tool_call_id": call['id'], "content": results[call['id']]} for call in tool_calls]
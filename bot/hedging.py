@@ -0,0 +1,141 @@
+# *-* coding:utf-8 *-*
+import logging
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bot.metrics import metrics_recorder
+from config import HEDGE_MAX_WORKERS, HEDGE_MIN_SAMPLES, HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY
+
+LOGGER = logging.getLogger(__name__)
+
+# 对冲请求单独使用一个线程池：主请求可能本身就运行在 fan_out 的线程池中，共用线程池在繁忙时会互相等待
+_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix='hedge')
+
+
+def get_hedge_delay(bot_id):
+    """
+    按这个Bot最近的首字延迟的 p95 计算发出备用请求前的等待时间，样本不足时使用默认值。
+    """
+    samples = sorted(
+        r['first_token_latency'] for r in metrics_recorder.get_recent(bot_id=bot_id)
+        if r.get('first_token_latency') is not None and not r.get('error') and not r.get('cache_hit') and not r.get('shared')
+    )
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    p95 = samples[min(len(samples) - 1, math.ceil(len(samples) * 0.95) - 1)]
+    return max(HEDGE_MIN_DELAY, p95)
+
+
+class HedgedRequest:
+    """
+    带备用Bot的请求。
+
+    主Bot超过 p95 首字延迟仍没有输出时，再向备用Bot发出同样的请求，先输出的一方胜出，另一方被取消。
+    make_stream 应当返回真正逐段产出的流：一次性返回完整回复时几乎总会超过首字延迟而发出备用请求。
+    主Bot在备用请求发出前就失败时，立即改用备用Bot。
+    没有备用Bot时直接调用主Bot，不经过线程池。
+    """
+
+    def __init__(self, primary, fallback=None, delay=None):
+        self.primary = primary
+        self.fallback = fallback
+        self.delay = delay if delay is not None else get_hedge_delay(primary.bot_id)
+        self.router = primary       # 胜出的 ChatRouter，调用结束后从它读取指标
+        self.hedged = False
+
+    def cancel(self):
+        """
+        取消主Bot和备用Bot的请求，立即关闭连接。
+        """
+        for router in (self.primary, self.fallback):
+            if router is not None:
+                router.cancel_token.cancel()
+
+    def stream(self, make_stream):
+        """
+        make_stream(chat_router) 返回逐段产出回复文本的可迭代对象，返回胜出一方的增量。
+        """
+        if self.fallback is None:
+            yield from make_stream(self.primary)
+            return
+
+        events = queue.Queue()
+        routers = {'primary': self.primary, 'fallback': self.fallback}
+        cancel_events = {name: threading.Event() for name in routers}
+
+        def run(name):
+            stream = None
+            try:
+                stream = make_stream(routers[name])
+                for delta in stream:
+                    if cancel_events[name].is_set():
+                        return
+                    events.put((name, 'delta', delta))
+                events.put((name, 'done', None))
+            except Exception as e:
+                events.put((name, 'error', e))
+            finally:
+                if stream is not None and hasattr(stream, 'close'):
+                    stream.close()
+                # 主Bot在准备消息之前就结束时，备用Bot不再等待它的摘要
+                routers[name].summary_ready.set()
+
+        def start_fallback(reason):
+            self.hedged = True
+            pending.add('fallback')
+            LOGGER.info(f"[Hedge] {self.primary.engine} {reason}，发出备用请求: {self.fallback.engine}")
+            _executor.submit(run, 'fallback')
+
+        pending = {'primary'}
+        _executor.submit(run, 'primary')
+        deadline = time.monotonic() + self.delay
+        winner = None
+        first_error = None
+        try:
+            while True:
+                timeout = None
+                if winner is None and not self.hedged:
+                    timeout = max(0, deadline - time.monotonic())
+                try:
+                    name, event, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    start_fallback(f"超过 {self.delay:.1f}s 没有输出")
+                    continue
+
+                if winner is None:
+                    if event == 'error':
+                        pending.discard(name)
+                        first_error = first_error or payload
+                        if not self.hedged:
+                            start_fallback(f"请求失败（{str(payload)}）")
+                        elif not pending:
+                            raise first_error
+                        continue
+                    # 先输出（或先完成）的一方胜出，取消另一方并立即关闭它的连接
+                    winner = name
+                    self.router = routers[name]
+                    for other in routers:
+                        if other != name:
+                            cancel_events[other].set()
+                            routers[other].cancel_token.cancel()
+                    if name == 'fallback':
+                        LOGGER.info(f"[Hedge] 备用Bot {self.fallback.engine} 胜出")
+
+                if name != winner:
+                    continue
+                if event == 'delta':
+                    yield payload
+                elif event == 'done':
+                    return
+                else:
+                    raise payload
+        except GeneratorExit:
+            # 调用方中途停止读取，两边的请求都不再需要
+            self.cancel()
+            raise
+        finally:
+            for cancel_event in cancel_events.values():
+                cancel_event.set()
@@ -0,0 +1,77 @@
+# *-* coding:utf-8 *-*
+import json
+import logging
+import os
+import threading
+from collections import Counter, deque
+
+from config import METRICS_RING_SIZE, METRICS_FILE
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MetricsRecorder:
+    """
+    记录每次大模型调用的耗时和用量。
+
+    - 最近的 ring_size 条保存在内存中，供页面展示和路由、对冲请求等策略使用
+    - 同时逐行追加写入 metrics_file（JSON Lines），便于离线分析；metrics_file 为空时不写文件
+    """
+
+    def __init__(self, ring_size=METRICS_RING_SIZE, metrics_file=METRICS_FILE):
+        self._records = deque(maxlen=ring_size)
+        self._lock = threading.Lock()
+        self.metrics_file = metrics_file
+        self._file_error_logged = False
+        self._in_flight = Counter()     # bot_id -> 正在进行的调用数
+
+    def call_started(self, bot_id):
+        """
+        统计Bot正在进行的调用数（包括排队等待限流配额的调用），供自动路由估算排队深度。
+        调用结束时（无论成功、失败还是被取消）必须调用 call_finished。
+        """
+        with self._lock:
+            self._in_flight[bot_id] += 1
+
+    def call_finished(self, bot_id):
+        with self._lock:
+            self._in_flight[bot_id] -= 1
+            if self._in_flight[bot_id] <= 0:
+                del self._in_flight[bot_id]
+
+    def get_in_flight(self, bot_id):
+        with self._lock:
+            return self._in_flight.get(bot_id, 0)
+
+    def record(self, metrics):
+        with self._lock:
+            self._records.append(metrics)
+            if not self.metrics_file:
+                return
+            try:
+                directory = os.path.dirname(self.metrics_file)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.metrics_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(metrics, ensure_ascii=False) + '\n')
+            except Exception as e:
+                # 写文件失败不影响对话，只记录一次日志
+                if not self._file_error_logged:
+                    LOGGER.warning(f"[Metrics] 写入指标文件出错: {str(e)}")
+                    self._file_error_logged = True
+
+    def get_recent(self, limit=None, **filters):
+        """
+        按时间从旧到新返回最近的记录，filters 为字段的等值过滤条件，如 engine='Moonshot'。
+        """
+        with self._lock:
+            records = list(self._records)
+        if filters:
+            records = [r for r in records if all(r.get(k) == v for k, v in filters.items())]
+        if limit:
+            records = records[-limit:]
+        return records
+
+
+# 创建全局指标记录实例
+metrics_recorder = MetricsRecorder()
@@ -0,0 +1,196 @@
+# *-* coding:utf-8 *-*
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from bot.cancellation import CallCancelledError
+from bot.client_pool import hash_api_key
+from bot.config import ENGINE_CONFIG
+from config import RATE_LIMIT_MAX_WAIT
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RateLimitTimeout(Exception):
+    """
+    排队等待配额的时间超过了上限。
+    """
+
+    def __init__(self, key, waited):
+        super().__init__(f"请求过于频繁，排队 {int(waited)} 秒仍未轮到，请稍后再试")
+        self.key = key
+        self.waited = waited
+
+
+class TokenBucket:
+    """
+    令牌桶：容量为 capacity，每秒补充 capacity / 60 个令牌（即每分钟额度）。
+    令牌数允许为负，表示实际用量超过了预扣的额度，需要等待补回。
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount, now):
+        """
+        返回还需要等待多少秒才能取出 amount 个令牌，0 表示现在就可以取。
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """
+    同一个API Key的请求配额和 token 配额。
+
+    等待配额的请求按用户名分组排队，各用户轮流取用：
+    某个用户一次发出很多请求（如同时对比多个Bot）时，其他用户的请求不必排在它们全部后面。
+    """
+
+    def __init__(self, key, rpm=None, tpm=None, max_wait=RATE_LIMIT_MAX_WAIT):
+        self.key = key
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self.max_wait = max_wait
+        self.paused_until = 0
+        self._queues = OrderedDict()    # username -> deque[ticket]，字典顺序即轮转顺序
+        self._condition = threading.Condition()
+
+    def _is_head(self, username, ticket):
+        # 轮转顺序中排在最前面的用户的第一个请求才能取令牌
+        head_username = next(iter(self._queues))
+        return head_username == username and self._queues[username][0] is ticket
+
+    def _wait_time(self, tokens, now):
+        wait = max(0, self.paused_until - now)
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.wait_time(1, now))
+        if self.token_bucket:
+            wait = max(wait, self.token_bucket.wait_time(tokens, now))
+        return wait
+
+    def acquire(self, username, tokens, cancel_token=None):
+        """
+        取得一次请求和 tokens 个 token 的配额，额度不足时排队等待。
+        传入 cancel_token 时，排队期间被取消会立即退出队列。
+
+        返回:
+            排队等待的秒数。
+
+        异常:
+            RateLimitTimeout: 等待超过 max_wait 秒时抛出。
+            CallCancelledError: 排队期间调用被取消时抛出。
+        """
+        if not self.request_bucket and not self.token_bucket:
+            return 0
+        username = username or ''
+        ticket = object()
+        start_time = time.monotonic()
+        with self._condition:
+            self._queues.setdefault(username, deque()).append(ticket)
+            try:
+                while True:
+                    if cancel_token is not None and cancel_token.cancelled:
+                        raise CallCancelledError()
+                    now = time.monotonic()
+                    if self._is_head(username, ticket):
+                        wait = self._wait_time(tokens, now)
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = self.max_wait
+                    remaining = self.max_wait - (now - start_time)
+                    if remaining <= 0:
+                        raise RateLimitTimeout(self.key, now - start_time)
+                    if cancel_token is not None:
+                        # 取消不会唤醒条件变量，分段等待以便及时退出
+                        wait = min(wait, 0.5)
+                    self._condition.wait(min(wait, remaining))
+                if self.request_bucket:
+                    self.request_bucket.take(1)
+                if self.token_bucket:
+                    self.token_bucket.take(tokens)
+            finally:
+                queue = self._queues[username]
+                queue.remove(ticket)
+                if queue:
+                    # 本用户还有请求在排队，轮转到队尾
+                    self._queues.move_to_end(username)
+                else:
+                    del self._queues[username]
+                self._condition.notify_all()
+        waited = time.monotonic() - start_time
+        if waited > 0.5:
+            LOGGER.info(f"[RateLimiter] {self.key} 用户 {username} 排队 {waited:.1f}s")
+        return waited
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """
+        调用结束后用实际的 token 用量修正预扣的额度。
+        """
+        if not self.token_bucket or actual_tokens is None:
+            return
+        with self._condition:
+            self.token_bucket.adjust(actual_tokens - estimated_tokens)
+            self._condition.notify_all()
+
+    def release(self, estimated_tokens):
+        """
+        调用在产生用量之前被取消时，退还预扣的请求和 token 配额。
+        """
+        with self._condition:
+            if self.request_bucket:
+                self.request_bucket.adjust(-1)
+            if self.token_bucket:
+                self.token_bucket.adjust(-estimated_tokens)
+            self._condition.notify_all()
+
+    def queue_depth(self):
+        """
+        正在排队等待配额的请求数。
+        """
+        with self._condition:
+            return sum(len(tickets) for tickets in self._queues.values())
+
+    def pause(self, seconds):
+        """
+        服务端返回 429 时暂停发放配额，避免排队的请求继续撞上限流。
+        """
+        with self._condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(engine, api_key):
+    """
+    获取某个引擎下某个API Key的限流器，配额取自 ENGINE_CONFIG 中该引擎的 rate_limit。
+    没有配置 rate_limit 的引擎不限流。
+    """
+    key = (engine, hash_api_key(api_key))
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            rate_limit = ENGINE_CONFIG.get('engines', {}).get(engine, {}).get('rate_limit', {})
+            limiter = RateLimiter(key, rpm=rate_limit.get('rpm'), tpm=rate_limit.get('tpm'))
+            _rate_limiters[key] = limiter
+        return limiter
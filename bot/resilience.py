@@ -0,0 +1,314 @@
+# *-* coding:utf-8 *-*
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import httpx
+import requests
+
+from bot.cancellation import CallCancelledError
+from config import (
+    LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY,
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT, CIRCUIT_BREAKER_PROBE_TIMEOUT
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+class UpstreamError(Exception):
+    """
+    直接发送HTTP请求的引擎返回了错误状态码。
+    """
+
+    def __init__(self, status_code, message, retry_after=None):
+        super().__init__(f"HTTP {status_code}: {message}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """
+    熔断器处于打开状态，请求被直接拒绝。
+    """
+
+    def __init__(self, key, remaining):
+        super().__init__(f"服务暂时不可用，已熔断，约 {int(remaining) + 1} 秒后重试")
+        self.key = key
+        self.remaining = remaining
+
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 头，支持秒数和HTTP日期两种格式，返回需要等待的秒数。
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error):
+    """
+    判断一次调用失败的性质。
+
+    返回:
+        (retryable, retry_after, is_outage)
+        retryable: 是否值得重试（429、5xx、超时、连接失败）
+        retry_after: 服务端要求的等待秒数，没有则为 None
+        is_outage: 是否说明服务端不可用（5xx、超时、连接失败），用于熔断计数；429只说明限流，不计入
+    """
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is None:
+            headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+            retry_after = parse_retry_after(headers.get('retry-after'))
+        if status_code == 429:
+            return True, retry_after, False
+        if status_code >= 500:
+            return True, retry_after, True
+        return False, None, False
+
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, httpx.TimeoutException, httpx.TransportError)):
+        return True, None, True
+    # openai 和 zhipuai SDK 的超时、连接错误，按类名判断，避免在这里导入SDK
+    if any(cls.__name__ in ('APITimeoutError', 'APIConnectionError') for cls in type(error).__mro__):
+        return True, None, True
+    return False, None, False
+
+
+class RetryPolicy:
+    """
+    带抖动的指数退避重试策略。
+    """
+
+    def __init__(self, max_retries=LLM_MAX_RETRIES, base_delay=LLM_RETRY_BASE_DELAY, max_delay=LLM_RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt, retry_after=None):
+        # 服务端给出 Retry-After 时优先遵守，但不超过 max_delay
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # full jitter：在 [0, base * 2^attempt] 之间随机等待，避免大量请求同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    单个 (engine, base_url) 的熔断器。
+
+    连续失败达到阈值后打开，打开期间直接拒绝请求；
+    经过 reset_timeout 秒后进入半开状态，只放行一个试探请求，成功则关闭，失败则重新打开。
+    试探请求超过 probe_timeout 秒还没有结果（调用方没有记录结果就退出了）时，放行下一个试探请求。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, key, failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_BREAKER_RESET_TIMEOUT,
+                 probe_timeout=CIRCUIT_BREAKER_PROBE_TIMEOUT):
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_started_at = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """
+        熔断中且还没到试探时间，此时发出的请求会被直接拒绝。
+        """
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                if now - self.probe_started_at < self.probe_timeout:
+                    raise CircuitOpenError(self.key, self.probe_timeout - (now - self.probe_started_at))
+                LOGGER.warning(f"[CircuitBreaker] {self.key} 试探请求 {self.probe_timeout} 秒没有结果，放行新的试探请求")
+                self.probe_started_at = now
+                return
+            elapsed = now - self.opened_at
+            if elapsed >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_started_at = now
+                LOGGER.info(f"[CircuitBreaker] {self.key} 进入半开状态，放行一个试探请求")
+                return
+            raise CircuitOpenError(self.key, self.reset_timeout - elapsed)
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                LOGGER.info(f"[CircuitBreaker] {self.key} 恢复正常")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    LOGGER.warning(f"[CircuitBreaker] {self.key} 连续失败 {self.failures} 次，熔断 {self.reset_timeout} 秒")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_cancel(self):
+        """
+        调用没有得到能说明服务端状态的结果（被取消、被中断、请求发出前就失败）。
+        是半开状态的试探请求时，允许下一个请求立即重新试探。
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic() - self.reset_timeout
+
+    def record_error(self, error):
+        """
+        根据错误性质更新熔断器：服务端不可用时计为失败；返回了4xx说明服务端在正常响应，计为成功；
+        其他错误（排队等待限流配额超时、参数错误等，请求可能根本没有发出）不说明服务端的状态，按取消处理。
+        """
+        _, _, is_outage = classify_error(error)
+        if is_outage:
+            self.record_failure()
+        elif getattr(error, 'status_code', None) is not None:
+            self.record_success()
+        else:
+            self.record_cancel()
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(engine, base_url):
+    key = (engine, base_url or '')
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(key)
+            _circuit_breakers[key] = breaker
+        return breaker
+
+
+def call_with_retry(fn, breaker, policy=None, on_retry=None, cancel_token=None):
+    """
+    在熔断器保护下调用 fn，遇到可重试的错误时按退避策略重试。
+    on_retry(attempt, error, delay) 会在每次重试前被调用。
+    传入 cancel_token 时，取消后不再重试，退避等待也会提前结束，抛出 CallCancelledError。
+    """
+    policy = policy or RetryPolicy()
+    attempt = 0
+    while True:
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        breaker.before_call()
+        # 在 finally 中释放还没有结果的调用：被取消或被 BaseException 中断时，不能让半开状态的试探请求一直占着
+        recorded = False
+        try:
+            result = fn()
+            recorded = True
+            breaker.record_success()
+            return result
+        except Exception as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                # 取消时连接被主动关闭，产生的连接错误不计入熔断
+                raise CallCancelledError() from e
+            recorded = True
+            breaker.record_error(e)
+            retryable, retry_after, _ = classify_error(e)
+            if not retryable or attempt >= policy.max_retries:
+                raise
+            delay = policy.get_delay(attempt, retry_after)
+            attempt += 1
+            LOGGER.warning(f"[Retry] {breaker.key} 第 {attempt} 次重试，等待 {delay:.1f}s，原因: {str(e)}")
+            if on_retry:
+                on_retry(attempt, e, delay)
+            if cancel_token is not None:
+                cancel_token.wait(delay)
+            else:
+                time.sleep(delay)
+            continue
+        finally:
+            if not recorded:
+                breaker.record_cancel()
+
+
+# 异步调用检查取消标记的间隔（秒）：CancelToken 基于线程事件，事件循环中只能轮询
+CANCEL_POLL_INTERVAL = 0.1
+
+
+async def _await_cancellable(awaitable, cancel_token):
+    """
+    等待 awaitable 完成，期间被取消时取消它并抛出 CallCancelledError。
+    """
+    if cancel_token is None:
+        return await awaitable
+    task = asyncio.ensure_future(awaitable)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=CANCEL_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if cancel_token.cancelled:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise CallCancelledError()
+
+
+async def call_with_retry_async(fn, breaker, policy=None, on_retry=None, cancel_token=None):
+    """
+    call_with_retry 的异步版本，fn 是返回协程的无参函数。
+    传入 cancel_token 时，取消后正在进行的调用和退避等待都会被中断，抛出 CallCancelledError。
+    """
+    policy = policy or RetryPolicy()
+    attempt = 0
+    while True:
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        breaker.before_call()
+        # 协程被取消（asyncio.CancelledError 不是 Exception）时也在 finally 中释放试探请求
+        recorded = False
+        try:
+            result = await _await_cancellable(fn(), cancel_token)
+            recorded = True
+            breaker.record_success()
+            return result
+        except Exception as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                # 取消时连接被主动关闭，产生的连接错误不计入熔断
+                if isinstance(e, CallCancelledError):
+                    raise
+                raise CallCancelledError() from e
+            recorded = True
+            breaker.record_error(e)
+            retryable, retry_after, _ = classify_error(e)
+            if not retryable or attempt >= policy.max_retries:
+                raise
+            delay = policy.get_delay(attempt, retry_after)
+            attempt += 1
+            LOGGER.warning(f"[Retry] {breaker.key} 第 {attempt} 次重试，等待 {delay:.1f}s，原因: {str(e)}")
+            if on_retry:
+                on_retry(attempt, e, delay)
+            await _await_cancellable(asyncio.sleep(delay), cancel_token)
+            continue
+        finally:
+            if not recorded:
+                breaker.record_cancel()
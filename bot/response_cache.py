@@ -0,0 +1,166 @@
+# *-* coding:utf-8 *-*
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from utils.crypto_utils import encrypt_data, decrypt_data
+from config import RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_DIR, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DISK_MAX_BYTES
+
+LOGGER = logging.getLogger(__name__)
+
+
+# 磁盘缓存超出上限时，删除最久没有使用的文件，直到总大小降到上限的这个比例以下
+DISK_EVICT_RATIO = 0.9
+
+
+def make_cache_key(engine, base_url, model, params, system_prompt, messages):
+    """
+    按 (引擎, 接口地址, 模型, 生成参数, 实际生效的系统提示词, 裁剪后的消息列表) 计算缓存键。
+    引擎和模型名相同但接口地址或参数不同的Bot，回复可能不同，不能共用缓存。
+    """
+    raw = json.dumps([engine, base_url, model, params, system_prompt, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    大模型回复的精确匹配缓存，只用于结果确定的调用（temperature 为 0 的Bot，或开启了缓存的Bot）。
+
+    - 内存层：按最近使用顺序淘汰，总大小不超过 max_bytes
+    - 磁盘层：每条回复一个文件，用 utils.crypto_utils 加密，超过 ttl 秒的条目视为过期；
+      总大小超过 disk_max_bytes 时按最近使用时间（文件修改时间）淘汰
+    读取时先查内存，内存未命中再查磁盘，磁盘命中的条目会放回内存。
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES, cache_dir=RESPONSE_CACHE_DIR, ttl=RESPONSE_CACHE_TTL,
+                 disk_max_bytes=RESPONSE_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.disk_max_bytes = disk_max_bytes
+        # 磁盘缓存的总大小，第一次写入时扫描目录得到，之后按写入的文件大小累加
+        self._disk_size = None
+        self._disk_lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> {'content': ..., 'created_at': ..., 'size': ...}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _file_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.encrypt")
+
+    def _put_memory(self, key, content, created_at):
+        size = len(content.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry:
+                self._size -= old_entry['size']
+            self._entries[key] = {'content': content, 'created_at': created_at, 'size': size}
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted['size']
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry['created_at'] > self.ttl:
+                self._entries.pop(key)
+                self._size -= entry['size']
+                return None
+            self._entries.move_to_end(key)
+            return entry['content']
+
+    def _get_disk(self, key):
+        file_path = self._file_path(key)
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with open(file_path, 'r') as f:
+                data = json.loads(decrypt_data(f.read()))
+            if time.time() - data['created_at'] > self.ttl:
+                os.remove(file_path)
+                return None
+            # 更新修改时间，磁盘缓存按最近使用时间淘汰
+            os.utime(file_path)
+            self._put_memory(key, data['content'], data['created_at'])
+            return data['content']
+        except Exception as e:
+            LOGGER.warning(f"[ResponseCache] 读取缓存文件出错: {str(e)}")
+            return None
+
+    def get(self, key):
+        content = self._get_memory(key)
+        if content is None:
+            content = self._get_disk(key)
+        return content
+
+    def _scan_disk(self):
+        """
+        返回磁盘缓存文件的 [(修改时间, 大小, 路径)]。
+        """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.encrypt'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _evict_disk(self, written_size):
+        """
+        累加新写入的文件大小，超过 disk_max_bytes 时删除最久没有使用的文件。
+        """
+        with self._disk_lock:
+            if self._disk_size is None:
+                self._disk_size = sum(size for _, size, _ in self._scan_disk())
+            else:
+                self._disk_size += written_size
+            if self._disk_size <= self.disk_max_bytes:
+                return
+            files = sorted(self._scan_disk())
+            self._disk_size = sum(size for _, size, _ in files)
+            removed = 0
+            for _, size, path in files:
+                if self._disk_size <= self.disk_max_bytes * DISK_EVICT_RATIO:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._disk_size -= size
+                removed += 1
+            LOGGER.info(f"[ResponseCache] 磁盘缓存超出 {self.disk_max_bytes} 字节，删除了 {removed} 个最久没有使用的文件")
+
+    def set(self, key, content):
+        if not content:
+            return
+        created_at = time.time()
+        self._put_memory(key, content, created_at)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            file_path = self._file_path(key)
+            # 先写临时文件再替换，避免并发读到写了一半的文件
+            tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+            encrypted = encrypt_data(json.dumps({'content': content, 'created_at': created_at}))
+            with open(tmp_path, 'w') as f:
+                f.write(encrypted)
+            os.replace(tmp_path, file_path)
+            self._evict_disk(len(encrypted))
+        except Exception as e:
+            LOGGER.warning(f"[ResponseCache] 写入缓存文件出错: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+# 创建全局回复缓存实例
+response_cache = ResponseCache()
@@ -0,0 +1,640 @@
+# *-* coding:utf-8 *-*
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+
+from utils.crypto_utils import encrypt_data, decrypt_data
+from config import USER_CONFIG_BASEDIR, SESSION_LOG_COMPACT_RECORDS, SESSION_STORAGE_BACKEND, SESSION_DB_PATH
+
+LOGGER = logging.getLogger(__name__)
+
+# 私聊话题和群聊话题在快照中对应的字段，以及话题中保存消息的字段
+VERSION_KINDS = {
+    'private': ('history_versions', 'histories'),
+    'group': ('group_history_versions', 'group_history'),
+}
+# 增量记录的类型对应的话题类型
+RECORD_KINDS = {'message': 'private', 'group_message': 'group'}
+# 话题索引的字段：私聊话题按Bot保存消息数（message_counts），群聊话题保存消息数和发言的Bot（message_count、bot_ids）
+# 话题的消息按需加载，没有加载的话题只有索引，没有 histories / group_history 字段
+INDEX_FIELDS = ('message_counts', 'message_count', 'bot_ids')
+
+
+def topic_key(version, position):
+    """
+    话题在存储中的键：话题的 timestamp，旧数据没有 timestamp 时使用位置。
+    """
+    return version.get('timestamp') or str(position)
+
+
+def is_topic_loaded(kind, version):
+    return VERSION_KINDS[kind][1] in version
+
+
+def topic_message_count(kind, version):
+    messages_key = VERSION_KINDS[kind][1]
+    if messages_key in version:
+        if kind == 'private':
+            return sum(len(history) for history in version[messages_key].values())
+        return len(version[messages_key])
+    if kind == 'private':
+        return sum(version.get('message_counts', {}).values())
+    return version.get('message_count', 0)
+
+
+def topic_bot_ids(kind, version):
+    """
+    参与话题的Bot：私聊话题中的全部Bot（包括还没有消息的），群聊话题中发过言的Bot。
+    """
+    messages_key = VERSION_KINDS[kind][1]
+    if messages_key in version:
+        if kind == 'private':
+            return list(version[messages_key].keys())
+        return sorted({message['bot_id'] for message in version[messages_key] if message.get('bot_id')})
+    if kind == 'private':
+        return list(version.get('message_counts', {}).keys())
+    return version.get('bot_ids', [])
+
+
+def update_topic_index(kind, version):
+    """
+    用已加载的消息更新话题的索引字段，没有加载的话题保持不变。
+    """
+    messages_key = VERSION_KINDS[kind][1]
+    if messages_key in version:
+        if kind == 'private':
+            version['message_counts'] = {bot_id: len(history) for bot_id, history in version[messages_key].items()}
+        else:
+            version['message_count'] = len(version[messages_key])
+            version['bot_ids'] = topic_bot_ids(kind, version)
+    return version
+
+
+def strip_topic_body(kind, version):
+    """
+    返回不含消息的话题索引。
+    """
+    messages_key = VERSION_KINDS[kind][1]
+    return {key: value for key, value in update_topic_index(kind, version).items() if key != messages_key}
+
+
+def find_version(versions, timestamp, index):
+    """
+    按 timestamp 定位话题，找不到时按位置定位。
+    """
+    for version in versions:
+        if version.get('timestamp') == timestamp:
+            return version
+    if 0 <= index < len(versions):
+        return versions[index]
+    return None
+
+
+def apply_log_record(data, record):
+    """
+    把一条增量记录（新消息）应用到快照数据上。话题的消息已加载时追加消息，没有加载时只更新话题索引。
+    """
+    kind = RECORD_KINDS.get(record.get('op'))
+    if kind is None:
+        LOGGER.warning(f"未知的增量记录类型: {record.get('op')}")
+        return
+    versions_key, messages_key = VERSION_KINDS[kind]
+    version = find_version(data.get(versions_key, []), record['version'], record['index'])
+    if version is None:
+        return
+    if messages_key not in version:
+        if kind == 'private':
+            counts = version.setdefault('message_counts', {})
+            counts[record['bot_id']] = counts.get(record['bot_id'], 0) + 1
+        else:
+            version['message_count'] = version.get('message_count', 0) + 1
+            bot_id = record['message'].get('bot_id')
+            if bot_id and bot_id not in version.setdefault('bot_ids', []):
+                version['bot_ids'] = sorted(version['bot_ids'] + [bot_id])
+    elif kind == 'private':
+        version[messages_key].setdefault(record['bot_id'], []).append(record['message'])
+    else:
+        version[messages_key].append(record['message'])
+
+
+class EncryptedFileStorage:
+    """
+    用户数据的加密文件存储。
+
+    - {username}.encrypt 保存快照：Bot、设置和话题索引（名称、时间、消息数、参与的Bot），不含消息
+    - {username}.topics/ 每个话题的消息单独保存为一个加密文件，选中话题时才读取
+    - {username}.log 逐行追加新消息等增量记录，每行单独加密，新增一条消息只需写入这条消息
+    - 增量记录达到 SESSION_LOG_COMPACT_RECORDS 条时由调用方重写快照，快照写入后清空日志（压缩）
+
+    每条增量记录带有递增的序号，快照和话题文件中保存已经包含的最大序号 log_seq。
+    写完快照、清空日志之前进程退出时，重新加载会跳过已经包含的记录，不会重复。
+    旧格式的快照中直接包含所有话题的消息，加载后由调用方重写一次快照，把消息拆分到话题文件中。
+
+    快照和日志文件的修改时间、大小作为数据的版本，用于判断其他进程或会话是否修改过数据。
+    同一个用户的所有会话共用一个实例（见 get_session_storage），读写都在 _lock 中进行。
+    """
+
+    def __init__(self, username, basedir=USER_CONFIG_BASEDIR):
+        self.snapshot_path = os.path.join(basedir, f"{username}.encrypt")
+        self.log_path = os.path.join(basedir, f"{username}.log")
+        self.topics_dir = os.path.join(basedir, f"{username}.topics")
+        self.seq = 0
+        self.log_records = 0
+        self._lock = threading.RLock()
+        # 快照之后追加的增量记录，按话题分组，读取话题时应用到话题文件的内容上
+        self.topic_records = {}
+        # 话题文件内容的摘要，内容没有变化的话题重写快照时不再写入
+        self.topic_digests = {}
+        # 快照中已有的话题，重写快照时删除已经不存在的话题的文件
+        self.topic_keys = set()
+        self.legacy = False
+
+    def state_version(self):
+        versions = []
+        for path in (self.snapshot_path, self.log_path):
+            try:
+                stat = os.stat(path)
+                versions.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                versions.append(None)
+        return tuple(versions)
+
+    def _topic_path(self, kind, key):
+        name = hashlib.md5(f"{kind}:{key}".encode('utf-8')).hexdigest()
+        return os.path.join(self.topics_dir, f"{name}.encrypt")
+
+    def load(self):
+        """
+        返回 (快照数据, 快照之后的增量记录列表)。没有快照时快照数据为 None。
+        快照数据中的话题只有索引，消息由 load_topic 按需读取；旧格式的快照中话题包含消息。
+        """
+        with self._lock:
+            return self._load()
+
+    def _load(self):
+        data = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                data = json.loads(decrypt_data(f.read()))
+        self.seq = (data or {}).get('log_seq', 0)
+
+        self.topic_keys = set()
+        self.legacy = False
+        for kind, (versions_key, messages_key) in VERSION_KINDS.items():
+            for position, version in enumerate((data or {}).get(versions_key, [])):
+                self.topic_keys.add((kind, topic_key(version, position)))
+                if messages_key in version:
+                    self.legacy = True
+
+        records = []
+        self.log_records = 0
+        self.topic_records = {}
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                for line_number, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(decrypt_data(line))
+                    except Exception as e:
+                        # 写入中途断电等原因产生的残缺行，跳过后继续读取
+                        LOGGER.warning(f"[SessionStorage] 跳过无法解析的增量记录 {self.log_path}:{line_number}: {str(e)}")
+                        continue
+                    self.log_records += 1
+                    if record.get('seq', 0) <= self.seq:
+                        continue
+                    self.seq = record['seq']
+                    records.append(record)
+                    self._add_topic_record(record)
+        return data, records
+
+    def _add_topic_record(self, record):
+        key = (RECORD_KINDS.get(record.get('op')), record['version'] or str(record['index']))
+        self.topic_records.setdefault(key, []).append(record)
+
+    def load_topic(self, kind, key):
+        """
+        读取一个话题的消息：话题文件的内容加上快照之后追加的新消息。
+        私聊话题返回 {bot_id: [消息]}，群聊话题返回 [消息]。
+        """
+        with self._lock:
+            return self._load_topic(kind, key)
+
+    def _load_topic(self, kind, key):
+        messages, log_seq = ({} if kind == 'private' else []), 0
+        path = self._topic_path(kind, key)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                topic = json.loads(decrypt_data(f.read()))
+            messages, log_seq = topic['messages'], topic.get('log_seq', 0)
+            self.topic_digests[(kind, key)] = self._digest(messages)
+        for record in self.topic_records.get((kind, key), []):
+            if record.get('seq', 0) <= log_seq:
+                continue
+            if kind == 'private':
+                messages.setdefault(record['bot_id'], []).append(record['message'])
+            else:
+                messages.append(record['message'])
+        return messages
+
+    @staticmethod
+    def _digest(messages):
+        return hashlib.md5(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _write_topic(self, kind, key, messages):
+        digest = self._digest(messages)
+        if self.topic_digests.get((kind, key)) == digest:
+            return
+        os.makedirs(self.topics_dir, exist_ok=True)
+        path = self._topic_path(kind, key)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(encrypt_data(json.dumps({'messages': messages, 'log_seq': self.seq})))
+        os.replace(temp_path, path)
+        self.topic_digests[(kind, key)] = digest
+
+    def save_snapshot(self, data):
+        """
+        写入快照并清空增量日志。先写临时文件再替换，写入中途出错时原快照不受影响。
+
+        已加载的话题内容有变化时重写话题文件；没有加载但有新消息的话题，读取后合并新消息再写入。
+        话题文件都写完之后才替换快照，已经删除的话题的文件在快照替换之后删除。
+        返回写入前后的数据版本 (previous, current)。
+        """
+        with self._lock:
+            previous = self.state_version()
+            self._save_snapshot(data)
+            return previous, self.state_version()
+
+    def _save_snapshot(self, data):
+        index = dict(data, log_seq=self.seq)
+        topic_keys = set()
+        for kind, (versions_key, messages_key) in VERSION_KINDS.items():
+            versions = []
+            for position, version in enumerate(data.get(versions_key, [])):
+                key = topic_key(version, position)
+                topic_keys.add((kind, key))
+                if messages_key in version:
+                    self._write_topic(kind, key, version[messages_key])
+                elif self.topic_records.get((kind, key)):
+                    self._write_topic(kind, key, self._load_topic(kind, key))
+                versions.append(strip_topic_body(kind, version))
+            index[versions_key] = versions
+
+        encrypted_data = encrypt_data(json.dumps(index))
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(encrypted_data)
+        os.replace(temp_path, self.snapshot_path)
+        if self.log_records or os.path.exists(self.log_path):
+            open(self.log_path, 'w').close()
+        self.log_records = 0
+        self.topic_records = {}
+        self.legacy = False
+
+        for kind, key in self.topic_keys - topic_keys:
+            self.topic_digests.pop((kind, key), None)
+            path = self._topic_path(kind, key)
+            if os.path.exists(path):
+                os.remove(path)
+        self.topic_keys = topic_keys
+
+    def append(self, records):
+        """
+        把增量记录逐行加密后追加到日志末尾，返回写入前后的数据版本 (previous, current)。
+        """
+        with self._lock:
+            previous = self.state_version()
+            lines = []
+            for record in records:
+                self.seq += 1
+                record = dict(record, seq=self.seq)
+                lines.append(encrypt_data(json.dumps(record)) + '\n')
+                self._add_topic_record(record)
+            with open(self.log_path, 'a') as f:
+                f.write(''.join(lines))
+            self.log_records += len(lines)
+            return previous, self.state_version()
+
+    def needs_compaction(self):
+        # 旧格式的快照需要重写一次，把消息拆分到话题文件中
+        return self.legacy or self.log_records >= SESSION_LOG_COMPACT_RECORDS
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_state (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_revisions (
+    username TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS bots (
+    username TEXT NOT NULL,
+    bot_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (username, bot_id)
+);
+CREATE TABLE IF NOT EXISTS history_versions (
+    username TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    version TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    bot_ids TEXT NOT NULL DEFAULT '[]',
+    data TEXT NOT NULL,
+    PRIMARY KEY (username, kind, version)
+);
+CREATE INDEX IF NOT EXISTS idx_history_versions_position ON history_versions (username, kind, position);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    version TEXT NOT NULL,
+    bot_id TEXT NOT NULL DEFAULT '',
+    timestamp TEXT,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_version ON messages (username, kind, version, bot_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (username, timestamp);
+"""
+
+
+class SQLiteStorage:
+    """
+    用户数据的 SQLite 存储，与 EncryptedFileStorage 的接口相同。
+
+    - user_state: 聊天设置、当前话题等，每个用户一行
+    - bots: 每个Bot一行
+    - history_versions: 每个话题一行（私聊 kind=private，群聊 kind=group），以话题的 timestamp 为键，
+      行中保存话题名称、摘要等信息以及消息数和参与的Bot，不含消息本身
+    - messages: 每条消息一行，按用户、话题、bot_id 和时间建立索引
+    - user_revisions: 每个用户的修订号，每次写入时递增，用于判断进程内缓存的数据是否过期
+
+    Bot配置、话题信息和消息内容都逐行加密。新消息直接插入一行；
+    保存快照时只重写内容与数据库中不一致的话题（删除、修改过消息的话题），其余话题的消息不会重新加密和写入。
+    话题内容是否一致按摘要判断：load_topic 读取时计算，append 插入新消息时在原摘要上更新，没有摘要的话题直接重写。
+    加载时只读取话题索引，话题的消息由 load_topic 按需读取。
+    """
+
+    _schema_lock = threading.Lock()
+    _schema_ready = set()
+
+    def __init__(self, username, db_path=SESSION_DB_PATH):
+        self.username = username
+        self.db_path = db_path
+        self.topic_digests = {}     # (kind, 话题键) -> 数据库中这个话题的消息摘要
+        self._lock = threading.RLock()
+        self._ensure_schema()
+
+    @staticmethod
+    def _chain_digest(digest, message):
+        return hashlib.md5((digest + json.dumps(message, sort_keys=True)).encode('utf-8')).hexdigest()
+
+    def _topic_digest(self, kind, messages):
+        """
+        话题消息的摘要 {bot_id: 摘要}：每个Bot的消息按顺序链式计算，追加消息时可以直接在原摘要上更新。
+        没有消息的Bot在数据库中没有记录，不参与计算。
+        """
+        histories = messages if kind == 'private' else {'': messages}
+        digests = {}
+        for bot_id, history in histories.items():
+            digest = ''
+            for message in history:
+                digest = self._chain_digest(digest, message)
+            if history:
+                digests[bot_id] = digest
+        return digests
+
+    def _get_revision(self, conn):
+        row = conn.execute('SELECT revision FROM user_revisions WHERE username = ?', (self.username,)).fetchone()
+        return row[0] if row else 0
+
+    # 每次写入时递增用户的修订号，与写入在同一个事务中，返回写入前后的修订号
+    def _bump_revision(self, conn):
+        previous = self._get_revision(conn)
+        conn.execute('INSERT INTO user_revisions (username, revision) VALUES (?, 1) '
+                     'ON CONFLICT(username) DO UPDATE SET revision = revision + 1', (self.username,))
+        return previous, self._get_revision(conn)
+
+    def state_version(self):
+        with closing(self._connect()) as conn:
+            return self._get_revision(conn)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        加锁后开启一个写事务。事务失败时清空话题摘要：摘要已经按没有提交的写入更新过，下次保存时重写已加载的话题。
+        """
+        with self._lock:
+            try:
+                with closing(self._connect()) as conn, conn:
+                    yield conn
+            except BaseException:
+                self.topic_digests = {}
+                raise
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _ensure_schema(self):
+        with self._schema_lock:
+            if self.db_path in self._schema_ready:
+                return
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with closing(self._connect()) as conn:
+                # WAL 模式下读写互不阻塞，多个会话可以同时读取
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(SQLITE_SCHEMA)
+            self._schema_ready.add(self.db_path)
+
+    def load(self):
+        """
+        返回 (状态, [])，格式与加密文件的快照相同，话题只有索引。数据库中没有这个用户时，导入原来的加密文件。
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT data FROM user_state WHERE username = ?', (self.username,)).fetchone()
+            if row is None:
+                return self._import_from_file()
+
+            data = json.loads(decrypt_data(row[0]))
+            data['bots'] = [
+                json.loads(decrypt_data(bot_data)) for (bot_data,) in
+                conn.execute('SELECT data FROM bots WHERE username = ? ORDER BY position', (self.username,))
+            ]
+            # 私聊话题按Bot统计消息数，只查询索引，不读取和解密消息
+            private_counts = {}
+            for version_key, bot_id, count in conn.execute(
+                    "SELECT version, bot_id, COUNT(*) FROM messages WHERE username = ? AND kind = 'private' GROUP BY version, bot_id",
+                    (self.username,)):
+                private_counts.setdefault(version_key, {})[bot_id] = count
+            for kind, (versions_key, messages_key) in VERSION_KINDS.items():
+                data[versions_key] = []
+                for version_key, message_count, bot_ids, version_data in conn.execute(
+                        'SELECT version, message_count, bot_ids, data FROM history_versions WHERE username = ? AND kind = ? ORDER BY position',
+                        (self.username, kind)):
+                    version = json.loads(decrypt_data(version_data))
+                    if kind == 'private':
+                        # 私聊话题中没有消息的Bot也要保留，用于判断哪些Bot参与了这个话题
+                        counts = private_counts.get(version_key, {})
+                        version['message_counts'] = {bot_id: counts.get(bot_id, 0) for bot_id in json.loads(bot_ids)}
+                    else:
+                        version['message_count'] = message_count
+                        version['bot_ids'] = json.loads(bot_ids)
+                    data[versions_key].append(version)
+        return data, []
+
+    def load_topic(self, kind, key):
+        """
+        读取一个话题的消息。私聊话题返回 {bot_id: [消息]}，群聊话题返回 [消息]。
+        """
+        messages = {} if kind == 'private' else []
+        with self._lock, closing(self._connect()) as conn:
+            for bot_id, body in conn.execute(
+                    'SELECT bot_id, body FROM messages WHERE username = ? AND kind = ? AND version = ? ORDER BY id',
+                    (self.username, kind, key)):
+                message = json.loads(decrypt_data(body))
+                if kind == 'private':
+                    messages.setdefault(bot_id, []).append(message)
+                else:
+                    messages.append(message)
+            self.topic_digests[(kind, key)] = self._topic_digest(kind, messages)
+        return messages
+
+    def _import_from_file(self):
+        file_storage = EncryptedFileStorage(self.username)
+        data, records = file_storage.load()
+        if data is None and not records:
+            return None, []
+        LOGGER.info(f"[SessionStorage] 把用户 {self.username} 的加密文件导入 SQLite")
+        data = data or {}
+        if file_storage.legacy:
+            for record in records:
+                apply_log_record(data, record)
+        else:
+            # 话题的消息保存在单独的文件中，读取时已经包含了增量记录
+            for kind, (versions_key, messages_key) in VERSION_KINDS.items():
+                for position, version in enumerate(data.get(versions_key, [])):
+                    version[messages_key] = file_storage.load_topic(kind, topic_key(version, position))
+        if data.get('history_versions') or data.get('group_history_versions') or data.get('bots'):
+            self.save_snapshot(data)
+        return data, []
+
+    def save_snapshot(self, data):
+        """
+        在一个事务中写入完整状态。内容与数据库一致的话题跳过，不重写它的消息。
+        返回写入前后的修订号 (previous, current)。
+        """
+        state = {key: value for key, value in data.items()
+                 if key not in ('bots', 'log_seq') and key not in (versions_key for versions_key, _ in VERSION_KINDS.values())}
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO user_state (username, data) VALUES (?, ?)',
+                         (self.username, encrypt_data(json.dumps(state))))
+            conn.execute('DELETE FROM bots WHERE username = ?', (self.username,))
+            conn.executemany('INSERT INTO bots (username, bot_id, position, data) VALUES (?, ?, ?, ?)', [
+                (self.username, bot['id'], position, encrypt_data(json.dumps(bot)))
+                for position, bot in enumerate(data.get('bots', []))
+            ])
+            for kind, (versions_key, messages_key) in VERSION_KINDS.items():
+                self._save_versions(conn, kind, messages_key, data.get(versions_key, []))
+            return self._bump_revision(conn)
+
+    def _save_versions(self, conn, kind, messages_key, versions):
+        saved_counts = dict(conn.execute(
+            'SELECT version, message_count FROM history_versions WHERE username = ? AND kind = ?', (self.username, kind)))
+        version_keys = []
+        for position, version in enumerate(versions):
+            version_key = topic_key(version, position)
+            if version_key in version_keys:
+                # 两个话题共用一个键时后一个话题的消息会写到前一个话题中，不能静默跳过
+                LOGGER.error(f"[SessionStorage] 用户 {self.username} 的话题键重复: {kind} {version_key}")
+                raise ValueError(f"话题键重复: {kind} {version_key}")
+            version_keys.append(version_key)
+            bot_ids = topic_bot_ids(kind, version)
+            meta = {key: value for key, value in version.items() if key != messages_key and key not in INDEX_FIELDS}
+            if not is_topic_loaded(kind, version):
+                # 没有加载的话题只更新话题信息，消息数以数据库为准
+                conn.execute(
+                    'INSERT OR REPLACE INTO history_versions (username, kind, version, position, message_count, bot_ids, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (self.username, kind, version_key, position, saved_counts.get(version_key, topic_message_count(kind, version)),
+                     json.dumps(bot_ids), encrypt_data(json.dumps(meta))))
+                continue
+            if kind == 'private':
+                messages = [(bot_id, message) for bot_id, history in version[messages_key].items() for message in history]
+            else:
+                messages = [('', message) for message in version[messages_key]]
+            conn.execute(
+                'INSERT OR REPLACE INTO history_versions (username, kind, version, position, message_count, bot_ids, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.username, kind, version_key, position, len(messages), json.dumps(bot_ids), encrypt_data(json.dumps(meta))))
+            digest = self._topic_digest(kind, version[messages_key])
+            if self.topic_digests.get((kind, version_key)) == digest:
+                continue
+            conn.execute('DELETE FROM messages WHERE username = ? AND kind = ? AND version = ?', (self.username, kind, version_key))
+            conn.executemany('INSERT INTO messages (username, kind, version, bot_id, timestamp, body) VALUES (?, ?, ?, ?, ?, ?)', [
+                (self.username, kind, version_key, bot_id, message.get('timestamp'), encrypt_data(json.dumps(message)))
+                for bot_id, message in messages
+            ])
+            self.topic_digests[(kind, version_key)] = digest
+
+        # 已经删除的话题
+        for version_key in set(saved_counts) - set(version_keys):
+            self.topic_digests.pop((kind, version_key), None)
+            conn.execute('DELETE FROM history_versions WHERE username = ? AND kind = ? AND version = ?', (self.username, kind, version_key))
+            conn.execute('DELETE FROM messages WHERE username = ? AND kind = ? AND version = ?', (self.username, kind, version_key))
+
+    def append(self, records):
+        """
+        每条新消息插入一行，同时更新所在话题的消息数和摘要。返回写入前后的修订号 (previous, current)。
+        """
+        with self._transaction() as conn:
+            for record in records:
+                kind = RECORD_KINDS[record['op']]
+                message = record['message']
+                version_key = record['version'] or str(record['index'])
+                digests = self.topic_digests.get((kind, version_key))
+                if digests is not None:
+                    bot_id = record.get('bot_id') or ''
+                    digests[bot_id] = self._chain_digest(digests.get(bot_id, ''), message)
+                conn.execute('INSERT INTO messages (username, kind, version, bot_id, timestamp, body) VALUES (?, ?, ?, ?, ?, ?)',
+                             (self.username, kind, version_key, record.get('bot_id') or '', message.get('timestamp'),
+                              encrypt_data(json.dumps(message))))
+                conn.execute('UPDATE history_versions SET message_count = message_count + 1 WHERE username = ? AND kind = ? AND version = ?',
+                             (self.username, kind, version_key))
+                # 第一次在话题中发言的Bot加入话题索引
+                bot_id = record.get('bot_id') or message.get('bot_id')
+                row = conn.execute('SELECT bot_ids FROM history_versions WHERE username = ? AND kind = ? AND version = ?',
+                                   (self.username, kind, version_key)).fetchone()
+                if bot_id and row and bot_id not in json.loads(row[0]):
+                    conn.execute('UPDATE history_versions SET bot_ids = ? WHERE username = ? AND kind = ? AND version = ?',
+                                 (json.dumps(json.loads(row[0]) + [bot_id]), self.username, kind, version_key))
+            return self._bump_revision(conn)
+
+    def needs_compaction(self):
+        return False
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_session_storage(username):
+    """
+    按 MULTIBOT_SESSION_STORAGE_BACKEND 获取用户数据的存储。
+    同一个用户的所有会话共用一个存储实例，进程内的写入按顺序进行，增量记录的序号不会冲突。
+    """
+    key = (SESSION_STORAGE_BACKEND, username)
+    with _storages_lock:
+        storage = _storages.get(key)
+        if storage is None:
+            storage = SQLiteStorage(username) if SESSION_STORAGE_BACKEND == 'sqlite' else EncryptedFileStorage(username)
+            _storages[key] = storage
+        return storage
@@ -0,0 +1,235 @@
+# *-* coding:utf-8 *-*
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+
+from bot.cancellation import CallCancelledError, CancelToken
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_flight_key(*parts):
+    """
+    把请求的全部要素序列化后计算摘要，作为合并请求的键。
+    """
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class RequestCancelledError(Exception):
+    """
+    合并的请求在得到结果之前被取消。非流式请求的等待方收到后重新发起请求。
+    """
+
+
+class _Call:
+    """
+    一次正在进行的上游请求。回复按增量保存在 chunks 中，等待方可以边到达边读取。
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        # 流式请求还在读取的调用方数量，以及上游请求使用的取消标记：所有调用方都离开后才取消上游请求
+        self.readers = 0
+        self.token = CancelToken()
+        self.condition = threading.Condition()
+
+    def append(self, chunk):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def iter_chunks(self, cancel_token=None):
+        """
+        等待方读取回复。传入 cancel_token 时分段等待，等待方被取消后立即退出，不影响发起方和其他等待方。
+        """
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.chunks) and not self.done:
+                    if cancel_token is None:
+                        self.condition.wait()
+                        continue
+                    if cancel_token.cancelled:
+                        raise CallCancelledError()
+                    self.condition.wait(0.5)
+                new_chunks = self.chunks[index:]
+                index = len(self.chunks)
+                done, error = self.done, self.error
+            yield from new_chunks
+            if done and index >= len(self.chunks):
+                if error is not None:
+                    raise error
+                return
+
+
+class _Reader:
+    """
+    流式请求的一个调用方。登记到调用方的取消标记上，调用方被取消时 close 被调用，只让这个调用方离开。
+    """
+
+    def __init__(self, flight, key, call):
+        self.flight = flight
+        self.key = key
+        self.call = call
+        self.closed = False
+
+    def close(self):
+        self.flight._detach(self)
+        # 唤醒正在等待增量的读取方，让它立即检查取消标记
+        with self.call.condition:
+            self.call.condition.notify_all()
+
+
+class SingleFlight:
+    """
+    合并同时发出的相同请求：同一个键同一时刻只有第一个调用方（leader）真正请求上游，
+    之后到达的调用方等待并共享它的结果，流式请求的增量也会同步转发给它们。
+    请求结束后立即移除，之后的相同请求重新发起（需要复用结果的场景由回复缓存负责）。
+    取消一个调用方只会让它离开，不影响其他调用方：流式请求在后台线程中继续，直到所有调用方都离开；
+    非流式请求的发起方被取消时，等待方中的一个重新发起请求。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                LOGGER.info(f"[SingleFlight] 合并相同请求，当前共享方 {call.waiters} 个")
+                return call, False
+            call = _Call()
+            self._calls[key] = call
+            return call, True
+
+    def _leave(self, key, call):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+
+    def stream(self, key, fn, cancel_token=None):
+        """
+        fn(cancel_token) 返回逐段产出文本的可迭代对象，上游请求需要使用传入的取消标记。返回 (生成器, 是否为leader)。
+        上游请求在后台线程中进行，发起方和等待方一样读取增量，任何一方被取消都只是停止读取。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+                LOGGER.info(f"[SingleFlight] 合并相同请求，当前共享方 {call.waiters} 个")
+            call.readers += 1
+        reader = _Reader(self, key, call)
+        if cancel_token is not None:
+            cancel_token.track(reader)
+        if leader:
+            threading.Thread(target=self._run_stream, args=(key, call, fn), name='single-flight', daemon=True).start()
+        return self._read_stream(reader, cancel_token), leader
+
+    def _run_stream(self, key, call, fn):
+        error = None
+        try:
+            for chunk in fn(call.token):
+                call.append(chunk)
+        except CallCancelledError:
+            error = RequestCancelledError("合并的请求已被所有调用方取消")
+        except Exception as e:
+            error = e
+        finally:
+            self._leave(key, call)
+            call.finish(error)
+
+    def _read_stream(self, reader, cancel_token):
+        try:
+            yield from reader.call.iter_chunks(cancel_token)
+        finally:
+            if cancel_token is not None:
+                cancel_token.untrack(reader)
+            self._detach(reader)
+
+    def _detach(self, reader):
+        """
+        调用方离开流式请求。最后一个调用方在请求结束前离开时，取消上游请求，关闭连接并退还限流配额。
+        """
+        call = reader.call
+        with self._lock:
+            if reader.closed:
+                return
+            reader.closed = True
+            call.readers -= 1
+            if call.readers > 0 or call.done:
+                return
+            if self._calls.get(reader.key) is call:
+                del self._calls[reader.key]
+        LOGGER.info("[SingleFlight] 所有调用方都已离开，取消上游请求")
+        call.token.cancel()
+
+    def do(self, key, fn, cancel_token=None):
+        """
+        fn 返回完整的回复文本。返回 (回复文本, 是否为leader)。
+        发起方被取消时等待方不会跟着失败，第一个重新加入的等待方成为新的发起方。
+        """
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return ''.join(call.iter_chunks(cancel_token)), False
+            except RequestCancelledError:
+                LOGGER.info("[SingleFlight] 合并的请求已被发起方取消，重新发起请求")
+        error = None
+        try:
+            result = fn()
+            call.append(result)
+            return result, True
+        except BaseException as e:
+            error = e if isinstance(e, Exception) and not isinstance(e, CallCancelledError) else RequestCancelledError("合并的请求已被发起方取消")
+            raise
+        finally:
+            self._leave(key, call)
+            call.finish(error)
+
+    async def do_async(self, key, coro_fn, cancel_token=None):
+        """
+        do 的异步版本，coro_fn 是返回协程的无参函数。等待方在线程中阻塞等待，不占用事件循环。
+        """
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return await asyncio.to_thread(lambda: ''.join(call.iter_chunks(cancel_token))), False
+            except RequestCancelledError:
+                LOGGER.info("[SingleFlight] 合并的请求已被发起方取消，重新发起请求")
+        error = None
+        try:
+            result = await coro_fn()
+            call.append(result)
+            return result, True
+        except BaseException as e:
+            error = e if isinstance(e, Exception) and not isinstance(e, CallCancelledError) else RequestCancelledError("合并的请求已被发起方取消")
+            raise
+        finally:
+            self._leave(key, call)
+            call.finish(error)
+
+
+# 创建全局请求合并实例
+single_flight = SingleFlight()
@@ -0,0 +1,169 @@
+# *-* coding:utf-8 *-*
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from bot.client_pool import client_pool, hash_api_key
+from bot.config import ENGINE_ADAPTERS
+from config import (
+    BASS_LLM_BASE_URL, BASS_LLM_API_KEY, BASS_LLM_MODEL, LLM_READ_TIMEOUT,
+    WARMUP_ENABLED, WARMUP_INTERVAL, WARMUP_TIMEOUT, OLLAMA_KEEP_ALIVE
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# 预热在后台线程中执行，不阻塞页面渲染
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='warmup')
+
+# 规划引擎（chat_pilot、web_search、上下文摘要）使用的接口，在连接池中的引擎名
+BASE_LLM_ENGINE = 'base_llm'
+
+OLLAMA_DEFAULT_PORT = 11434
+
+
+def get_base_llm_endpoint():
+    return {
+        'engine': BASE_LLM_ENGINE,
+        'adapter': 'openai',
+        'base_url': BASS_LLM_BASE_URL,
+        'api_key': BASS_LLM_API_KEY,
+        'model': BASS_LLM_MODEL,
+    }
+
+
+def get_bot_endpoint(bot):
+    """
+    按 ENGINE_ADAPTERS 解析Bot实际请求的接口地址和密钥，解析方式与 ChatRouter 相同。
+    """
+    adapter_config = ENGINE_ADAPTERS.get(bot.get('engine', ''), {})
+    base_url = adapter_config.get('base_url') or bot.get(adapter_config.get('base_url_field', ''), '')
+    if not adapter_config or not base_url:
+        return None
+    return {
+        'engine': bot['engine'],
+        'adapter': adapter_config['adapter'],
+        'base_url': base_url,
+        'api_key': bot.get(adapter_config.get('api_key_field', 'api_key'), ''),
+        'model': bot.get('model') or adapter_config.get('default_model'),
+    }
+
+
+def is_ollama_endpoint(endpoint):
+    """
+    Ollama 引擎，或者使用 Ollama 默认端口的接口（如默认的规划引擎）。
+    """
+    if endpoint['engine'] == 'Ollama':
+        return True
+    return urlparse(endpoint['base_url']).port == OLLAMA_DEFAULT_PORT
+
+
+class Warmer:
+    """
+    预先建立到大模型接口的连接，使第一条消息不再等待 DNS 解析、TCP/TLS 握手和本地模型加载。
+
+    - 兼容OpenAI接口的引擎通过连接池中的客户端请求一次模型列表，建立的长连接留在连接池中供之后的对话复用
+    - 直接发送HTTP请求的引擎（AzureOpenAI、CoZe、Qianfan）通过连接池中的会话发送一次 HEAD 请求
+    - 其余引擎只预先解析域名
+    - Ollama 接口额外发送一次不带 prompt 的生成请求，让模型加载到内存并保留 OLLAMA_KEEP_ALIVE
+    同一个接口 WARMUP_INTERVAL 秒内只预热一次，失败只记录日志，不影响正常对话。
+    """
+
+    def __init__(self, enabled=WARMUP_ENABLED, interval=WARMUP_INTERVAL):
+        self.enabled = enabled
+        self.interval = interval
+        self._last_warmed = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _should_warm(self, key):
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_warmed.get(key)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last_warmed[key] = now
+            return True
+
+    def warm_up_on_start(self):
+        """
+        进程启动后第一次运行页面时调用：预热规划引擎，并预先解析所有固定接口地址的域名。
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.warm_up([get_base_llm_endpoint()])
+        for adapter_config in ENGINE_ADAPTERS.values():
+            if adapter_config.get('base_url'):
+                _executor.submit(self._resolve, adapter_config['base_url'])
+
+    def warm_up_bots(self, bots):
+        """
+        每个会话登录后调用一次：预热这个用户所有Bot（包括未启用的，它们可能是备用Bot）用到的接口，以及规划引擎。
+        """
+        if not self.enabled:
+            return
+        endpoints = [get_base_llm_endpoint()]
+        endpoints += [endpoint for endpoint in map(get_bot_endpoint, bots or []) if endpoint]
+        self.warm_up(endpoints)
+
+    def warm_up(self, endpoints):
+        for endpoint in endpoints:
+            key = (endpoint['engine'], endpoint['base_url'], hash_api_key(endpoint['api_key']))
+            if self._should_warm(key):
+                _executor.submit(self._warm_connection, endpoint)
+            if is_ollama_endpoint(endpoint) and endpoint.get('model') and self._should_warm(key + (endpoint['model'],)):
+                _executor.submit(self._preload_ollama_model, endpoint)
+
+    def _resolve(self, base_url):
+        parsed = urlparse(base_url)
+        if not parsed.hostname:
+            return
+        try:
+            socket.getaddrinfo(parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80), proto=socket.IPPROTO_TCP)
+        except Exception as e:
+            LOGGER.debug(f"[Warmup] 解析域名 {parsed.hostname} 失败: {str(e)}")
+
+    def _warm_connection(self, endpoint):
+        engine, base_url = endpoint['engine'], endpoint['base_url']
+        start_time = time.monotonic()
+        try:
+            if endpoint['adapter'] == 'openai':
+                client = client_pool.get_openai_client(engine, base_url, endpoint['api_key'])
+                client.models.list(timeout=WARMUP_TIMEOUT)
+            elif endpoint['adapter'] in ('azure', 'coze', 'qianfan'):
+                session = client_pool.get_requests_session(engine, base_url)
+                session.head(base_url, timeout=WARMUP_TIMEOUT)
+            else:
+                self._resolve(base_url)
+                return
+            LOGGER.info(f"[Warmup] {engine} {base_url} 连接已预热，耗时 {time.monotonic() - start_time:.2f}s")
+        except Exception as e:
+            # 接口不支持模型列表或返回错误时，连接通常也已经建立，不需要处理
+            LOGGER.info(f"[Warmup] {engine} {base_url} 预热请求出错: {str(e)}")
+
+    def _preload_ollama_model(self, endpoint):
+        # Ollama 的原生接口在 /api 下，兼容OpenAI的接口在 /v1 下
+        root = endpoint['base_url'].rstrip('/')
+        if root.endswith('/v1'):
+            root = root[:-len('/v1')]
+        start_time = time.monotonic()
+        try:
+            session = client_pool.get_requests_session(endpoint['engine'], endpoint['base_url'])
+            response = session.post(f"{root}/api/generate", json={'model': endpoint['model'], 'keep_alive': OLLAMA_KEEP_ALIVE},
+                                    timeout=(WARMUP_TIMEOUT, LLM_READ_TIMEOUT))
+            if response.status_code < 400:
+                LOGGER.info(f"[Warmup] Ollama 模型 {endpoint['model']} 已加载，耗时 {time.monotonic() - start_time:.2f}s")
+            else:
+                LOGGER.info(f"[Warmup] Ollama 模型 {endpoint['model']} 加载失败: {response.status_code} {response.text[:200]}")
+        except Exception as e:
+            LOGGER.info(f"[Warmup] Ollama 模型 {endpoint['model']} 加载出错: {str(e)}")
+
+
+# 创建全局连接预热实例
+warmer = Warmer()
@@ -3,7 +3,7 @@ import tempfile
 import logging
 import string
 import random
-from bot.config import ENGINE_CONFIG
+from bot.config import ENGINE_CONFIG, apply_mock_base_url
 
 # token 的过期时间（以秒为单位）
 # 默认为 86400 秒（1天）
@@ -69,4 +69,125 @@ LOGGER = logging.getLogger(__name__)
 # 规划引擎所用模型，支持所有兼容OpenAI接口格式的引擎
 BASS_LLM_MODEL = os.getenv('MULTIBOT_BASE_LLM_MODEL', 'qwen2.5:3b')
 BASS_LLM_BASE_URL = os.getenv('MULTIBOT_BASE_LLM_BASE_URL', 'http://127.0.0.1:11434/v1')
-BASS_LLM_API_KEY = os.getenv('MULTIBOT_BASE_LLM_API_KEY', 'ollama')
\ No newline at end of file
+BASS_LLM_API_KEY = os.getenv('MULTIBOT_BASE_LLM_API_KEY', 'ollama')
+
+# 本地模拟大模型服务的地址（启动方式: python -m utils.mock_llm_server），如 http://127.0.0.1:8765
+# 设置后所有引擎和规划引擎都改为请求模拟服务，不再访问外网，用于离线压测和延迟测试
+MOCK_LLM_BASE_URL = os.getenv('MULTIBOT_MOCK_LLM_BASE_URL', '')
+if MOCK_LLM_BASE_URL:
+    apply_mock_base_url(MOCK_LLM_BASE_URL)
+    BASS_LLM_BASE_URL = f"{MOCK_LLM_BASE_URL.rstrip('/')}/base_llm/v1"
+
+# 大模型客户端连接池设置
+# 连接池最多缓存的客户端数量，超出时淘汰最久未使用的客户端
+CLIENT_POOL_MAX_SIZE = int(os.getenv('MULTIBOT_CLIENT_POOL_MAX_SIZE', 64))
+# 客户端空闲多少秒后关闭并移除
+CLIENT_POOL_IDLE_TIMEOUT = int(os.getenv('MULTIBOT_CLIENT_POOL_IDLE_TIMEOUT', 1800))
+# 每个客户端最多保持的连接数
+CLIENT_POOL_MAX_CONNECTIONS = int(os.getenv('MULTIBOT_CLIENT_POOL_MAX_CONNECTIONS', 20))
+# 空闲的长连接保持多少秒
+CLIENT_POOL_KEEPALIVE_EXPIRY = int(os.getenv('MULTIBOT_CLIENT_POOL_KEEPALIVE_EXPIRY', 300))
+
+# 调用大模型时的连接超时和读取超时（秒）
+LLM_CONNECT_TIMEOUT = float(os.getenv('MULTIBOT_LLM_CONNECT_TIMEOUT', 10))
+LLM_READ_TIMEOUT = float(os.getenv('MULTIBOT_LLM_READ_TIMEOUT', 120))
+
+# 对话模式下并发请求多个Bot时使用的最大线程数
+FAN_OUT_MAX_WORKERS = int(os.getenv('MULTIBOT_FAN_OUT_MAX_WORKERS', 32))
+# 单个Bot回复的超时时间（秒），超时的Bot不再等待
+BOT_RESPONSE_TIMEOUT = float(os.getenv('MULTIBOT_BOT_RESPONSE_TIMEOUT', 180))
+
+# 调用大模型失败时的重试设置（429、5xx、超时、连接失败时重试）
+LLM_MAX_RETRIES = int(os.getenv('MULTIBOT_LLM_MAX_RETRIES', 2))
+# 指数退避的基础等待时间和最长等待时间（秒），服务端返回的 Retry-After 也不会超过最长等待时间
+LLM_RETRY_BASE_DELAY = float(os.getenv('MULTIBOT_LLM_RETRY_BASE_DELAY', 1))
+LLM_RETRY_MAX_DELAY = float(os.getenv('MULTIBOT_LLM_RETRY_MAX_DELAY', 20))
+
+# 熔断设置：同一个接口地址连续失败多少次后熔断，熔断多少秒后放行试探请求
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv('MULTIBOT_CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.getenv('MULTIBOT_CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+# 半开状态的试探请求超过多少秒还没有结果时视为丢失，放行下一个试探请求
+CIRCUIT_BREAKER_PROBE_TIMEOUT = float(os.getenv('MULTIBOT_CIRCUIT_BREAKER_PROBE_TIMEOUT', 120))
+
+# 限流设置：同一个API Key的请求按 ENGINE_CONFIG 中的 rate_limit（每分钟请求数 rpm、每分钟 token 数 tpm）排队发送
+# 排队超过多少秒仍未轮到时放弃本次请求
+RATE_LIMIT_MAX_WAIT = float(os.getenv('MULTIBOT_RATE_LIMIT_MAX_WAIT', 60))
+
+# 大模型回复缓存设置（只缓存 temperature 为 0 或开启了缓存的Bot的回复）
+# 内存中缓存的回复总大小上限（字节）
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('MULTIBOT_RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# 磁盘缓存目录，缓存文件经过加密
+RESPONSE_CACHE_DIR = os.getenv('MULTIBOT_RESPONSE_CACHE_DIR', './response_cache')
+# 缓存有效期（秒）
+RESPONSE_CACHE_TTL = int(os.getenv('MULTIBOT_RESPONSE_CACHE_TTL', 7 * 24 * 3600))
+# 磁盘缓存的总大小上限（字节），超出时删除最久没有使用的缓存文件
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.getenv('MULTIBOT_RESPONSE_CACHE_DISK_MAX_BYTES', 256 * 1024 * 1024))
+
+# 上下文裁剪设置：按 token 预算裁剪时，ENGINE_CONFIG 中没有配置 context_budget 的引擎使用这个预算
+CONTEXT_TOKEN_BUDGET = int(os.getenv('MULTIBOT_CONTEXT_TOKEN_BUDGET', 6000))
+
+# 上下文摘要设置：生成摘要时为最新的对话保留的预算比例，其余预算留给摘要
+SUMMARY_KEEP_RATIO = float(os.getenv('MULTIBOT_SUMMARY_KEEP_RATIO', 0.5))
+
+# 调用指标设置：内存中保留最近多少次调用的指标，以及追加写入指标的文件（JSON Lines，留空则不写文件）
+METRICS_RING_SIZE = int(os.getenv('MULTIBOT_METRICS_RING_SIZE', 2000))
+METRICS_FILE = os.getenv('MULTIBOT_METRICS_FILE', './logs/llm_metrics.jsonl')
+
+# 对冲请求设置：主Bot超过其最近首字延迟的 p95 仍没有输出时向备用Bot发出请求
+HEDGE_MAX_WORKERS = int(os.getenv('MULTIBOT_HEDGE_MAX_WORKERS', 16))
+# 计算 p95 至少需要的样本数，样本不足时使用默认等待时间（秒）
+HEDGE_MIN_SAMPLES = int(os.getenv('MULTIBOT_HEDGE_MIN_SAMPLES', 5))
+HEDGE_DEFAULT_DELAY = float(os.getenv('MULTIBOT_HEDGE_DEFAULT_DELAY', 8))
+# 等待时间的下限（秒），避免主Bot很快时几乎每次都发出备用请求
+HEDGE_MIN_DELAY = float(os.getenv('MULTIBOT_HEDGE_MIN_DELAY', 1))
+
+# 连接预热设置：启动时和登录后在后台预先建立到各Bot接口地址的长连接，并把本地 Ollama 模型预先加载到内存
+WARMUP_ENABLED = os.getenv('MULTIBOT_WARMUP_ENABLED', 'True').lower() == 'true'
+# 同一个接口地址两次预热之间的最短间隔（秒），多个会话先后登录时不会重复预热
+WARMUP_INTERVAL = int(os.getenv('MULTIBOT_WARMUP_INTERVAL', 300))
+# 建立连接的预热请求的超时时间（秒），Ollama 加载模型不受此限制
+WARMUP_TIMEOUT = float(os.getenv('MULTIBOT_WARMUP_TIMEOUT', 10))
+# Ollama 模型预加载后在内存中保留的时间，格式同 Ollama 的 keep_alive 参数，如 30m、1h、-1（一直保留）
+OLLAMA_KEEP_ALIVE = os.getenv('MULTIBOT_OLLAMA_KEEP_ALIVE', '30m')
+
+# 冷启动导入耗时预算（毫秒）：python -m utils.import_report 统计登录页首屏需要导入的模块，总耗时超过预算时报告失败
+IMPORT_TIME_BUDGET_MS = int(os.getenv('MULTIBOT_IMPORT_TIME_BUDGET_MS', 1500))
+
+# Function calling 设置：Bot 在一轮对话中调用工具箱中的工具
+# 单个工具的执行超时时间（秒）
+FUNCTION_CALL_TIMEOUT = float(os.getenv('MULTIBOT_FUNCTION_CALL_TIMEOUT', 30))
+# 一轮对话中最多调用工具的轮数，达到后要求模型直接回答
+FUNCTION_CALL_MAX_ROUNDS = int(os.getenv('MULTIBOT_FUNCTION_CALL_MAX_ROUNDS', 3))
+# 工具返回的结果超过这个 token 数时截断后再发给模型
+FUNCTION_RESULT_MAX_TOKENS = int(os.getenv('MULTIBOT_FUNCTION_RESULT_MAX_TOKENS', 2000))
+
+# 图片输入设置：上传的图片先压缩后存入对话历史，发送时再按各引擎的限制缩放、重新编码
+# 存入历史的图片长边的最大像素数
+IMAGE_MAX_SIDE = int(os.getenv('MULTIBOT_IMAGE_MAX_SIDE', 2048))
+# 单张图片 base64 编码后的最大字节数，引擎没有单独设置时也使用这个限制
+IMAGE_MAX_BYTES = int(os.getenv('MULTIBOT_IMAGE_MAX_BYTES', 1024 * 1024))
+# 重新编码为 JPEG 时的初始质量，超出大小限制时逐步降低
+IMAGE_JPEG_QUALITY = int(os.getenv('MULTIBOT_IMAGE_JPEG_QUALITY', 85))
+# 缓存的已编码图片数量，历史消息中的图片每轮对话不必重新编码
+IMAGE_CACHE_SIZE = int(os.getenv('MULTIBOT_IMAGE_CACHE_SIZE', 64))
+
+# 自动路由设置：Bot设置了等价的Bot池时，每次调用按最近的延迟、错误率和排队深度选择其中一个
+# 延迟和错误率的指数加权平均系数，越大越看重最近的调用
+AUTO_ROUTE_EWMA_ALPHA = float(os.getenv('MULTIBOT_AUTO_ROUTE_EWMA_ALPHA', 0.3))
+# 每个Bot参与计算的最近调用数
+AUTO_ROUTE_WINDOW = int(os.getenv('MULTIBOT_AUTO_ROUTE_WINDOW', 50))
+# 样本少于这个数的Bot优先被选中，先积累统计数据
+AUTO_ROUTE_MIN_SAMPLES = int(os.getenv('MULTIBOT_AUTO_ROUTE_MIN_SAMPLES', 3))
+# 随机选择的概率，让变慢后又恢复的Bot有机会被重新测量
+AUTO_ROUTE_EXPLORE_RATE = float(os.getenv('MULTIBOT_AUTO_ROUTE_EXPLORE_RATE', 0.05))
+
+# 用户数据存储设置：新消息逐条追加到加密的增量日志中，不再每次重写整个用户文件
+# 增量日志中的记录达到这个数量时，重写完整快照并清空日志
+SESSION_LOG_COMPACT_RECORDS = int(os.getenv('MULTIBOT_SESSION_LOG_COMPACT_RECORDS', 200))
+# 用户数据的存储方式：file 为加密文件（快照加增量日志），sqlite 为 SQLite 数据库（按行加密）
+# 切换到 sqlite 后，用户第一次登录时自动导入原来的加密文件
+SESSION_STORAGE_BACKEND = os.getenv('MULTIBOT_SESSION_STORAGE_BACKEND', 'file').lower()
+# SQLite 数据库文件的路径
+SESSION_DB_PATH = os.getenv('MULTIBOT_SESSION_DB_PATH', os.path.join(USER_CONFIG_BASEDIR, 'sessions.db'))
+# 进程内缓存的会话管理器数量（每个浏览器会话一个），页面重跑时复用，存储中的数据没有变化时不重新读取和解密
+SESSION_CACHE_SIZE = int(os.getenv('MULTIBOT_SESSION_CACHE_SIZE', 256))
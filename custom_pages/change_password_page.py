@@ -1,5 +1,6 @@
 import streamlit as st
 from utils.user_manager import user_manager  # 确保这行导入存在
+from bot.bot_session_manager import session_manager_cache
 
 def change_password_page():
     st.title("修改密码")
@@ -23,6 +24,8 @@ def change_password_page():
             if new_password != confirm_password:
                 st.error("新密码和确认密码不匹配")
             elif user_manager.change_password(st.session_state.username, old_password, new_password):
+                # 其他会话（包括其他设备上）缓存的会话管理器不再保留在内存中
+                session_manager_cache.invalidate(st.session_state.username)
                 st.success("密码修改成功")
             else:
                 st.warning("旧密码错误")
@@ -7,6 +7,7 @@ from custom_pages.utils.sidebar import render_sidebar
 from custom_pages.utils.welcome_message import display_welcome_message
 from custom_pages.utils.bot_display import display_active_bots, display_inactive_bots
 from config import PRIVATE_CHAT_EMOJI
+from utils.image_utils import IMAGE_UPLOAD_TYPES, ImageError, normalize_image
 
 # def main_page():
 #     bot_manager = st.session_state.bot_manager
@@ -97,7 +98,16 @@ def main_page():
         col1, col2 = st.columns([9, 1], gap="small")
         
         with col1:
-            prompt = st.chat_input("按Enter发送消息，按Shift+Enter换行")
+            chat_value = st.chat_input("按Enter发送消息，按Shift+Enter换行，可以附带一张图片", accept_file=True, file_type=IMAGE_UPLOAD_TYPES)
+            prompt = chat_value.text if chat_value else None
+            image = None
+            if chat_value and chat_value.files:
+                # 图片上传后先压缩再存入历史记录，发送给各Bot时再按引擎的限制重新编码
+                try:
+                    image = normalize_image(chat_value.files[0].getvalue())
+                    prompt = prompt or "请描述这张图片"
+                except ImageError as e:
+                    st.warning(str(e))
             if prompt and not enabled_bots:
                 st.warning("请至少启用一个机器人，才能进行对话")
 
@@ -111,7 +121,7 @@ def main_page():
     with output_box:
 
         if enabled_bots:
-            display_active_bots(bot_manager=bot_manager, prompt=prompt, show_bots=enabled_bots)
+            display_active_bots(bot_manager=bot_manager, prompt=prompt, show_bots=enabled_bots, image=image)
             
         if bot_manager.is_current_history_empty():
             if st.session_state.bots:
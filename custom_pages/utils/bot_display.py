@@ -1,5 +1,6 @@
 import streamlit as st
-from utils.chat_utils import get_response_from_bot, get_response_from_bot_group, display_chat, display_group_chat
+from utils.chat_utils import get_responses_from_bots, get_response_from_bot_group, display_chat, display_group_chat, format_metrics
+from utils.session_utils import cancel_session_calls
 from custom_pages.utils.dialogs import edit_bot, add_new_bot
 from datetime import datetime, date
 import random
@@ -8,41 +9,69 @@ import importlib
 import os
 
 
+# 生成回复期间显示"停止生成"按钮。点击后 Streamlit 中断当前运行并重跑页面，
+# 回调在重跑开始时执行，取消这个会话还在进行中的调用；已经中断的回复不会存入历史记录
+def render_stop_button():
+    def stop_generation():
+        cancel_session_calls()
+        st.toast("已停止生成")
+
+    st.button("⏹ 停止生成", key="stop_generation", on_click=stop_generation)
+
 #  参数：bot_manager 是管理机器人的对象，prompt 是用户输入的提示信息，show_bots 是一个包含要显示的机器人信息的列表
-def display_active_bots(bot_manager, prompt, show_bots):
+#  image 是随 prompt 上传的图片（已压缩的 data URL），和 prompt 一起存入历史记录
+def display_active_bots(bot_manager, prompt, show_bots, image=None):
     num_bots = len(show_bots)       # 当前显示的bot数量
     num_cols = min(2, num_bots)     # 最多显示两列
     cols = st.columns(num_cols)     # 创建列对象
 
+    active_bots = [bot for bot in show_bots if bot['enable']]   # 如果机器人被禁用，则跳过
+    bot_boxes = {}
     for i, bot in enumerate(show_bots):
-        if not bot['enable']:       # 如果机器人被禁用，则跳过
+        if not bot['enable']:
             continue
         col = cols[i % num_cols]
-        with col:                   # 在当前列中创建两个子列：button_box 和 title_box，用于放置按钮和标题
+        with col:                   # 在当前列中创建两个子列：button_box 和 title_box，用于放置按钮和标题，下方的 chat_box 用于放置对话
             button_box, title_box = st.columns([1, 10], gap="small")
-            # 获取当前bot的历史记录
-            current_history = bot_manager.get_current_history_by_bot(bot)
-            
-            # 如果有用户输入的提示信息 prompt，则执行以下操作：
-            # 调用 get_response_from_bot 函数获取机器人的响应。
-            # 将用户的提示和机器人的响应添加到机器人的对话历史中。
-            # 调用 fix_history_names 方法修复历史记录中的名称问题。
-            # 更新当前机器人的对话历史记录
-            if prompt:
-                response_content = get_response_from_bot(prompt, bot, bot_manager.get_current_history_by_bot(bot))
-                bot_manager.add_message_to_history(bot['id'], {"role": "user", "content": prompt})
-                bot_manager.add_message_to_history(bot['id'], {"role": "assistant", "content": response_content})
-                bot_manager.fix_history_names(bot_manager.current_history_version_idx)
-                current_history = bot_manager.get_current_history_by_bot(bot)
-
-            if current_history:
+            bot_boxes[bot['id']] = (button_box, title_box, st.container())
+
+    # 如果有用户输入的提示信息 prompt，则执行以下操作：
+    # 把 prompt 并发发送给所有启用的机器人，每个机器人的回复到达时就显示在它自己的列中。
+    # 全部回复结束后，把用户的提示和机器人的响应一次性添加到各机器人的对话历史中。
+    # 调用 fix_history_names 方法修复历史记录中的名称问题。
+    if prompt and active_bots:
+        histories = {bot['id']: bot_manager.get_current_history_by_bot(bot) for bot in active_bots}
+        render_stop_button()
+        placeholders = {}
+        for bot in active_bots:
+            with bot_boxes[bot['id']][2]:
+                placeholders[bot['id']] = st.empty()   # 回复到达时先显示在这里
+        responses = get_responses_from_bots(prompt, active_bots, histories, placeholders, image=image)
+
+        user_message = {"role": "user", "content": prompt}
+        if image:
+            user_message["image"] = image
+        new_messages = []
+        for bot in active_bots:
+            new_messages.append((bot['id'], dict(user_message)))
+            new_messages.append((bot['id'], responses[bot['id']]))
+            placeholders[bot['id']].empty()
+        bot_manager.add_messages_to_history(new_messages)
+        bot_manager.fix_history_names(bot_manager.current_history_version_idx)
+
+    for bot in active_bots:
+        button_box, title_box, chat_box = bot_boxes[bot['id']]
+        # 获取当前bot的历史记录
+        current_history = bot_manager.get_current_history_by_bot(bot)
+        if current_history:
+            with chat_box:
                 display_chat(bot, current_history)  # 如果有对话历史记录，则调用 display_chat 函数显示对话
 
-                # 在 button_box 中显示机器人的头像，在 title_box 中显示机器人的标题
-                with button_box:
-                    show_bot_avatar(bot)
-                with title_box:
-                    show_bot_title(bot)
+            # 在 button_box 中显示机器人的头像，在 title_box 中显示机器人的标题
+            with button_box:
+                show_bot_avatar(bot)
+            with title_box:
+                show_bot_title(bot, current_history)
 
 def display_inactive_bots(bot_manager, show_bots):
     show_bots = show_bots + [{'id': 'new_bot', 'avatar': '⚡', 'name': '新增一个Bot', 'engine': f'支持{len(ENGINE_OPTIONS)}种API引擎'}]
@@ -81,12 +110,24 @@ def display_inactive_bots(bot_manager, show_bots):
                     show_toggle_bot_enable(bot)
                     if st.session_state.page == 'main_page':
                         all_histories = bot_manager.get_all_histories(bot)
-                        non_empty_histories = [h for h in all_histories[:-1] if h['history']]
+                        non_empty_histories = [h for h in all_histories[:-1] if h['message_count']]
 
                         if non_empty_histories:
                             num_topics = len(non_empty_histories)
                             with st.expander(f"查看 {num_topics} 个历史话题"):
-                                for i, history in enumerate(reversed(non_empty_histories)):
+                                # 话题的消息按需读取：选中话题后才加载并显示这个话题
+                                histories_by_index = {h['index']: h for h in non_empty_histories}
+                                history_index = st.selectbox(
+                                    "历史话题",
+                                    options=list(reversed(histories_by_index)),
+                                    format_func=lambda i: f"{histories_by_index[i]['name']}（{histories_by_index[i]['message_count']}条）",
+                                    index=None,
+                                    placeholder="选择要查看的话题",
+                                    key=f"history_topic_{bot['id']}",
+                                    label_visibility="collapsed"
+                                )
+                                history = histories_by_index.get(history_index)
+                                if history:
                                     try:
                                         timestamp = datetime.fromisoformat(history['timestamp'])
                                     except ValueError:
@@ -99,7 +140,7 @@ def display_inactive_bots(bot_manager, show_bots):
                                         formatted_time = timestamp.strftime("%Y年%m月%d日 %H:%M")
                                     
                                     st.markdown(f"**{history['name']}** - {formatted_time}")
-                                    display_chat(bot, history['history'])
+                                    display_chat(bot, bot_manager.get_history_by_bot(bot, history['index']))
             
             if i < len(show_bots) - num_cols:
                 st.markdown("---")
@@ -138,6 +179,7 @@ def display_group_chat_area(bot_manager, show_bots, histories):
             for i, tool in enumerate(sorted_tools):  
                 with tool_cols[i % 4]:
                     if st.button(tool["name"], use_container_width=True, key=f"use_tool_{i}", help=f"{tool['description'][0:100]}\n\n***【点击按钮可调用】***".strip()):
+                        render_stop_button()
                         use_tool(tool['id'], True)
 
         enabled_bots = [bot for bot in show_bots if bot['enable']]
@@ -161,8 +203,9 @@ def display_group_chat_area(bot_manager, show_bots, histories):
                     chat_config = bot_manager.get_chat_config()
                     group_user_prompt = chat_config.get('group_user_prompt')
                     if st.button(f"{bot.get('avatar', '🤖')} {bot['name']}\n\n{ENGINE_NAMES.get(bot['engine'],bot['engine'])} {bot.get('model','')}", key=f"group_bot_{bot['id']}", help=f"{bot.get('system_prompt','')[0:100]}\n\n***【点击按钮可手动发言】***".strip(), use_container_width=True):
-                        response_content = get_response_from_bot_group(group_user_prompt, bot, histories)
-                        bot_manager.add_message_to_group_history("assistant", response_content, bot=bot)
+                        render_stop_button()
+                        response_message = get_response_from_bot_group(group_user_prompt, bot, histories, placeholder=st.empty())
+                        bot_manager.add_message_to_group_history("assistant", response_message["content"], bot=bot, metrics=response_message["metrics"], error=response_message.get("error", False))
                         bot_manager.save_data_to_file()
                         st.rerun()
         
@@ -180,8 +223,9 @@ def display_group_chat_area(bot_manager, show_bots, histories):
                     chat_config = bot_manager.get_chat_config()
                     group_user_prompt = chat_config.get('group_user_prompt')
                     if st.button(f"{bot.get('avatar', '🤖')} {bot['name']}\n\n{ENGINE_NAMES.get(bot['engine'],bot['engine'])} {bot.get('model','')}", key=f"group_bot_{bot['id']}", help=f"{bot.get('system_prompt','')[0:100]}\n\n***【点击按钮可手动发言】***".strip(), use_container_width=True):
-                        response_content = get_response_from_bot_group(group_user_prompt, bot, histories)
-                        bot_manager.add_message_to_group_history("assistant", response_content, bot=bot)
+                        render_stop_button()
+                        response_message = get_response_from_bot_group(group_user_prompt, bot, histories, placeholder=st.empty())
+                        bot_manager.add_message_to_group_history("assistant", response_message["content"], bot=bot, metrics=response_message["metrics"], error=response_message.get("error", False))
                         bot_manager.save_data_to_file()
                         st.rerun()
 
@@ -191,8 +235,12 @@ def show_bot_avatar(bot):
     if st.button(bot.get('avatar', '') or '🤖', key=f"__avatar_edit_bot_{bot['id']}", help=f"{bot.get('system_prompt','')[0:100]}\n\n***【点击头像可编辑】***".strip()):
         edit_bot(bot)
 
-def show_bot_title(bot):
-   st.markdown(f"<h3 style='padding:0;'>{bot['name']}</h3> {ENGINE_NAMES.get(bot['engine'],bot['engine'])} {bot.get('model', '')}", unsafe_allow_html=True)
+def show_bot_title(bot, history=None):
+   # 标题下方显示最近一次回复的速度
+   last_metrics = next((entry.get('metrics') for entry in reversed(history or []) if entry.get('role') == 'assistant'), None)
+   speed = format_metrics(last_metrics)
+   speed_html = f" <span style='opacity: 0.6;'>{speed}</span>" if speed else ''
+   st.markdown(f"<h3 style='padding:0;'>{bot['name']}</h3> {ENGINE_NAMES.get(bot['engine'],bot['engine'])} {bot.get('model', '')}{speed_html}", unsafe_allow_html=True)
 
 def show_toggle_bot_enable(bot):
     def make_update_bot_enable(bot_id):
@@ -278,10 +326,10 @@ def use_tool(tool_folder, show_planning=False):
                         prompt = f'请你专注于你的角色设定，结合上下文继续讨论前面的话题，尽量言简意赅地表达最核心的信息和观点，格式清晰易读，尽量控制在200字以内。{prompt}'
                         if group_user_prompt:
                             prompt = f'{prompt}\n\n回复时的要求是：\n{group_user_prompt}'
-                        response = get_response_from_bot_group(prompt, bot, group_history)
+                        response_message = get_response_from_bot_group(prompt, bot, group_history, placeholder=st.empty())
                     else:
-                        response = get_response_from_bot_group(group_user_prompt, bot, group_history)
-                    bot_manager.add_message_to_group_history("assistant", response, bot=bot)
+                        response_message = get_response_from_bot_group(group_user_prompt, bot, group_history, placeholder=st.empty())
+                    bot_manager.add_message_to_group_history("assistant", response_message["content"], bot=bot, metrics=response_message["metrics"], error=response_message.get("error", False))
             elif type(result) == dict and result and result.get("type") == 'call_tool':
                 function_call = result
                 tool_id = function_call.get("id")
@@ -1,9 +1,10 @@
 # *-* coding:utf-8 *-*
 import streamlit as st
 import random
-from bot.config import ENGINE_CONFIG
+from bot.config import ENGINE_CONFIG, ENGINE_ADAPTERS
 from config import EMOJI_OPTIONS, ENGINE_OPTIONS, LOGGER, SHOW_SECRET_INFO, GUEST_USERNAMES, DEVELOPER_USERNAME
 import json
+from bot.bot_session_manager import session_manager_cache
 
 @st.dialog('编辑Bot', width='large')
 def edit_bot(bot):
@@ -25,6 +26,29 @@ def edit_bot(bot):
                 bot['name'] = new_name
 
             bot['enable'] = st.toggle('启用 / 禁用', value=bot.get('enable', True))
+            bot['cache'] = st.toggle('缓存回复', value=bot.get('cache', False), help="相同的上下文直接返回上次的回复，不再请求大模型。温度为0的Bot总是缓存")
+            if ENGINE_ADAPTERS.get(bot['engine'], {}).get('function_calling'):
+                bot['function_calling'] = st.toggle('调用工具', value=bot.get('function_calling', False), help="允许模型在回答时自行调用计算器、网页搜索等工具，需要模型本身支持 function calling")
+
+            # 备用Bot：本Bot响应明显慢于平时或请求失败时，改由备用Bot回复
+            other_bots = [b for b in bot_manager.bots if b['id'] != bot['id']]
+            fallback_options = [''] + [b['id'] for b in other_bots]
+            fallback_names = {b['id']: f"{b.get('avatar', '🤖')} {b['name']}" for b in other_bots}
+            bot['fallback_bot_id'] = st.selectbox(
+                "备用Bot",
+                options=fallback_options,
+                index=fallback_options.index(bot.get('fallback_bot_id', '')) if bot.get('fallback_bot_id', '') in fallback_options else 0,
+                format_func=lambda bot_id: fallback_names.get(bot_id, '无'),
+                help="本Bot超过平时的响应时间仍没有输出，或请求失败时，同时请求备用Bot，采用先回复的一方",
+            )
+            # 自动路由：选择与本Bot等价（同一模型、不同服务商）的Bot，每次调用自动选择当前最快的一个
+            bot['pool_bot_ids'] = st.multiselect(
+                "自动路由",
+                options=[b['id'] for b in other_bots],
+                default=[bot_id for bot_id in bot.get('pool_bot_ids', []) if bot_id in fallback_names],
+                format_func=lambda bot_id: fallback_names.get(bot_id, bot_id),
+                help="选择与本Bot等价的其他Bot（如通过不同服务商调用的同一模型），每次调用时按最近的延迟、错误率和排队情况，在本Bot和这些Bot中自动选择一个。系统提示词和温度使用本Bot的设置",
+            )
             
             st.markdown(f"**engine:** {bot.get('engine', '')}")
             
@@ -107,6 +131,9 @@ def add_new_bot():
             new_bot['name'] = st.text_input("机器人名称", value=new_bot['name'], help="请输入机器人的名称", key=f"__new_bot_name_{selected_engine}")
             
             new_bot['enable'] = st.toggle('启用 / 禁用', value=default_bot.get('enable', True), key=f"__new_bot_enable_{selected_engine}")
+            new_bot['cache'] = st.toggle('缓存回复', value=default_bot.get('cache', False), key=f"__new_bot_cache_{selected_engine}", help="相同的上下文直接返回上次的回复，不再请求大模型。温度为0的Bot总是缓存")
+            if ENGINE_ADAPTERS.get(selected_engine, {}).get('function_calling'):
+                new_bot['function_calling'] = st.toggle('调用工具', value=default_bot.get('function_calling', False), key=f"__new_bot_function_calling_{selected_engine}", help="允许模型在回答时自行调用计算器、网页搜索等工具，需要模型本身支持 function calling")
             
             st.markdown(f"**engine:** {selected_engine}")
 
@@ -156,6 +183,8 @@ def edit_bot_config():
                 new_config_dict = json.loads(new_config)
                 if bot_manager.validate_bot_config(new_config_dict):
                     bot_manager.update_bot_config(new_config_dict)
+                    # 其他会话的会话管理器会保留自己选中的话题，导入后全部重新创建，使用导入的配置
+                    session_manager_cache.invalidate(bot_manager.username)
                     st.success("配置已更新")
                     st.rerun()
                 else:
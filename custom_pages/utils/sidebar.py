@@ -2,6 +2,8 @@ import streamlit as st
 import random
 from config import EMOJI_OPTIONS, SHOW_SECRET_INFO, GUEST_USERNAMES
 from utils.user_manager import user_manager
+from utils.session_utils import cancel_session_calls, get_session_id
+from bot.bot_session_manager import session_manager_cache
 from custom_pages.utils.dialogs import edit_bot, add_new_bot, edit_bot_config
 import logging
 import re
@@ -64,11 +66,16 @@ def render_sidebar():
                 bot_manager.save_data_to_file()  # 立即保存到文件
                 LOGGER.info(f"Updated and saved force_system_prompt: {force_system_prompt}")
 
+            new_config['stream'] = st.toggle("流式输出", value=chat_config.get('stream', True), help="Bot的回复边生成边显示，不用等到全部生成完")
+
+            new_config['trim_by_tokens'] = st.toggle("按模型上下文长度携带对话", value=chat_config.get('trim_by_tokens', False), help="按各模型的上下文长度尽量多地携带最新的对话，超长的内容会被截断；关闭后按条数携带")
+            new_config['summarize_context'] = st.toggle("自动总结早期对话", value=chat_config.get('summarize_context', False), help="对话超出模型上下文长度时，把较早的对话总结成摘要继续携带", disabled=not new_config['trim_by_tokens'])
+
             if st.session_state.page == "group_page":
                 new_config['group_user_prompt'] = st.text_area("群聊接力提示词", value=chat_config.get('group_user_prompt',''), height=68, placeholder='提示Bot在群聊时应该如何接力，如果留空则由Bot自由发挥')
-                new_config['group_history_length'] = st.slider("群聊携带对话条数", min_value=1, max_value=20, value=chat_config['group_history_length'], help="Bot在参与群聊时可以看到多少条历史消息")
+                new_config['group_history_length'] = st.slider("群聊携带对话条数", min_value=1, max_value=20, value=chat_config['group_history_length'], help="Bot在参与群聊时可以看到多少条历史消息", disabled=new_config['trim_by_tokens'])
             else:
-                new_config['history_length'] = st.slider("携带对话条数", min_value=1, max_value=20, value=chat_config['history_length'])
+                new_config['history_length'] = st.slider("携带对话条数", min_value=1, max_value=20, value=chat_config['history_length'], disabled=new_config['trim_by_tokens'])
             
             bot_manager.update_chat_config(new_config)
 
@@ -183,6 +190,9 @@ def confirm_action_logout():
     col1, col2 = st.columns(2)
     with col1:
         if st.button("确认", key="confirm_button", use_container_width=True):
+            # 取消这个会话还在进行中的调用，移除这个会话缓存的会话管理器
+            cancel_session_calls()
+            session_manager_cache.invalidate(st.session_state.username, get_session_id())
             # 清除会话状态
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
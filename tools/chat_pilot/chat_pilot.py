@@ -79,7 +79,7 @@ def plan_task_with_openai(prompt, group_prompt, group_history, bots, tools):
         return f"[ERROR] 生成任务计划出错: {str(e)}"
 
 def fix_messages(messages):
-    messages = [{"role": msg.get("role"), "content": str(msg.get("content",""))} for msg in messages if msg['content']]
+    messages = [{"role": msg.get("role"), "content": str(msg.get("content",""))} for msg in messages if msg['content'] and not msg.get('error')]
     if messages and messages[-1]['role'] != 'user':
         messages[-1]['role'] = 'user'
     return messages
@@ -25,7 +25,8 @@ class ToolManager:
                         'name': config.get('name', folder),
                         'description': config.get('description', ''),
                         'main_file': config.get('main_file', ''),
-                        'parameter': config.get('parameter', {})
+                        'parameter': config.get('parameter', {}),
+                        'function': config.get('function')     # 配置了 function 的工具可以由Bot通过 function calling 调用
                     }
                     self.tool_map[folder] = tool
                     self.tools.append(tool)
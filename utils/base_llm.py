@@ -1,8 +1,10 @@
-from openai import OpenAI
+from bot.client_pool import client_pool
+from bot.warmup import BASE_LLM_ENGINE
 from config import BASS_LLM_BASE_URL, BASS_LLM_API_KEY, BASS_LLM_MODEL
 
 def base_llm_completion(content, system_prompt, history=[], tools=[]):
-    client = OpenAI(api_key=BASS_LLM_API_KEY, base_url=BASS_LLM_BASE_URL)
+    # 复用连接池中的客户端，启动时预热的连接可以直接使用
+    client = client_pool.get_openai_client(BASE_LLM_ENGINE, BASS_LLM_BASE_URL, BASS_LLM_API_KEY)
     completion = client.chat.completions.create(
         model=BASS_LLM_MODEL,
         messages=[
@@ -13,4 +15,4 @@ def base_llm_completion(content, system_prompt, history=[], tools=[]):
         temperature=0.5,
         tools=tools,
     )
-    return completion
\ No newline at end of file
+    return completion
@@ -1,114 +1,215 @@
 import logging
-import markdown
-from bot.chat_router import ChatRouter
+from bot.cancellation import cancel_registry
+from config import BOT_RESPONSE_TIMEOUT
 import streamlit.components.v1 as components
-from markdown.extensions import Extension
-from markdown.preprocessors import Preprocessor
 import html
 import random
+import time
 import streamlit as st
-from bs4 import BeautifulSoup
-import base64
 from utils.chat_styles import get_chat_container_style
+from utils.lazy_import import lazy_import
+from utils.session_utils import get_session_id
 
-LOGGER = logging.getLogger(__name__)
+# 调用大模型（openai、httpx 等）和渲染 Markdown（markdown、bs4、Pygments）的依赖较重，第一次用到时才加载
+auto_router = lazy_import('bot.auto_router')
+chat_router = lazy_import('bot.chat_router')
+fan_out = lazy_import('bot.fan_out')
+hedging = lazy_import('bot.hedging')
+markdown_utils = lazy_import('utils.markdown_utils')
 
-class SVGProcessor(Preprocessor):
-    def run(self, lines):
-        new_lines = []
-        in_block = False
-        block_content = []
-        block_type = ''
-        
-        for line in lines:
-            if line.strip().startswith('```') and not in_block:
-                block_type = line.strip()[3:].lower()
-                if block_type in ['svg', 'xml', 'html']:
-                    in_block = True
-                    block_content = []
-                else:
-                    new_lines.append(line)
-            elif line.strip() == '```' and in_block:
-                in_block = False
-                content_string = '\n'.join(block_content)
-                try:
-                    soup = BeautifulSoup(content_string, 'html.parser')
-                    root = soup.find()
-                    if root and root.name == 'svg':
-                        svg_bytes = str(root).encode('utf-8')
-                        base64_svg = base64.b64encode(svg_bytes).decode('utf-8')
-                        new_lines.append(f'![SVG图片](data:image/svg+xml;base64,{base64_svg})')
-                    else:
-                        new_lines.extend([f'```{block_type}'] + block_content + ['```'])
-                except Exception as e:
-                    LOGGER.error(f"错误解析{block_type.upper()}内容: {e}")
-                    new_lines.extend([f'```{block_type}'] + block_content + ['```'])
-            elif in_block:
-                block_content.append(line)
-            else:
-                new_lines.append(line)
-        
-        return new_lines
-class SVGExtension(Extension):
-    def extendMarkdown(self, md):
-        md.preprocessors.register(SVGProcessor(md), 'svg_processor', 175)
-class CodeProcessor(Preprocessor):
-    def run(self, lines):
-        new_lines = []
-        in_block = False
-        block_content = []
-        block_type = ''
-        
-        for line in lines:
-            if line.strip().startswith('```') and not in_block:
-                block_type = line.strip()[3:].lower() or 'text'
-                in_block = True
-                block_content = []
-                new_lines.append(f'<div class="code-block"><div class="code-header"><span class="code-language">{block_type}</span><button class="code-copy-btn" onclick="copyCode(this)"><span>复制</span></button></div>')
-                new_lines.append(line)
-            elif line.strip() == '```' and in_block:
-                in_block = False
-                new_lines.extend(block_content)
-                new_lines.append(line)
-                new_lines.append('</div>')
-            elif in_block:
-                block_content.append(line)
-            else:
-                new_lines.append(line)
-        
-        return new_lines
+LOGGER = logging.getLogger(__name__)
 
-class CodeExtension(Extension):
-    def extendMarkdown(self, md):
-        md.preprocessors.register(CodeProcessor(md), 'code_processor', 175)
+# 流式输出时两次刷新页面之间的最小间隔（秒）
+STREAM_RENDER_INTERVAL = 0.05
+# 等待回复期间刷新页面的间隔（秒），Streamlit 只在刷新页面时才能中断脚本，响应"停止生成"
+STOP_CHECK_INTERVAL = 0.5
 
 # 移除原有的 process_svg_content 函数
+# 为Bot创建请求：Bot设置了备用Bot时，主Bot响应慢或失败会自动改用备用Bot
+# context_summary 是这段对话之前保存的上下文摘要，备用Bot复用主Bot本次使用的摘要，一个请求只生成一次摘要
+# 每个 ChatRouter 的取消标记都登记在当前会话下，会话重跑或停止生成时一起取消
+# Bot设置了等价Bot池时，按各Bot最近的延迟、错误率和排队深度选出本次实际请求的Bot
+def create_bot_request(bot, bot_manager, chat_config, context_summary=None):
+    session_id = get_session_id()
+    route_bot = bot
+    if bot.get('pool_bot_ids'):
+        pool_bots = [bot_manager.get_bot_by_id(bot_id) for bot_id in bot['pool_bot_ids']]
+        route_bot = auto_router.make_backend_config(bot, auto_router.select_backend(bot, pool_bots))
+    router = chat_router.ChatRouter(route_bot, chat_config, username=bot_manager.username, context_summary=context_summary,
+                             cancel_token=cancel_registry.new_token(session_id))
+    fallback_router = None
+    fallback_bot = bot_manager.get_bot_by_id(bot.get('fallback_bot_id')) if bot.get('fallback_bot_id') else None
+    if fallback_bot and fallback_bot['id'] != bot['id']:
+        fallback_router = chat_router.ChatRouter(fallback_bot, chat_config, username=bot_manager.username, context_summary=context_summary,
+                                     cancel_token=cancel_registry.new_token(session_id), summary_source=router)
+    return hedging.HedgedRequest(router, fallback_router)
+
+# 非流式模式也通过流式接口请求，只是在线程中收齐后一次返回：这样停止生成时同样可以立即关闭连接
+# 收齐放在对冲请求之外：对冲按第一个真正的增量决定胜负，与计算等待时间用的首字延迟一致
+def make_send_job(request, send_stream, stream_mode):
+    if stream_mode:
+        return lambda: request.stream(send_stream)
+    def send_joined():
+        yield ''.join(request.stream(send_stream))
+    return send_joined
+
+# 并发执行各Bot的请求，回复到达时渲染到各自的 placeholder 中（placeholder 为 None 时不渲染）
+# 等待期间定时刷新 placeholder，让 Streamlit 有机会中断脚本，响应"停止生成"和页面重跑
+# 脚本被中断时取消所有请求，关闭连接并退还限流配额
+# 返回 (contents, errors)：以 bot_id 为键的回复文本，以及调用失败的 bot_id 集合
+def collect_responses(bot_requests, jobs, placeholders, titles=None):
+    titles = titles or {}
+    contents = {bot_id: '' for bot_id in jobs}
+    errors = set()
+    pending = set(jobs)
+    last_render_times = {bot_id: 0 for bot_id in jobs}
+
+    def render(bot_id, content):
+        if placeholders.get(bot_id) is not None:
+            placeholders[bot_id].markdown(f"{titles.get(bot_id, '')}{content}")
+            last_render_times[bot_id] = time.monotonic()
+
+    try:
+        for bot_id, event, payload in fan_out.fan_out(jobs, BOT_RESPONSE_TIMEOUT, heartbeat=STOP_CHECK_INTERVAL):
+            if event == 'tick':
+                for pending_id in pending:
+                    render(pending_id, f"{contents[pending_id]}▌")
+                continue
+            if event == 'delta':
+                contents[bot_id] += payload
+                # 限制刷新频率，避免长回复时每个增量都重新渲染整段 Markdown
+                if time.monotonic() - last_render_times[bot_id] > STREAM_RENDER_INTERVAL:
+                    render(bot_id, f"{contents[bot_id]}▌")
+                continue
+            pending.discard(bot_id)
+            if event == 'error':
+                contents[bot_id] = payload
+                errors.add(bot_id)
+            elif event == 'timeout':
+                bot_requests[bot_id].cancel()
+                contents[bot_id] = f"等待回复超过 {int(BOT_RESPONSE_TIMEOUT)} 秒"
+                errors.add(bot_id)
+            render(bot_id, contents[bot_id])
+    except BaseException:
+        # 页面重跑时 Streamlit 在刷新 placeholder 处抛出异常中断脚本，此时立即取消还在进行的请求
+        for request in bot_requests.values():
+            request.cancel()
+        raise
+    return contents, errors
+
+# Bot开启了"调用工具"时返回 function calling 可用的工具列表，须在主线程调用（线程池中不能访问 st.session_state）
+def get_bot_tools(bot):
+    if not bot.get('function_calling') or 'tool_manager' not in st.session_state:
+        return None
+    return st.session_state.tool_manager.tools
+
 # 001 从一个聊天机器人获取响应
-def get_response_from_bot(prompt, bot, history):
+# 传入 placeholder 时，回复会边生成边渲染到 placeholder 中（关闭流式输出时收齐后一次显示）
+# 返回可以直接存入历史记录的助手消息字典；调用失败时 content 为错误提示，并带有 error 标记，
+# 带 error 标记的消息只用于展示，不会作为上下文发送给大模型
+# image 是随 prompt 上传的图片（data URL），Bot按自己引擎的限制重新编码
+def get_response_from_bot(prompt, bot, history, placeholder=None, image=None):
     # bot_manager 用来管理聊天机器人配置和状态的一个类实例
     bot_manager = st.session_state.bot_manager
     # 获取最新的聊天配置。这个配置可能包含了机器人的行为设置、回复模板等
     latest_chat_config = bot_manager.get_chat_config()
     # LOGGER.info(f"Latest chat_config: {latest_chat_config}")
 
-    # 创建一个 ChatRouter 对象，它可能负责根据配置将消息路由到正确的处理逻辑
-    chat_router = ChatRouter(bot, latest_chat_config)
-    # 使用 ChatRouter 的 send_message 方法发送 prompt 消息，并附带对话历史 history，然后接收机器人的响应内容
-    response_content = chat_router.send_message(prompt, history)
+    # 创建请求，它负责根据配置将消息路由到正确的处理逻辑
+    request = create_bot_request(bot, bot_manager, latest_chat_config, bot_manager.get_context_summary(bot['id']))
+    # 发送 prompt 消息，并附带对话历史 history，然后接收机器人的响应内容
+    tools = get_bot_tools(bot)
+    input_type = 'image' if image else 'text'
+    job = make_send_job(request, lambda router: router.send_message_stream(prompt, history, input_type=input_type, image=image, tools=tools), latest_chat_config.get('stream', True))
+    contents, errors = collect_responses({bot['id']: request}, {bot['id']: job}, {bot['id']: placeholder})
+    if placeholder is not None:
+        placeholder.empty()
+    if request.primary.summary_updated:
+        bot_manager.set_context_summary(request.primary.context_summary, bot['id'])
     # 日志记录
-    # LOGGER.info(f"Single Response: {response_content}")
-    return response_content
+    # LOGGER.info(f"Single Response: {contents[bot['id']]}")
+    return build_assistant_message(contents[bot['id']], request, error=bot['id'] in errors)
 
-def get_response_from_bot_group(prompt, bot, group_history):
+def get_response_from_bot_group(prompt, bot, group_history, placeholder=None):
     bot_manager = st.session_state.bot_manager
     # 每次调用时获取最新的chat_config
     latest_chat_config = bot_manager.get_chat_config()
     # LOGGER.info(f"Latest chat_config for group chat: {latest_chat_config}")
-    chat_router = ChatRouter(bot, latest_chat_config)
-    response_content = chat_router.send_message_group(prompt, group_history)
+    request = create_bot_request(bot, bot_manager, latest_chat_config, bot_manager.get_context_summary())
+    tools = get_bot_tools(bot)
+    job = make_send_job(request, lambda router: router.send_message_group_stream(prompt, group_history, tools=tools), latest_chat_config.get('stream', True))
+    title = f"**{bot.get('avatar', '🤖')} {bot['name']}**\n\n"
+    contents, errors = collect_responses({bot['id']: request}, {bot['id']: job}, {bot['id']: placeholder}, titles={bot['id']: title})
+    if placeholder is not None:
+        placeholder.empty()
+    # 群聊的摘要由所有Bot共用
+    if request.primary.summary_updated:
+        bot_manager.set_context_summary(request.primary.context_summary)
     # 日志记录
-    # LOGGER.info(f"Group Response: {response_content}")
-    return response_content
+    # LOGGER.info(f"Group Response: {contents[bot['id']]}")
+    return build_assistant_message(contents[bot['id']], request, error=bot['id'] in errors)
+
+# 把同一个 prompt 并发发送给多个Bot，每个Bot的回复到达时就渲染到它自己的 placeholder 中
+# histories 和 placeholders 都是以 bot_id 为键的字典，image 是随 prompt 上传的图片
+# 返回以 bot_id 为键的助手消息字典
+def get_responses_from_bots(prompt, bots, histories, placeholders, image=None):
+    bot_manager = st.session_state.bot_manager
+    latest_chat_config = bot_manager.get_chat_config()
+    stream_mode = latest_chat_config.get('stream', True)
+
+    # 请求在主线程中创建，线程池中只做网络请求，不接触 st.session_state
+    bot_requests = {bot['id']: create_bot_request(bot, bot_manager, latest_chat_config, bot_manager.get_context_summary(bot['id'])) for bot in bots}
+
+    # image 是随 prompt 上传的图片（data URL），各Bot按自己引擎的限制重新编码
+    input_type = 'image' if image else 'text'
+
+    def make_job(request, history, tools):
+        return make_send_job(request, lambda router: router.send_message_stream(prompt, history, input_type=input_type, image=image, tools=tools), stream_mode)
+
+    bot_tools = {bot['id']: get_bot_tools(bot) for bot in bots}
+    jobs = {bot_id: make_job(request, histories.get(bot_id, []), bot_tools[bot_id]) for bot_id, request in bot_requests.items()}
+    contents, errors = collect_responses(bot_requests, jobs, placeholders)
+
+    # 各Bot新生成的上下文摘要在主线程中写回历史版本
+    for bot_id, request in bot_requests.items():
+        if request.primary.summary_updated:
+            bot_manager.set_context_summary(request.primary.context_summary, bot_id)
+
+    return {bot_id: build_assistant_message(contents[bot_id], bot_requests[bot_id], error=bot_id in errors) for bot_id in jobs}
+
+# 根据请求的结果构造助手消息，指标取自胜出的 ChatRouter
+def build_assistant_message(content, request, error=False):
+    metrics = dict(request.router.metrics)
+    if request.hedged:
+        metrics['hedged'] = True
+        metrics['fallback_used'] = request.router is request.fallback
+    message = {"role": "assistant", "content": content, "metrics": metrics}
+    if error:
+        message["error"] = True
+    return message
+
+# 把一次调用的指标格式化成简短的速度说明，如 "首字 0.8s · 共 3.2s · 42 tok/s"
+def format_metrics(metrics):
+    if not metrics or metrics.get('error'):
+        return ''
+    if metrics.get('cache_hit'):
+        return '⚡ 缓存'
+    parts = []
+    first_token_latency = metrics.get('first_token_latency')
+    latency = metrics.get('latency')
+    if first_token_latency is not None and first_token_latency != latency:
+        parts.append(f"首字 {first_token_latency:.1f}s")
+    if latency is not None:
+        parts.append(f"共 {latency:.1f}s")
+    # 生成速度按首字之后的时间计算，排除排队和首字等待
+    generation_time = (latency or 0) - (first_token_latency or 0) if first_token_latency != latency else (latency or 0) - metrics.get('queue_wait', 0)
+    if metrics.get('completion_tokens') and generation_time > 0:
+        parts.append(f"{metrics['completion_tokens'] / generation_time:.0f} tok/s")
+    if metrics.get('retry_count'):
+        parts.append(f"重试 {metrics['retry_count']} 次")
+    if metrics.get('fallback_used'):
+        parts.append("由备用Bot回复")
+    return '⏱ ' + ' · '.join(parts)
 
 # bot（包含机器人信息的字典）和 history（聊天历史的列表）
 def display_chat(bot, history):
@@ -123,21 +224,13 @@ def display_chat(bot, history):
     for entry in history:
         # 获取聊天条目的内容，并使用 Markdown 扩展将其转换为 HTML
         content = entry.get('content', '')
-        content_markdown = markdown.markdown(
-            str(content),
-            extensions=[
-                SVGExtension(),
-                "nl2br",
-                "codehilite",
-                "tables",
-                "admonition",
-                "sane_lists",
-                "attr_list",
-                "toc",
-                "fenced_code",
-                CodeExtension(),
-            ]
-        )
+        # 调用失败的提示加上警告标记，和正常回复区分开
+        if entry.get('error'):
+            content = f"⚠️ {content}"
+        content_markdown = markdown_utils.render_markdown(content)
+        # 用户上传的图片显示在消息文字上方
+        if entry.get('image'):
+            content_markdown = f"<img src='{html.escape(entry['image'])}' style='max-width: 100%; max-height: 240px; border-radius: 6px;'/>{content_markdown}"
         
         content_markdown_repr = repr(entry['content'])
         # 生成一个随机 ID 用于复制按钮的 JavaScript 函数
@@ -216,21 +309,10 @@ def display_group_chat(bots, history):
         bot_id = entry.get('bot_id','')
         role = entry.get('role','')
         content = entry.get('content', '')
-        content_markdown = markdown.markdown(
-            str(content),
-            extensions=[
-                SVGExtension(),
-                "nl2br",
-                "codehilite",
-                "tables",
-                "admonition",
-                "sane_lists",
-                "attr_list",
-                "toc",
-                "fenced_code",
-                CodeExtension(),
-            ]
-        )
+        # 调用失败的提示加上警告标记，和正常回复区分开
+        if entry.get('error'):
+            content = f"⚠️ {content}"
+        content_markdown = markdown_utils.render_markdown(content)
         # 将聊天内容转换为Markdown格式
         content_markdown_repr = repr(entry['content'])
         random_id = str(random.randint(100000000000, 999999999999))
@@ -265,10 +347,12 @@ def display_group_chat(bots, history):
             bot = next((b for b in bots if b['id'] == bot_id), None)
             if bot:
                 avatar = bot.get('avatar', '🤖')
+                speed = format_metrics(entry.get('metrics'))
+                speed_html = f" <span style='font-weight: normal; opacity: 0.6;'>{html.escape(speed)}</span>" if speed else ''
                 bot_html += f"""<div class='message message-assistant'>
                                 <div class='bot-avatar'>{avatar}</div>
                                 <div style='display: flex; flex-direction: column; max-width: 80%;'>
-                                    <div class='bot-name'>{html.escape(bot.get('name'))}</div>
+                                    <div class='bot-name'>{html.escape(bot.get('name'))}{speed_html}</div>
                                     <div style='display: flex; align-items: flex-end;'>
                                         <div class='message-assistant-content'>
                                             {content_markdown}
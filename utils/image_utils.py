@@ -0,0 +1,185 @@
+# *-* coding:utf-8 *-*
+import base64
+import hashlib
+import io
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+from config import IMAGE_MAX_SIDE, IMAGE_MAX_BYTES, IMAGE_JPEG_QUALITY, IMAGE_CACHE_SIZE
+
+LOGGER = logging.getLogger(__name__)
+
+# 超出大小限制时依次尝试的 JPEG 质量，全部超出时再缩小尺寸
+JPEG_QUALITY_STEPS = (IMAGE_JPEG_QUALITY, 75, 65, 50)
+# 每次缩小尺寸的比例
+DOWNSCALE_RATIO = 0.75
+# 缩小到这个尺寸仍然超出限制时放弃
+MIN_IMAGE_SIDE = 64
+# 上传时接受的图片格式
+IMAGE_UPLOAD_TYPES = ['png', 'jpg', 'jpeg', 'webp', 'gif', 'bmp']
+
+
+class ImageError(Exception):
+    """
+    图片无法读取，或者无法压缩到大小限制以内。
+    """
+
+
+def to_data_url(mime, data):
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def parse_data_url(data_url):
+    """
+    把 data URL 解析为 (mime, bytes)。
+    """
+    try:
+        header, encoded = data_url.split(',', 1)
+        mime = header[len('data:'):].split(';', 1)[0] or 'application/octet-stream'
+        return mime, base64.b64decode(encoded)
+    except (ValueError, TypeError) as e:
+        raise ImageError(f"无法解析图片数据: {str(e)}") from e
+
+
+def _target_scale(width, height, max_side, short_side=None, max_pixels=None):
+    scale = min(1.0, max_side / max(width, height))
+    if short_side:
+        scale = min(scale, short_side / min(width, height))
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (width * height)))
+    return scale
+
+
+def fit_image(image_bytes, max_side=IMAGE_MAX_SIDE, max_bytes=IMAGE_MAX_BYTES, short_side=None, max_pixels=None):
+    """
+    把图片缩放到尺寸限制以内并重新压缩，使 base64 编码后不超过 max_bytes，返回 (mime, bytes)。
+
+    参数:
+        max_side (int): 长边的最大像素数。
+        max_bytes (int): base64 编码后的最大字节数。
+        short_side (int): 短边的最大像素数，可选，如 OpenAI 高清模式会把短边缩放到 768。
+        max_pixels (int): 总像素数上限，可选，如通义千问VL按像素数计算 token。
+
+    尺寸和大小都已经符合要求的 JPEG、PNG 原样返回，不重新压缩。
+    带透明通道或颜色较少的图片（截图、图表）优先保存为 PNG，超出大小时再转为 JPEG。
+    """
+    from PIL import Image, ImageOps     # Pillow 较重，只在处理图片时才导入
+
+    # base64 编码后体积增大为原来的 4/3
+    raw_limit = max_bytes * 3 // 4
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        source_format = image.format
+        image.load()
+    except Exception as e:
+        raise ImageError(f"无法读取图片: {str(e)}") from e
+
+    transposed = ImageOps.exif_transpose(image)
+    rotated = transposed is not image
+    image = transposed
+    width, height = image.size
+    scale = _target_scale(width, height, max_side, short_side, max_pixels)
+    if scale >= 1 and not rotated and source_format in ('JPEG', 'PNG') and len(image_bytes) <= raw_limit:
+        return f"image/{source_format.lower()}", image_bytes
+
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    prefer_png = has_alpha or image.mode in ('P', 'L', '1')
+    while True:
+        size = (max(1, round(width * min(scale, 1))), max(1, round(height * min(scale, 1))))
+        resized = image.resize(size, Image.LANCZOS) if size != image.size else image
+        if prefer_png:
+            buffer = io.BytesIO()
+            resized.save(buffer, format='PNG', optimize=True)
+            if buffer.tell() <= raw_limit:
+                return 'image/png', buffer.getvalue()
+        if resized.mode != 'RGB':
+            # 透明部分填充为白色，与聊天界面的背景一致
+            background = Image.new('RGB', resized.size, (255, 255, 255))
+            rgba = resized.convert('RGBA')
+            background.paste(rgba, mask=rgba.split()[-1])
+            resized = background
+        for quality in JPEG_QUALITY_STEPS:
+            buffer = io.BytesIO()
+            resized.save(buffer, format='JPEG', quality=quality, optimize=True)
+            if buffer.tell() <= raw_limit:
+                return 'image/jpeg', buffer.getvalue()
+        scale = min(scale, 1) * DOWNSCALE_RATIO
+        if max(width, height) * scale < MIN_IMAGE_SIDE:
+            raise ImageError(f"图片无法压缩到 {max_bytes} 字节以内")
+
+
+def normalize_image(image_bytes):
+    """
+    处理上传的图片：按全局的尺寸和大小限制压缩，返回存入对话历史的 data URL。
+    """
+    mime, data = fit_image(image_bytes)
+    LOGGER.info(f"[Image] 上传图片 {len(image_bytes)} 字节，压缩后 {len(data)} 字节 ({mime})")
+    return to_data_url(mime, data)
+
+
+# 定义图片编码缓存类：按图片内容的摘要和引擎的限制缓存编码结果
+# 对话历史中的图片每轮都会随上下文发送，命中缓存时不必重新解码、缩放和编码
+class ImagePayloadCache:
+    def __init__(self, max_size=IMAGE_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            payload = self._items.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def set(self, key, payload):
+        with self._lock:
+            self._items[key] = payload
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+# 创建全局图片编码缓存实例
+image_payload_cache = ImagePayloadCache()
+
+
+def encode_image_for_engine(image, profile):
+    """
+    按引擎的图片限制编码图片，返回可以直接放进请求的字符串。
+
+    参数:
+        image (str | bytes): 对话历史中保存的 data URL，或者原始的图片字节。
+        profile (dict): ENGINE_ADAPTERS 中引擎的 image 配置，包含 max_side、max_bytes、short_side、max_pixels、data_url。
+            data_url 为 False 时返回不带前缀的 base64 字符串（如智谱的接口）。
+    """
+    if isinstance(image, str):
+        source = image.encode('ascii', errors='ignore')
+    else:
+        source = bytes(image)
+    limits = (profile.get('max_side', IMAGE_MAX_SIDE), profile.get('max_bytes', IMAGE_MAX_BYTES),
+              profile.get('short_side'), profile.get('max_pixels'))
+    key = (hashlib.sha256(source).hexdigest(), limits, profile.get('data_url', True))
+    payload = image_payload_cache.get(key)
+    if payload is not None:
+        return payload
+
+    image_bytes = parse_data_url(image)[1] if isinstance(image, str) else source
+    mime, data = fit_image(image_bytes, *limits)
+    if profile.get('data_url', True):
+        payload = to_data_url(mime, data)
+    else:
+        payload = base64.b64encode(data).decode('ascii')
+    image_payload_cache.set(key, payload)
+    return payload
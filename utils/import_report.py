@@ -0,0 +1,121 @@
+# *-* coding:utf-8 *-*
+"""
+统计冷启动时登录页首屏需要导入的模块及耗时（基于 python -X importtime），并检查是否超出预算。
+
+用法（在项目根目录下执行）:
+    python -m utils.import_report
+    python -m utils.import_report --budget 1000 --top 30
+
+在新的子进程中导入 app 和 custom_pages.login_page，报告写入 logs/import_time_report.txt。
+导入总耗时超过 MULTIBOT_IMPORT_TIME_BUDGET_MS，或者首屏导入了应当延迟加载的重量级模块时，以返回码 1 退出。
+"""
+import argparse
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+from config import IMPORT_TIME_BUDGET_MS
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 登录页首屏需要导入的模块：app.py 顶部的导入，加上登录页本身
+FIRST_PAINT_MODULES = ['app', 'custom_pages.login_page']
+
+# 只在对话、工具中用到的重量级依赖，首屏不应该导入
+LAZY_MODULES = ['openai', 'httpx', 'markdown', 'bs4', 'pygments', 'readability', 'duckduckgo_search', 'zhipuai']
+
+DEFAULT_OUTPUT = os.path.join('logs', 'import_time_report.txt')
+
+
+def run_importtime(modules):
+    """
+    在子进程中导入 modules，返回 -X importtime 的输出。
+    """
+    env = dict(os.environ, PYTHONIOENCODING='utf-8')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {', '.join(modules)}"],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True, encoding='utf-8',
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入失败:\n{result.stderr[-2000:]}")
+    return result.stderr
+
+
+def parse_importtime(output):
+    """
+    解析 -X importtime 的输出，返回 [{'name', 'level', 'self_us', 'cumulative_us'}]，顺序同输出。
+    level 为嵌套层级，0 表示由顶层直接导入。
+    """
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        raw_name = parts[2][1:]
+        name = raw_name.lstrip(' ')
+        entries.append({
+            'name': name,
+            'level': (len(raw_name) - len(name)) // 2,
+            'self_us': int(parts[0].strip()),
+            'cumulative_us': int(parts[1].strip()),
+        })
+    return entries
+
+
+def build_report(entries, budget_ms, top=20):
+    """
+    返回 (报告文本, 是否通过)。
+    """
+    total_ms = sum(entry['cumulative_us'] for entry in entries if entry['level'] == 0) / 1000
+    imported = {entry['name'] for entry in entries}
+    eager_heavy = [name for name in LAZY_MODULES if name in imported]
+
+    # 按自身耗时排序更容易找到真正慢的模块，按累计耗时排序更容易找到把它们带进来的入口
+    by_cumulative = sorted((e for e in entries if e['level'] <= 1), key=lambda e: e['cumulative_us'], reverse=True)[:top]
+    by_self = sorted(entries, key=lambda e: e['self_us'], reverse=True)[:top]
+
+    lines = [
+        f"导入耗时报告 {datetime.now().isoformat(timespec='seconds')}",
+        f"导入的模块: {', '.join(FIRST_PAINT_MODULES)}",
+        f"总耗时: {total_ms:.0f} ms / 预算 {budget_ms} ms，共导入 {len(entries)} 个模块",
+        '',
+        f"累计耗时最多的 {len(by_cumulative)} 个模块（含其导入的子模块）:",
+    ]
+    lines += [f"  {e['cumulative_us'] / 1000:>8.1f} ms  {'  ' * e['level']}{e['name']}" for e in by_cumulative]
+    lines += ['', f"自身耗时最多的 {len(by_self)} 个模块:"]
+    lines += [f"  {e['self_us'] / 1000:>8.1f} ms  {e['name']}" for e in by_self]
+
+    passed = total_ms <= budget_ms and not eager_heavy
+    lines.append('')
+    if eager_heavy:
+        lines.append(f"失败: 首屏导入了应当延迟加载的模块: {', '.join(eager_heavy)}（请改用 utils.lazy_import 或在函数内导入）")
+    if total_ms > budget_ms:
+        lines.append(f"失败: 导入总耗时 {total_ms:.0f} ms 超出预算 {budget_ms} ms")
+    if passed:
+        lines.append('通过')
+    return '\n'.join(lines), passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='统计登录页首屏的导入耗时')
+    parser.add_argument('--budget', type=int, default=IMPORT_TIME_BUDGET_MS, help='导入总耗时预算（毫秒）')
+    parser.add_argument('--top', type=int, default=20, help='列出耗时最多的模块数量')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='报告文件路径，为空时不写文件')
+    args = parser.parse_args()
+
+    entries = parse_importtime(run_importtime(FIRST_PAINT_MODULES))
+    report, passed = build_report(entries, args.budget, args.top)
+    print(report)
+    if args.output:
+        output = os.path.join(PROJECT_DIR, args.output)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# *-* coding:utf-8 *-*
+import importlib
+import importlib.util
+import sys
+import threading
+
+_lock = threading.Lock()
+
+
+def lazy_import(name):
+    """
+    延迟导入模块：立即返回模块对象，第一次访问它的属性时才真正执行模块代码。
+
+    用于登录页等首屏不需要的重量级依赖（openai、httpx、markdown、bs4 等），
+    使它们只在第一次真正用到时才加载，缩短进程启动后首屏的渲染时间。
+
+    注意：`from x import y` 会立即访问属性，达不到延迟的效果，调用方应当保留模块对象，用 `x.y` 的方式访问。
+    已经导入过的模块直接返回，模块不存在时与普通导入一样抛出 ModuleNotFoundError。
+    """
+    with _lock:
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        # 父包按普通方式导入，只有目标模块本身延迟执行
+        parent, _, child = name.rpartition('.')
+        if parent:
+            importlib.import_module(parent)
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+        if parent:
+            setattr(sys.modules[parent], child, module)
+        return module
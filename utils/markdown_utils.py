@@ -0,0 +1,100 @@
+# *-* coding:utf-8 *-*
+import base64
+import logging
+import markdown
+from markdown.extensions import Extension
+from markdown.preprocessors import Preprocessor
+from bs4 import BeautifulSoup
+
+LOGGER = logging.getLogger(__name__)
+
+# 聊天记录的 Markdown 渲染。markdown、bs4 和 codehilite 依赖的 Pygments 较重，
+# 这个模块由 chat_utils 延迟导入，只在第一次渲染聊天记录时加载
+
+class SVGProcessor(Preprocessor):
+    def run(self, lines):
+        new_lines = []
+        in_block = False
+        block_content = []
+        block_type = ''
+        
+        for line in lines:
+            if line.strip().startswith('```') and not in_block:
+                block_type = line.strip()[3:].lower()
+                if block_type in ['svg', 'xml', 'html']:
+                    in_block = True
+                    block_content = []
+                else:
+                    new_lines.append(line)
+            elif line.strip() == '```' and in_block:
+                in_block = False
+                content_string = '\n'.join(block_content)
+                try:
+                    soup = BeautifulSoup(content_string, 'html.parser')
+                    root = soup.find()
+                    if root and root.name == 'svg':
+                        svg_bytes = str(root).encode('utf-8')
+                        base64_svg = base64.b64encode(svg_bytes).decode('utf-8')
+                        new_lines.append(f'![SVG图片](data:image/svg+xml;base64,{base64_svg})')
+                    else:
+                        new_lines.extend([f'```{block_type}'] + block_content + ['```'])
+                except Exception as e:
+                    LOGGER.error(f"错误解析{block_type.upper()}内容: {e}")
+                    new_lines.extend([f'```{block_type}'] + block_content + ['```'])
+            elif in_block:
+                block_content.append(line)
+            else:
+                new_lines.append(line)
+        
+        return new_lines
+class SVGExtension(Extension):
+    def extendMarkdown(self, md):
+        md.preprocessors.register(SVGProcessor(md), 'svg_processor', 175)
+class CodeProcessor(Preprocessor):
+    def run(self, lines):
+        new_lines = []
+        in_block = False
+        block_content = []
+        block_type = ''
+        
+        for line in lines:
+            if line.strip().startswith('```') and not in_block:
+                block_type = line.strip()[3:].lower() or 'text'
+                in_block = True
+                block_content = []
+                new_lines.append(f'<div class="code-block"><div class="code-header"><span class="code-language">{block_type}</span><button class="code-copy-btn" onclick="copyCode(this)"><span>复制</span></button></div>')
+                new_lines.append(line)
+            elif line.strip() == '```' and in_block:
+                in_block = False
+                new_lines.extend(block_content)
+                new_lines.append(line)
+                new_lines.append('</div>')
+            elif in_block:
+                block_content.append(line)
+            else:
+                new_lines.append(line)
+        
+        return new_lines
+
+class CodeExtension(Extension):
+    def extendMarkdown(self, md):
+        md.preprocessors.register(CodeProcessor(md), 'code_processor', 175)
+
+
+# 把一条聊天内容渲染成 HTML
+def render_markdown(content):
+    return markdown.markdown(
+        str(content),
+        extensions=[
+            SVGExtension(),
+            "nl2br",
+            "codehilite",
+            "tables",
+            "admonition",
+            "sane_lists",
+            "attr_list",
+            "toc",
+            "fenced_code",
+            CodeExtension(),
+        ]
+    )
@@ -0,0 +1,316 @@
+# *-* coding:utf-8 *-*
+"""
+本地模拟大模型服务，用于在没有网络的环境下对整个应用做压测和延迟测试。
+
+支持 ChatRouter 使用的各种协议:
+    - OpenAI 兼容接口 .../chat/completions（普通和 SSE 流式），智谱和千帆 v2 也使用这个格式
+    - AzureOpenAI .../openai/deployments/{model}/chat/completions
+    - CoZe .../open_api/v2/chat（普通和流式）
+    - 预热用到的 .../models、HEAD 请求和 Ollama 的 /api/generate
+可以配置首字延迟的分布、生成速度、429/5xx 的注入比例、挂起不响应的连接和流式输出中途断开。
+
+用法:
+    python -m utils.mock_llm_server --port 8765 --latency lognormal:-0.5,0.6 --token-rate 40 --rate-429 0.05
+    # 另一个终端中，所有引擎都改为请求模拟服务
+    MULTIBOT_MOCK_LLM_BASE_URL=http://127.0.0.1:8765 streamlit run app.py
+
+请求路径的第一段是引擎名（如 /Moonshot/chat/completions），--config 指定的 JSON 文件可以按引擎覆盖参数:
+    {"Moonshot": {"latency": "fixed:3", "rate_5xx": 0.2}, "CoZe": {"hang": 0.1}}
+GET /_stats 返回按引擎和状态码统计的请求数。
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    'latency': 'lognormal:-0.7,0.5',    # 首字延迟的分布（秒）
+    'token_rate': 50.0,                 # 生成速度（token/秒）
+    'reply_tokens': 120,                # 每个回复的 token 数
+    'rate_429': 0.0,                    # 返回 429 的比例
+    'retry_after': 1,                   # 429 响应的 Retry-After（秒）
+    'rate_5xx': 0.0,                    # 返回 500/502/503 的比例
+    'hang': 0.0,                        # 接受请求后不响应的比例
+    'hang_seconds': 600,                # 挂起的时长（秒）
+    'stream_drop': 0.0,                 # 流式输出中途断开连接的比例
+}
+
+# 模拟回复的内容，中英文混排，用来覆盖按字符估算 token 的逻辑
+REPLY_WORDS = ['这是', '模拟', '服务', '的', '回复', '，', 'mock ', 'reply ', 'token ', '。', '测试', '延迟', '和', '吞吐', '\n']
+
+
+def sample_latency(spec):
+    """
+    按分布采样延迟（秒）。spec 格式为 名称:参数，支持:
+        fixed:秒数  uniform:最小,最大  normal:均值,标准差  lognormal:mu,sigma  exp:均值
+    """
+    name, _, raw_params = spec.partition(':')
+    params = [float(p) for p in raw_params.split(',') if p]
+    if name == 'fixed':
+        value = params[0]
+    elif name == 'uniform':
+        value = random.uniform(params[0], params[1])
+    elif name == 'normal':
+        value = random.gauss(params[0], params[1])
+    elif name == 'lognormal':
+        value = random.lognormvariate(params[0], params[1])
+    elif name == 'exp':
+        value = random.expovariate(1 / params[0])
+    else:
+        raise ValueError(f"不支持的延迟分布: {spec}")
+    return max(0.0, value)
+
+
+def estimate_tokens(messages):
+    # 粗略估算，模拟服务只需要量级正确
+    return sum(len(str(m.get('content', ''))) for m in messages or []) // 2 + 1
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings, engine_settings=None):
+        super().__init__(address, MockLLMHandler)
+        self.settings = settings
+        self.engine_settings = engine_settings or {}
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.stats_lock = threading.Lock()
+
+    def get_settings(self, engine):
+        return {**self.settings, **self.engine_settings.get(engine, {})}
+
+    def record(self, engine, status):
+        with self.stats_lock:
+            self.stats[engine][str(status)] += 1
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 才能保持长连接，和客户端的连接池一起测试
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        LOGGER.debug(f"[MockLLM] {self.address_string()} {format % args}")
+
+    # ---------- 请求分派 ----------
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/_stats':
+            with self.server.stats_lock:
+                stats = {engine: dict(counts) for engine, counts in self.server.stats.items()}
+            return self.send_json(200, stats)
+        if path.endswith('/models'):
+            return self.send_json(200, {'object': 'list', 'data': [{'id': 'mock-model', 'object': 'model'}]})
+        self.send_json(404, {'error': {'message': f'not found: {path}'}})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        engine = path.strip('/').split('/')[0] or 'default'
+        settings = self.server.get_settings(engine)
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        except ValueError:
+            return self.send_json(400, {'error': {'message': 'invalid json'}})
+
+        if path.endswith('/api/generate'):
+            # Ollama 预加载模型
+            self.server.record(engine, 200)
+            return self.send_json(200, {'model': body.get('model'), 'done': True, 'done_reason': 'load'})
+
+        if path.endswith('/open_api/v2/chat'):
+            protocol = 'coze'
+        elif '/openai/deployments/' in path and path.endswith('/chat/completions'):
+            protocol = 'azure'
+        elif path.endswith('/chat/completions'):
+            protocol = 'openai'
+        else:
+            return self.send_json(404, {'error': {'message': f'not found: {path}'}})
+
+        if self.inject_fault(engine, settings):
+            return
+        self.server.record(engine, 200)
+        if protocol == 'coze':
+            self.handle_coze(body, settings)
+        else:
+            self.handle_openai(body, settings, azure=protocol == 'azure')
+
+    def inject_fault(self, engine, settings):
+        """
+        按比例注入挂起、429 和 5xx，已处理时返回 True。
+        """
+        if random.random() < settings['hang']:
+            self.server.record(engine, 'hang')
+            # 不返回任何内容，直到客户端超时断开或挂起时间结束
+            time.sleep(settings['hang_seconds'])
+            self.close_connection = True
+            return True
+        if random.random() < settings['rate_429']:
+            self.server.record(engine, 429)
+            self.send_json(429, {'error': {'message': 'mock rate limit', 'type': 'rate_limit_error'}},
+                           headers={'Retry-After': str(settings['retry_after'])})
+            return True
+        if random.random() < settings['rate_5xx']:
+            status = random.choice([500, 502, 503])
+            self.server.record(engine, status)
+            self.send_json(status, {'error': {'message': f'mock server error {status}'}})
+            return True
+        return False
+
+    # ---------- 生成 ----------
+
+    def generate_tokens(self, settings):
+        """
+        先等待首字延迟，再按生成速度逐个产出 token。
+        """
+        time.sleep(sample_latency(settings['latency']))
+        interval = 1 / settings['token_rate'] if settings['token_rate'] > 0 else 0
+        for i in range(int(settings['reply_tokens'])):
+            if i and interval:
+                time.sleep(interval)
+            yield REPLY_WORDS[i % len(REPLY_WORDS)]
+
+    def usage(self, messages, completion_tokens):
+        prompt_tokens = estimate_tokens(messages)
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+    def handle_openai(self, body, settings, azure=False):
+        model = body.get('model') or 'mock-model'
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        if not body.get('stream'):
+            content = ''.join(self.generate_tokens(settings))
+            return self.send_json(200, {
+                'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': self.usage(body.get('messages'), int(settings['reply_tokens'])),
+            })
+
+        def chunk(delta, finish_reason=None, usage=None):
+            data = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            if usage:
+                data['usage'] = usage
+            return data
+
+        def events():
+            if azure:
+                # Azure 的第一个数据块只包含内容过滤结果
+                yield {'id': '', 'object': '', 'created': 0, 'model': '', 'choices': [], 'prompt_filter_results': []}
+            yield chunk({'role': 'assistant', 'content': ''})
+            count = 0
+            for token in self.generate_tokens(settings):
+                count += 1
+                yield chunk({'content': token})
+            yield chunk({}, finish_reason='stop', usage=self.usage(body.get('messages'), count))
+
+        self.send_sse(events(), settings, done_marker=True)
+
+    def handle_coze(self, body, settings):
+        conversation_id = uuid.uuid4().hex[:12]
+        if not body.get('stream'):
+            content = ''.join(self.generate_tokens(settings))
+            return self.send_json(200, {
+                'msg': 'success', 'code': 0, 'conversation_id': conversation_id,
+                'messages': [{'role': 'assistant', 'type': 'answer', 'content': content, 'content_type': 'text'}],
+            })
+
+        def events():
+            for token in self.generate_tokens(settings):
+                yield {'event': 'message', 'is_finish': False, 'conversation_id': conversation_id,
+                       'message': {'role': 'assistant', 'type': 'answer', 'content': token, 'content_type': 'text'}}
+            yield {'event': 'done'}
+
+        self.send_sse(events(), settings, done_marker=False)
+
+    # ---------- 输出 ----------
+
+    def send_json(self, status, data, headers=None):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_sse(self, events, settings, done_marker):
+        """
+        用分块传输编码发送 SSE，连接在结束后可以继续复用。
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        drop_at = int(settings['reply_tokens'] * random.random()) if random.random() < settings['stream_drop'] else None
+        try:
+            for index, event in enumerate(events):
+                if drop_at is not None and index >= drop_at:
+                    # 模拟流式输出中途断开：不发送结束块，直接关闭连接
+                    self.close_connection = True
+                    return
+                self.write_chunk(f"data:{json.dumps(event, ensure_ascii=False)}\n\n")
+            if done_marker:
+                self.write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了请求
+            self.close_connection = True
+
+    def write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟大模型服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', default=DEFAULT_SETTINGS['latency'], help='首字延迟分布，如 fixed:0.5、uniform:0.2,2、lognormal:-0.7,0.5、exp:1')
+    parser.add_argument('--token-rate', type=float, default=DEFAULT_SETTINGS['token_rate'], help='生成速度（token/秒），0 表示不限速')
+    parser.add_argument('--reply-tokens', type=int, default=DEFAULT_SETTINGS['reply_tokens'], help='每个回复的 token 数')
+    parser.add_argument('--rate-429', type=float, default=DEFAULT_SETTINGS['rate_429'], help='返回 429 的比例')
+    parser.add_argument('--retry-after', type=int, default=DEFAULT_SETTINGS['retry_after'], help='429 响应的 Retry-After（秒）')
+    parser.add_argument('--rate-5xx', type=float, default=DEFAULT_SETTINGS['rate_5xx'], help='返回 500/502/503 的比例')
+    parser.add_argument('--hang', type=float, default=DEFAULT_SETTINGS['hang'], help='挂起不响应的比例')
+    parser.add_argument('--hang-seconds', type=float, default=DEFAULT_SETTINGS['hang_seconds'], help='挂起的时长（秒）')
+    parser.add_argument('--stream-drop', type=float, default=DEFAULT_SETTINGS['stream_drop'], help='流式输出中途断开的比例')
+    parser.add_argument('--config', help='按引擎覆盖参数的 JSON 文件')
+    args = parser.parse_args()
+
+    settings = {key: getattr(args, key) for key in DEFAULT_SETTINGS}
+    sample_latency(settings['latency'])     # 启动前检查延迟分布的格式
+    engine_settings = {}
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            engine_settings = json.load(f)
+
+    logging.basicConfig(level=logging.INFO)
+    server = MockLLMServer((args.host, args.port), settings, engine_settings)
+    LOGGER.info(f"[MockLLM] 模拟服务已启动: http://{args.host}:{args.port} 参数: {settings}")
+    LOGGER.info(f"[MockLLM] 设置环境变量 MULTIBOT_MOCK_LLM_BASE_URL=http://{args.host}:{args.port} 后启动应用")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+# *-* coding:utf-8 *-*
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from bot.cancellation import cancel_registry
+
+# 这个模块只依赖 streamlit 和 bot.cancellation，登录页等不需要对话功能的页面也可以直接导入
+
+
+# 当前 Streamlit 会话的ID，用于登记和取消这个会话发出的调用；不在 Streamlit 中运行时返回 None
+def get_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+# 取消当前会话所有还在进行中的调用，页面重跑、退出登录和点击"停止生成"时调用
+def cancel_session_calls():
+    return cancel_registry.cancel_session(get_session_id())
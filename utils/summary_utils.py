@@ -0,0 +1,97 @@
+# *-* coding:utf-8 *-*
+import hashlib
+import logging
+
+from utils.base_llm import base_llm_completion
+from utils.token_utils import estimate_messages_tokens, estimate_text_tokens, truncate_text_to_tokens
+from config import SUMMARY_KEEP_RATIO
+
+LOGGER = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = """你负责压缩一段多人对话的上下文。
+请把【已有摘要】和【新增对话】合并成一份新的摘要，保留讨论的主题、各方的主要观点和结论、尚未解决的问题，以及后续对话需要用到的关键事实和数字。
+不要评价，不要补充对话中没有的内容，用中文输出，尽量控制在500字以内。"""
+
+
+def _fingerprint(message):
+    content = f"{message.get('role', '')}:{message.get('content', '')}"
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+
+def is_summary_valid(summary, history):
+    """
+    摘要记录了它覆盖到的消息条数和最后一条消息的指纹，历史记录被删改后摘要失效。
+    """
+    if not summary or not summary.get('content'):
+        return False
+    upto = summary.get('upto', 0)
+    if upto <= 0 or upto > len(history):
+        return False
+    return summary.get('fingerprint') == _fingerprint(history[upto - 1])
+
+
+def _format_messages(messages):
+    lines = []
+    for message in messages:
+        if message.get('error') or not message.get('content'):
+            continue
+        speaker = message.get('bot_name') or message.get('tool_name') or ('用户' if message.get('role') == 'user' else '助手')
+        lines.append(f"{speaker}：{message['content']}")
+    return '\n\n'.join(lines)
+
+
+def summarize_messages(previous_summary, messages, max_tokens):
+    """
+    调用基础模型把已有摘要和新增的对话合并成新的摘要。
+    """
+    content = f"【已有摘要】\n{previous_summary or '（无）'}\n\n【新增对话】\n{_format_messages(messages)}"
+    completion = base_llm_completion(content, SUMMARY_SYSTEM_PROMPT)
+    summary = completion.choices[0].message.content or ''
+    return truncate_text_to_tokens(summary.strip(), max_tokens)
+
+
+def summarize_history(history, summary, budget):
+    """
+    历史记录超出 budget 时，用摘要代替较早的消息。
+
+    参数:
+        history (list): 完整的历史记录。
+        summary (dict): 之前保存的摘要 {'upto', 'fingerprint', 'content'}，没有时为 None。
+        budget (int): 历史记录（含摘要）可以使用的 token 数。
+
+    返回:
+        (summary, recent_history): 使用的摘要（可能是新生成的，不需要摘要时为 None）和摘要之后的消息。
+        已有摘要仍然够用时直接复用，只有摘要之后的消息再次超出预算时才重新生成，避免每轮都调用基础模型。
+    """
+    if estimate_messages_tokens(history) <= budget:
+        return None, history
+
+    if is_summary_valid(summary, history):
+        upto = summary['upto']
+        recent_history = history[upto:]
+        if estimate_text_tokens(summary['content']) + estimate_messages_tokens(recent_history) <= budget:
+            return summary, recent_history
+        previous_summary = summary['content']
+    else:
+        upto = 0
+        previous_summary = ''
+
+    # 从最新的消息往前保留一部分预算，更早的消息并入摘要
+    keep_budget = int(budget * SUMMARY_KEEP_RATIO)
+    split = len(history)
+    kept_tokens = 0
+    while split > upto:
+        tokens = estimate_messages_tokens(history[split - 1:split])
+        if kept_tokens + tokens > keep_budget:
+            break
+        kept_tokens += tokens
+        split -= 1
+    # 最新的一条消息总是原样保留，它本身超长时交给裁剪处理
+    split = min(split, len(history) - 1)
+    if split <= upto:
+        return (summary if upto else None), history[upto:]
+
+    LOGGER.info(f"[Summary] 合并第 {upto + 1} 到 {split} 条消息到摘要")
+    content = summarize_messages(previous_summary, history[upto:split], budget - keep_budget)
+    new_summary = {'upto': split, 'fingerprint': _fingerprint(history[split - 1]), 'content': content}
+    return new_summary, history[split:]
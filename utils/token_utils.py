@@ -0,0 +1,114 @@
+# *-* coding:utf-8 *-*
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+from bot.config import ENGINE_CONFIG
+from config import CONTEXT_TOKEN_BUDGET
+
+# 中日韩文字、全角标点：大多数模型的分词器中约一个字一个 token
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+# 每条消息的角色、分隔符等固定开销
+MESSAGE_OVERHEAD_TOKENS = 4
+# 每张图片按固定的 token 数估算（约为 OpenAI 高清模式下一张 1024x1024 图片的用量）
+IMAGE_TOKENS = 1000
+# 截断超长消息时附加的提示
+TRUNCATED_SUFFIX = '\n\n……（内容过长，已截断）'
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+_TOKEN_CACHE_MAX_SIZE = 10000
+
+
+def estimate_text_tokens(text):
+    """
+    快速估算一段文本的 token 数：中日韩文字按每字 1 个 token，其余字符按每 4 个字符 1 个 token。
+    结果只用于裁剪上下文和限流，不追求与各家分词器完全一致。
+    """
+    if not text:
+        return 0
+    cjk_count = len(CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+
+def estimate_message_tokens(message):
+    """
+    估算单条消息的 token 数，按内容摘要缓存，历史消息每轮只需计算一次。
+    消息中的图片（image 字段或多模态 content 中的 image_url）每张按 IMAGE_TOKENS 计算，不计入 base64 数据。
+    """
+    content = message.get('content', '')
+    image_count = 1 if message.get('image') else 0
+    if isinstance(content, list):
+        image_count += sum(1 for part in content if part.get('type') == 'image_url')
+        content = ''.join(part.get('text', '') for part in content if part.get('type') == 'text')
+    content = str(content)
+    key = hashlib.md5(content.encode('utf-8')).hexdigest()
+    with _token_cache_lock:
+        tokens = _token_cache.get(key)
+        if tokens is not None:
+            _token_cache.move_to_end(key)
+            return tokens + image_count * IMAGE_TOKENS
+    tokens = estimate_text_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    with _token_cache_lock:
+        _token_cache[key] = tokens
+        if len(_token_cache) > _TOKEN_CACHE_MAX_SIZE:
+            _token_cache.popitem(last=False)
+    return tokens + image_count * IMAGE_TOKENS
+
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+def get_context_budget(engine, model):
+    """
+    获取模型的上下文 token 预算（已为回复预留空间），取自 ENGINE_CONFIG 中该引擎的 context_budget，
+    优先使用模型名对应的值，其次使用引擎的 default，都没有时使用全局的 CONTEXT_TOKEN_BUDGET。
+    """
+    context_budget = ENGINE_CONFIG.get('engines', {}).get(engine, {}).get('context_budget', {})
+    return context_budget.get(model) or context_budget.get('default') or CONTEXT_TOKEN_BUDGET
+
+
+def truncate_text_to_tokens(text, max_tokens):
+    """
+    从开头保留文本，使估算的 token 数不超过 max_tokens。
+    """
+    if estimate_text_tokens(text) <= max_tokens:
+        return text
+    max_tokens = max(0, max_tokens - estimate_text_tokens(TRUNCATED_SUFFIX))
+    # 二分查找能保留的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_text_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + TRUNCATED_SUFFIX
+
+
+def trim_messages_to_budget(messages, budget):
+    """
+    在 token 预算内保留系统提示词和最新的消息。
+
+    - 开头的 system 消息总是保留
+    - 从最新的消息往前保留，直到预算用完，更早的消息丢弃
+    - 最新的一条消息本身就超出预算时，截断它的内容
+    """
+    system_messages = [message for message in messages[:1] if message.get('role') == 'system']
+    other_messages = messages[len(system_messages):]
+    remaining = budget - estimate_messages_tokens(system_messages)
+
+    kept_messages = []
+    for message in reversed(other_messages):
+        tokens = estimate_message_tokens(message)
+        if tokens > remaining:
+            if not kept_messages:
+                content = truncate_text_to_tokens(str(message.get('content', '')), max(remaining - MESSAGE_OVERHEAD_TOKENS, 0))
+                kept_messages.append({**message, 'content': content})
+            break
+        kept_messages.append(message)
+        remaining -= tokens
+    kept_messages.reverse()
+    return system_messages + kept_messages